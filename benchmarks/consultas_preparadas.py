@@ -0,0 +1,84 @@
+# Mede o custo de planejamento economizado pelas consultas preparadas do bot.
+#
+# Uso: DATABASE_URL=postgresql://... python benchmarks/consultas_preparadas.py [repeticoes]
+#
+# Para cada consulta de CONSULTAS_PREPARADAS (exceto as de escrita), compara na mesma conexão:
+#   - SQL comum: o texto é enviado, analisado e planejado a cada chamada (como antes do pool)
+#   - PREPARE/EXECUTE: o texto é analisado uma vez; após 5 execuções o PostgreSQL pode passar
+#     a reutilizar o plano genérico
+# e mostra o "Planning Time" médio do EXPLAIN ANALYZE de cada forma.
+import os
+import re
+import statistics
+import sys
+import time
+from datetime import date
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import psycopg2
+from decouple import config
+
+from bot import CONSULTAS_PREPARADAS
+
+USUARIO = "benchmark"
+PARAMETROS = {
+    "totais_periodo": (USUARIO, "month", date(2024, 1, 1), date(2025, 1, 1)),
+    "listar_gastos": (USUARIO, date(2024, 1, 1), date(2024, 2, 1)),
+    "listar_entradas": (USUARIO, date(2024, 1, 1), date(2024, 2, 1)),
+    "obter_limite": (USUARIO,),
+    "avaliar_limites": (USUARIO, date(2024, 1, 1), date(2024, 2, 1)),
+}
+TEMPO_PLANEJAMENTO = re.compile(r"Planning Time: ([\d.]+) ms")
+
+# $n -> %s na ordem em que aparecem, repetindo os parâmetros quando o mesmo $n se repete
+def sql_comum(sql, parametros):
+    ordem = [int(n) - 1 for n in re.findall(r"\$(\d+)", sql)]
+    return re.sub(r"\$\d+", "%s", sql), [parametros[i] for i in ordem]
+
+def planejamento(cursor, sql, parametros):
+    cursor.execute(f"EXPLAIN (ANALYZE, SUMMARY) {sql}", parametros)
+    plano = "\n".join(linha for (linha,) in cursor.fetchall())
+    return float(TEMPO_PLANEJAMENTO.search(plano)[1])
+
+def medir(cursor, nome, repeticoes):
+    tipos, sql = CONSULTAS_PREPARADAS[nome]
+    parametros = PARAMETROS[nome]
+    comum, parametros_comum = sql_comum(sql, parametros)
+    marcadores = ", ".join(["%s"] * len(parametros))
+
+    inicio = time.perf_counter()
+    for _ in range(repeticoes):
+        cursor.execute(comum, parametros_comum)
+        cursor.fetchall()
+    tempo_comum = (time.perf_counter() - inicio) / repeticoes * 1000
+
+    cursor.execute(f"PREPARE {nome} ({tipos}) AS {sql}")
+    inicio = time.perf_counter()
+    for _ in range(repeticoes):
+        cursor.execute(f"EXECUTE {nome} ({marcadores})", parametros)
+        cursor.fetchall()
+    tempo_preparado = (time.perf_counter() - inicio) / repeticoes * 1000
+
+    planejamento_comum = statistics.mean(planejamento(cursor, comum, parametros_comum) for _ in range(repeticoes))
+    planejamento_preparado = statistics.mean(
+        planejamento(cursor, f"EXECUTE {nome} ({marcadores})", parametros) for _ in range(repeticoes)
+    )
+    cursor.execute(f"DEALLOCATE {nome}")
+    return tempo_comum, tempo_preparado, planejamento_comum, planejamento_preparado
+
+def main():
+    repeticoes = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    conn = psycopg2.connect(config("DATABASE_URL"))
+    try:
+        with conn.cursor() as cursor:
+            print(f"{'consulta':<18}{'comum ms':>10}{'preparada ms':>14}{'plan. comum':>13}{'plan. prep.':>13}")
+            for nome in PARAMETROS:
+                tempo_comum, tempo_preparado, plan_comum, plan_preparado = medir(cursor, nome, repeticoes)
+                print(f"{nome:<18}{tempo_comum:>10.3f}{tempo_preparado:>14.3f}{plan_comum:>13.3f}{plan_preparado:>13.3f}")
+        conn.rollback()
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+# Compara a soma de valores em dinheiro no modelo antigo (float/Decimal) e em centavos inteiros.
+#
+# Uso: python benchmarks/dinheiro_centavos.py [quantidade]
+#
+# Gera valores digitados como no bot ("32,50", "1.500", "0.10") e mede, para a mesma lista:
+#   - float: float() do texto e sum() em float (como o text_handler fazia), com o erro acumulado
+#   - Decimal: os valores como vêm do NUMERIC do PostgreSQL, somados em Decimal
+#   - centavos: ler_centavos() e soma em array("q") / NumPy int64, como nos resumos e análises
+import os
+import random
+import sys
+import time
+from array import array
+from decimal import Decimal
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import numpy as np
+
+from bot import em_reais, ler_centavos
+
+def gerar_valores(quantidade):
+    aleatorio = random.Random(42)
+    valores = []
+    for _ in range(quantidade):
+        centavos = aleatorio.randint(1, 500000)
+        reais, resto = divmod(centavos, 100)
+        valores.append(f"{reais},{resto:02d}" if resto else str(reais))
+    return valores
+
+def medir(funcao, *argumentos):
+    inicio = time.perf_counter()
+    resultado = funcao(*argumentos)
+    return resultado, (time.perf_counter() - inicio) * 1000
+
+def somar_float(valores):
+    return sum(float(valor.replace(",", ".")) for valor in valores)
+
+def somar_decimal(valores):
+    return sum((Decimal(valor.replace(",", ".")) for valor in valores), Decimal(0))
+
+def somar_array(valores):
+    return sum(array("q", map(ler_centavos, valores)))
+
+def somar_numpy(valores):
+    return int(np.fromiter(map(ler_centavos, valores), dtype=np.int64, count=len(valores)).sum())
+
+def main():
+    quantidade = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    valores = gerar_valores(quantidade)
+    exato, _ = medir(somar_decimal, valores)
+
+    print(f"{'modelo':<16}{'ms':>10}{'total':>22}{'erro':>14}")
+    for nome, funcao in [("float", somar_float), ("Decimal", somar_decimal),
+                         ("array('q')", somar_array), ("numpy int64", somar_numpy)]:
+        total, tempo = medir(funcao, valores)
+        if isinstance(total, int):
+            total = em_reais(total)
+        erro = Decimal(total) - exato
+        print(f"{nome:<16}{tempo:>10.1f}{total:>22.2f}{erro:>14.2E}")
+
+    # Somas de totais já em centavos (o caso dos resumos): só a agregação, sem a leitura do texto
+    centavos = array("q", map(ler_centavos, valores))
+    reais = [float(valor) / 100 for valor in centavos]
+    decimais = [em_reais(valor) for valor in centavos]
+    vetor = np.frombuffer(centavos, dtype=np.int64)
+    print(f"\n{'agregação':<16}{'ms':>10}")
+    for nome, funcao, argumento in [("sum(float)", sum, reais), ("sum(Decimal)", sum, decimais),
+                                    ("sum(array)", sum, centavos), ("int64.sum()", np.sum, vetor)]:
+        _, tempo = medir(funcao, argumento)
+        print(f"{nome:<16}{tempo:>10.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,50 @@
 import logging
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, ContextTypes, CallbackQueryHandler, MessageHandler, filters
-from datetime import datetime
+from telegram.ext import Application, CommandHandler, ContextTypes, CallbackQueryHandler, MessageHandler, TypeHandler, ApplicationHandlerStop, filters
+from telegram.error import RetryAfter, BadRequest, Forbidden
+from datetime import datetime, date, time as dt_time, timedelta
+from zoneinfo import ZoneInfo
+from typing import NamedTuple, Optional
+import sqlite3
 import psycopg2
-from decouple import config
+import psycopg2.extensions
+import psycopg2.extras
+import psycopg2.pool
+import psycopg2.sql
+from decouple import config, Csv
 import os
+import re
+import sys
+import json
+import gzip
+import tempfile
+import time
+import random
+import inspect
+import calendar
+import unicodedata
 import asyncio
+import threading
+import contextvars
+import functools
+import cProfile
+import pstats
+import tracemalloc
+import numpy as np
+import matplotlib
+matplotlib.use("Agg")
+from matplotlib.figure import Figure
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
 import pandas as pd
-from io import BytesIO
+import tornado.web
+from io import BytesIO, StringIO
+from contextlib import contextmanager
+from html import escape
+from abc import ABC, abstractmethod
+from collections import OrderedDict, Counter, deque
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from array import array
 from openpyxl import Workbook
 from openpyxl.chart import BarChart, Reference
 from openpyxl.chart.label import DataLabelList
@@ -19,363 +56,4199 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Configuração do rastreamento de consultas lentas
+SLOW_QUERY_MS = config("SLOW_QUERY_MS", default=500, cast=int)
+EXPLAIN_SAMPLE_RATE = config("EXPLAIN_SAMPLE_RATE", default=0.1, cast=float)
+EXPLAIN_LOG_PATH = config("EXPLAIN_LOG_PATH", default="explain_plans.jsonl")
+SQL_ESCRITA = re.compile(r"\b(INSERT|UPDATE|DELETE|MERGE|CREATE|ALTER|DROP|TRUNCATE)\b", re.IGNORECASE)
+
+# Nome do handler ou job em execução na tarefa atual; o asyncio.to_thread copia o contexto para a
+# thread, então as consultas feitas fora do laço também são atribuídas a ele
+handler_atual = contextvars.ContextVar("handler_atual", default=None)
+
+# Função para identificar o handler (corrotina) que disparou a consulta
+def identificar_handler():
+    frame = sys._getframe(1)
+    while frame is not None:
+        if frame.f_code.co_flags & inspect.CO_COROUTINE:
+            return frame.f_code.co_name
+        frame = frame.f_back
+    return handler_atual.get() or "desconhecido"
+
+# Função para envolver um handler ou job, registrando o nome dele em handler_atual
+def rastrear_handler(callback):
+    nome = callback.__name__
+
+    @functools.wraps(callback)
+    async def executar(*args):
+        handler_atual.set(nome)
+        return await callback(*args)
+    return executar
+
+# Função para coletar as tabelas lidas com Seq Scan em um plano do EXPLAIN
+def listar_seq_scans(plano):
+    tabelas = []
+    if plano.get("Node Type") == "Seq Scan":
+        tabelas.append(plano.get("Relation Name"))
+    for subplano in plano.get("Plans", []):
+        tabelas.extend(listar_seq_scans(subplano))
+    return tabelas
+
+# Cursor que mede cada cursor.execute e registra as consultas lentas
+class CursorRastreado(psycopg2.extensions.cursor):
+    def execute(self, query, vars=None):
+        inicio = time.perf_counter()
+        resultado = super().execute(query, vars)
+        duracao_ms = (time.perf_counter() - inicio) * 1000
+        if duracao_ms >= SLOW_QUERY_MS:
+            self.registrar_consulta_lenta(query, vars, duracao_ms)
+        return resultado
+
+    def registrar_consulta_lenta(self, query, vars, duracao_ms):
+        try:
+            if isinstance(query, bytes):
+                query = query.decode(self.connection.encoding, "replace")
+            elif not isinstance(query, str):
+                query = query.as_string(self)
+            sql = sql_efetivo(" ".join(query.split()))
+            handler = identificar_handler()
+            # Os valores nunca vão para o log, apenas os tipos dos parâmetros
+            if isinstance(vars, dict):
+                parametros = {chave: type(valor).__name__ for chave, valor in vars.items()}
+            else:
+                parametros = [type(valor).__name__ for valor in (vars or ())]
+            logger.warning(f"Consulta lenta ({duracao_ms:.1f} ms) em {handler}: {sql} | parâmetros={parametros}")
+            if (self.name is None and not SQL_ESCRITA.search(sql)
+                    and random.random() < EXPLAIN_SAMPLE_RATE):
+                self.capturar_explain(query, vars, sql, handler, duracao_ms)
+        except Exception as e:
+            logger.error(f"Erro ao registrar consulta lenta: {e}")
+
+    def capturar_explain(self, query, vars, sql, handler, duracao_ms):
+        # EXPLAIN sem ANALYZE só planeja a consulta, sem executá-la de novo; usa um cursor separado e
+        # um savepoint para não afetar o resultado nem a transação da consulta original
+        with psycopg2.extensions.cursor(self.connection) as cursor:
+            cursor.execute("SAVEPOINT explain_amostra")
+            try:
+                cursor.execute("EXPLAIN (FORMAT JSON) " + query, vars)
+                plano = cursor.fetchone()[0]
+                cursor.execute("RELEASE SAVEPOINT explain_amostra")
+            except Exception:
+                cursor.execute("ROLLBACK TO SAVEPOINT explain_amostra")
+                raise
+        if isinstance(plano, str):
+            plano = json.loads(plano)
+        registro = {
+            "data": datetime.now().isoformat(timespec="seconds"),
+            "handler": handler,
+            "duracao_ms": round(duracao_ms, 1),
+            "sql": sql,
+            "seq_scans": listar_seq_scans(plano[0]["Plan"]),
+            "plano": plano,
+        }
+        with open(EXPLAIN_LOG_PATH, "a", encoding="utf-8") as arquivo:
+            arquivo.write(json.dumps(registro, ensure_ascii=False, default=str) + "\n")
+        if registro["seq_scans"]:
+            logger.warning(f"Seq Scan em {registro['seq_scans']} na consulta de {handler}; plano salvo em {EXPLAIN_LOG_PATH}")
+
+# Conexão que guarda os nomes das consultas já preparadas nela (PREPARE vale para a sessão inteira
+# e não é desfeito por ROLLBACK). Com "preparar" falso as consultas vão como SQL comum (ver POOL_MINIMO)
+class ConexaoPreparada(psycopg2.extensions.connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.preparadas = set()
+        self.devolvida_em = time.monotonic()
+        self.preparar = usar_consultas_preparadas(self.get_dsn_parameters().get("host", ""))
+
+# Resiliência ao PostgreSQL serverless (Neon suspende o banco ocioso e a primeira conexão depois
+# da pausa pode demorar ou falhar): a obtenção de uma conexão é repetida até BANCO_TENTATIVAS
+# vezes, com espera exponencial e jitter (no laço de eventos há uma só tentativa e as demais
+# acordam o banco em uma thread); conexões paradas no pool há mais de BANCO_OCIOSO_SEGUNDOS são
+# testadas antes do uso; e, após DISJUNTOR_FALHAS falhas seguidas, o disjuntor abre e as chamadas
+# falham na hora com BancoIndisponivel por DISJUNTOR_ABERTO_SEGUNDOS, quando uma nova tentativa
+# é liberada
+BANCO_TENTATIVAS = config("BANCO_TENTATIVAS", default=3, cast=int)
+BANCO_ESPERA_BASE_MS = config("BANCO_ESPERA_BASE_MS", default=200, cast=int)
+BANCO_ESPERA_MAXIMA_MS = config("BANCO_ESPERA_MAXIMA_MS", default=1000, cast=int)
+BANCO_TIMEOUT_CONEXAO = config("BANCO_TIMEOUT_CONEXAO", default=5, cast=int)
+BANCO_OCIOSO_SEGUNDOS = config("BANCO_OCIOSO_SEGUNDOS", default=60, cast=float)
+DISJUNTOR_FALHAS = config("DISJUNTOR_FALHAS", default=3, cast=int)
+DISJUNTOR_ABERTO_SEGUNDOS = config("DISJUNTOR_ABERTO_SEGUNDOS", default=20, cast=float)
+MENSAGEM_BANCO_INDISPONIVEL = "⏳ O banco de dados está acordando. Tente novamente em alguns segundos."
+
+# Subclasse de OperationalError: quem já trata erros de conexão do psycopg2 continua tratando
+class BancoIndisponivel(psycopg2.OperationalError):
+    pass
+
+class DisjuntorBanco:
+    def __init__(self):
+        self.falhas = 0
+        self.aberto_ate = 0.0
+
+    @property
+    def aberto(self):
+        return time.monotonic() < self.aberto_ate
+
+    def registrar_sucesso(self):
+        if self.falhas >= DISJUNTOR_FALHAS:
+            logger.info("Banco de dados respondendo de novo; disjuntor fechado")
+        self.falhas = 0
+        self.aberto_ate = 0.0
+
+    # Depois de aberto uma vez, cada falha da tentativa liberada o reabre
+    def registrar_falha(self):
+        self.falhas += 1
+        if self.falhas >= DISJUNTOR_FALHAS:
+            self.aberto_ate = time.monotonic() + DISJUNTOR_ABERTO_SEGUNDOS
+            logger.warning(f"Disjuntor do banco aberto por {DISJUNTOR_ABERTO_SEGUNDOS:.0f} s após {self.falhas} falhas seguidas")
+
+# Se o código está rodando na thread do laço de eventos (um handler ou job assíncrono)
+def em_laco_de_eventos():
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+# Espera antes da tentativa seguinte: exponencial com jitter completo (evita que as chamadas
+# que falharam juntas voltem todas ao mesmo tempo)
+def espera_tentativa(tentativa):
+    return random.uniform(0, min(BANCO_ESPERA_MAXIMA_MS, BANCO_ESPERA_BASE_MS * 2 ** tentativa)) / 1000
+
+# Pool de conexões: cada `with pool.conexao() as conn` é uma transação (commit ao sair, rollback
+# em caso de erro) e devolve a conexão ao pool; conexões quebradas são descartadas.
+# Atrás de um PgBouncer em modo transação (o endpoint "-pooler" do Neon) cada transação pode cair
+# em outra sessão do servidor, e um PREPARE feito em uma não existe nas outras. Por isso
+# PREPARAR_CONSULTAS ("auto", "sim" ou "nao") em "auto" desliga o PREPARE quando o host tem
+# "-pooler" e as consultas de CONSULTAS_PREPARADAS vão como SQL comum; use "nao" com outros
+# poolers em modo transação
+POOL_MINIMO = config("POOL_MINIMO", default=1, cast=int)
+POOL_MAXIMO = config("POOL_MAXIMO", default=10, cast=int)
+PREPARAR_CONSULTAS = config("PREPARAR_CONSULTAS", default="auto")
+
+def usar_consultas_preparadas(host):
+    if PREPARAR_CONSULTAS == "auto":
+        return "-pooler" not in (host or "")
+    return PREPARAR_CONSULTAS == "sim"
+
+class PoolConexoes:
+    def __init__(self, dsn):
+        self.dsn = dsn
+        self.pool = None
+        self.disjuntor = DisjuntorBanco()
+        self.acordando = None
+
+    def abrir(self):
+        if self.pool is None:
+            self.pool = psycopg2.pool.ThreadedConnectionPool(
+                POOL_MINIMO, POOL_MAXIMO, self.dsn, connect_timeout=BANCO_TIMEOUT_CONEXAO,
+                connection_factory=ConexaoPreparada, cursor_factory=CursorRastreado,
+            )
+        # Conexões paradas que não respondem ao teste são descartadas e a próxima do pool é usada;
+        # só a abertura de uma conexão nova conta como tentativa
+        while True:
+            conn = self.pool.getconn()
+            if time.monotonic() - conn.devolvida_em <= BANCO_OCIOSO_SEGUNDOS:
+                return conn
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT 1")
+                conn.rollback()
+                return conn
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                self.pool.putconn(conn, close=True)
+
+    # Os handlers chamam o banco direto do laço de eventos, onde esperar entre tentativas pararia
+    # todos os chats: ali é feita uma tentativa só e, se o banco não responder, as demais seguem
+    # em uma thread (acordar_em_segundo_plano) enquanto o usuário recebe MENSAGEM_BANCO_INDISPONIVEL.
+    # Fora do laço (jobs em executor, asyncio.to_thread) as tentativas esperam normalmente
+    def obter_conexao(self):
+        if self.disjuntor.aberto:
+            raise BancoIndisponivel(MENSAGEM_BANCO_INDISPONIVEL)
+        no_laco = em_laco_de_eventos()
+        tentativas = 1 if no_laco else BANCO_TENTATIVAS
+        for tentativa in range(tentativas):
+            try:
+                conn = self.abrir()
+                self.disjuntor.registrar_sucesso()
+                return conn
+            except psycopg2.pool.PoolError as e:
+                # Pool esgotado por uma rajada acima de POOL_MAXIMO: espera uma conexão ser devolvida,
+                # sem contar como falha do banco no disjuntor
+                if tentativa == tentativas - 1:
+                    raise BancoIndisponivel(MENSAGEM_BANCO_INDISPONIVEL) from e
+                logger.warning(f"Pool de conexões esgotado (tentativa {tentativa + 1}/{tentativas})")
+                time.sleep(espera_tentativa(tentativa))
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                if tentativa == tentativas - 1:
+                    if no_laco:
+                        self.acordar_em_segundo_plano()
+                    else:
+                        self.disjuntor.registrar_falha()
+                    raise BancoIndisponivel(MENSAGEM_BANCO_INDISPONIVEL) from e
+                logger.warning(f"Falha ao conectar ao banco (tentativa {tentativa + 1}/{tentativas}): {e}")
+                time.sleep(espera_tentativa(tentativa))
+
+    # Uma retomada por vez: refaz as tentativas (e alimenta o disjuntor) em uma thread do executor
+    def acordar_em_segundo_plano(self):
+        if self.acordando is not None and not self.acordando.done():
+            return
+        self.acordando = asyncio.get_running_loop().run_in_executor(None, self.acordar)
+
+    def acordar(self):
+        try:
+            self.pingar()
+            logger.info("Banco de dados acordado em segundo plano")
+        except Exception as e:
+            logger.warning(f"Banco de dados ainda indisponível: {e}")
+
+    @contextmanager
+    def conexao(self):
+        conn = self.obter_conexao()
+        try:
+            with conn:
+                yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            # Só a conexão perdida no meio do uso conta como falha e é descartada; um cancelamento
+            # por statement_timeout (QueryCanceled) deixa a conexão e suas consultas preparadas no pool
+            if conn.closed:
+                self.disjuntor.registrar_falha()
+            raise
+        finally:
+            conn.devolvida_em = time.monotonic()
+            self.pool.putconn(conn, close=bool(conn.closed))
+
+    # Ping do aquecimento: também passa pelas tentativas e pelo disjuntor
+    def pingar(self):
+        with self.conexao() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+
 # Configuração de conexão com o Neon (PostgreSQL)
+pool_primario = PoolConexoes(config("DATABASE_URL", default=""))
+
 def conectar():
-    return psycopg2.connect(config("DATABASE_URL"))
+    return pool_primario.conexao()
+
+# Aquecimento: enquanto houver uso nos últimos AQUECIMENTO_JANELA_MINUTOS, um job faz um ping a cada
+# AQUECIMENTO_INTERVALO_SEGUNDOS (abaixo dos 5 minutos de inatividade após os quais o Neon suspende
+# o banco). Sem uso, o banco pode ser suspenso e não gera custo; AQUECIMENTO_JANELA_MINUTOS=0 desliga
+AQUECIMENTO_INTERVALO_SEGUNDOS = config("AQUECIMENTO_INTERVALO_SEGUNDOS", default=240, cast=int)
+AQUECIMENTO_JANELA_MINUTOS = config("AQUECIMENTO_JANELA_MINUTOS", default=30, cast=float)
+
+class PoliticaAquecimento:
+    def __init__(self):
+        self.ultima_atividade = float("-inf")
+
+    def registrar_atividade(self):
+        self.ultima_atividade = time.monotonic()
+
+    def deve_pingar(self):
+        return time.monotonic() - self.ultima_atividade < AQUECIMENTO_JANELA_MINUTOS * 60
+
+aquecimento = PoliticaAquecimento()
+
+# Réplica de leitura opcional: as consultas somente leitura vão para DATABASE_REPLICA_URL, exceto
+# para um chat que escreveu há menos de REPLICA_FIXACAO_SEGUNDOS (lê as próprias escritas no
+# primário) e enquanto o atraso de replicação, medido a cada REPLICA_VERIFICACAO_SEGUNDOS, passar
+# de REPLICA_ATRASO_MAXIMO_SEGUNDOS. Sem réplica configurada, tudo vai para o primário
+DATABASE_REPLICA_URL = config("DATABASE_REPLICA_URL", default="")
+REPLICA_FIXACAO_SEGUNDOS = config("REPLICA_FIXACAO_SEGUNDOS", default=5, cast=float)
+REPLICA_ATRASO_MAXIMO_SEGUNDOS = config("REPLICA_ATRASO_MAXIMO_SEGUNDOS", default=10, cast=float)
+REPLICA_VERIFICACAO_SEGUNDOS = config("REPLICA_VERIFICACAO_SEGUNDOS", default=15, cast=float)
+
+class RoteadorLeitura:
+    def __init__(self, dsn):
+        self.pool = PoolConexoes(dsn) if dsn else None
+        self.escritas = {}
+        self.disponivel = False
+        self.verificado_em = float("-inf")
+
+    def registrar_escrita(self, usuario):
+        self.escritas[usuario] = time.monotonic()
+
+    def fixado_no_primario(self, usuario):
+        instante = self.escritas.get(usuario)
+        if instante is None:
+            return False
+        if time.monotonic() - instante < REPLICA_FIXACAO_SEGUNDOS:
+            return True
+        del self.escritas[usuario]
+        return False
+
+    # Atraso em segundos; zero quando a réplica já aplicou tudo o que recebeu (um primário ocioso
+    # não gera transações novas e não deve parecer atrasado)
+    def medir_atraso(self, conn):
+        with conn.cursor() as cursor:
+            cursor.execute('''
+            SELECT CASE
+                WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+            END
+            ''')
+            atraso = float(cursor.fetchone()[0])
+        conn.rollback()
+        return atraso
+
+    def verificar(self):
+        self.verificado_em = time.monotonic()
+        try:
+            with self.pool.conexao() as conn:
+                atraso = self.medir_atraso(conn)
+        except psycopg2.Error as e:
+            self.disponivel = False
+            logger.warning(f"Réplica indisponível, leituras no primário: {e}")
+            return
+        self.disponivel = atraso <= REPLICA_ATRASO_MAXIMO_SEGUNDOS
+        if not self.disponivel:
+            logger.warning(f"Réplica com {atraso:.1f} s de atraso; leituras no primário")
+
+    def conectar(self, usuario=None):
+        if self.pool is None or (usuario is not None and self.fixado_no_primario(usuario)):
+            return conectar()
+        if time.monotonic() - self.verificado_em >= REPLICA_VERIFICACAO_SEGUNDOS:
+            self.verificar()
+        return self.pool.conexao() if self.disponivel else conectar()
+
+roteador_leitura = RoteadorLeitura(DATABASE_REPLICA_URL)
+
+# Conexão para consultas somente leitura (réplica, quando configurada e em dia)
+def conectar_leitura(usuario=None):
+    return roteador_leitura.conectar(usuario)
+
+# Consultas mais frequentes, preparadas uma vez por conexão do pool e depois executadas pelo nome,
+# sem novo parse e, quando o PostgreSQL adota o plano genérico, sem novo planejamento.
+# nome -> (tipos dos parâmetros, SQL com $n). As edições usam uma única variante com COALESCE
+# (parâmetro nulo mantém a coluna) em vez de montar um UPDATE diferente por combinação de campos
+CONSULTAS_PREPARADAS = {
+    "inserir_gasto": ("text, numeric, text, integer, text, date, text", '''
+        INSERT INTO gastos (usuario, valor, categoria, categoria_id, forma_pagamento, data, chave_idempotencia)
+        VALUES ($1, $2, $3, $4, $5, $6, $7)
+        ON CONFLICT (chave_idempotencia, data) DO NOTHING
+    '''),
+    "inserir_entrada": ("text, numeric, text, date, text", '''
+        INSERT INTO entradas (usuario, valor, descricao, data, chave_idempotencia)
+        VALUES ($1, $2, $3, $4, $5)
+        ON CONFLICT (chave_idempotencia, data) DO NOTHING
+    '''),
+    # Meses já arquivados entram pelos totais guardados nas tabelas de resumo
+    "totais_periodo": ("text, text, date, date", '''
+        SELECT t.intervalo, c.nome, t.total
+        FROM (
+            SELECT date_trunc($2, data)::date AS intervalo, categoria_id, (SUM(valor) * 100)::bigint AS total
+            FROM gastos
+            WHERE usuario = $1 AND data >= $3 AND data < $4
+            GROUP BY 1, 2
+        ) t
+        JOIN categorias c ON c.id = t.categoria_id
+        UNION ALL
+        SELECT date_trunc($2, data)::date, NULL, (SUM(valor) * 100)::bigint
+        FROM entradas
+        WHERE usuario = $1 AND data >= $3 AND data < $4
+        GROUP BY 1
+        UNION ALL
+        SELECT date_trunc($2, mes)::date, categoria, (total * 100)::bigint
+        FROM gastos_arquivados
+        WHERE usuario = $1 AND mes >= $3 AND mes < $4
+        UNION ALL
+        SELECT date_trunc($2, mes)::date, NULL, (total * 100)::bigint
+        FROM entradas_arquivadas
+        WHERE usuario = $1 AND mes >= $3 AND mes < $4
+    '''),
+    "listar_gastos": ("text, date, date", '''
+        SELECT id, valor, categoria, forma_pagamento, data
+        FROM gastos
+        WHERE usuario = $1 AND data >= $2 AND data < $3
+        ORDER BY data DESC
+    '''),
+    "listar_entradas": ("text, date, date", '''
+        SELECT id, valor, descricao, data
+        FROM entradas
+        WHERE usuario = $1 AND data >= $2 AND data < $3
+        ORDER BY data DESC
+    '''),
+    "obter_limite": ("text", "SELECT limite FROM limites WHERE usuario = $1"),
+    "avaliar_limites": ("text, date, date", '''
+        WITH totais AS (
+            SELECT categoria_id, SUM(valor) AS total
+            FROM gastos
+            WHERE usuario = $1 AND data >= $2 AND data < $3
+            GROUP BY 1
+        )
+        SELECT NULL AS categoria, l.limite, COALESCE((SELECT SUM(total) FROM totais), 0) AS total
+        FROM limites l
+        WHERE l.usuario = $1
+        UNION ALL
+        SELECT lc.categoria, lc.limite, COALESCE(t.total, 0) AS total
+        FROM limites_categoria lc
+        LEFT JOIN totais t ON t.categoria_id = lc.categoria_id
+        WHERE lc.usuario = $1
+    '''),
+    # Gasto em uma mensagem: grava o gasto, aprende as palavras, atualiza a previsão e devolve a
+    # avaliação dos limites do mês (já com o gasto novo) em um único comando. Sempre há uma linha;
+    # id nulo indica reentrega e limite nulo, usuário sem limites
+    "registrar_gasto_livre": ("text, numeric, text, integer, text, date, text, date, date, text[]", '''
+        WITH novo AS (
+            INSERT INTO gastos (usuario, valor, categoria, categoria_id, forma_pagamento, data, chave_idempotencia)
+            VALUES ($1, $2, $3, $4, $5, $6, $7)
+            ON CONFLICT (chave_idempotencia, data) DO NOTHING
+            RETURNING id, valor, categoria_id, data
+        ), palavras AS (
+            INSERT INTO palavras_categoria (usuario, palavra, categoria_id, usos)
+            SELECT $1, palavra, novo.categoria_id, 1
+            FROM novo, unnest($10) AS palavra
+            ON CONFLICT (usuario, palavra) DO UPDATE
+            SET usos = CASE WHEN palavras_categoria.categoria_id = EXCLUDED.categoria_id THEN palavras_categoria.usos + 1 ELSE 1 END,
+                categoria_id = EXCLUDED.categoria_id
+        ), previsao AS (
+            UPDATE previsao_mensal p
+            SET gasto_variavel = p.gasto_variavel + novo.valor
+            FROM novo
+            WHERE p.usuario = $1 AND p.ano = extract(year FROM novo.data) AND p.mes = extract(month FROM novo.data)
+        ), totais AS (
+            SELECT categoria_id, SUM(valor) AS total
+            FROM (
+                SELECT categoria_id, valor FROM gastos WHERE usuario = $1 AND data >= $8 AND data < $9
+                UNION ALL
+                SELECT categoria_id, valor FROM novo WHERE data >= $8 AND data < $9
+            ) t
+            GROUP BY 1
+        )
+        SELECT n.id, l.categoria, l.limite, l.total
+        FROM (SELECT (SELECT id FROM novo) AS id) n
+        LEFT JOIN (
+            SELECT NULL AS categoria, limite, COALESCE((SELECT SUM(total) FROM totais), 0) AS total
+            FROM limites
+            WHERE usuario = $1
+            UNION ALL
+            SELECT lc.categoria, lc.limite, COALESCE(t.total, 0)
+            FROM limites_categoria lc
+            LEFT JOIN totais t ON t.categoria_id = lc.categoria_id
+            WHERE lc.usuario = $1
+        ) l ON true
+    '''),
+    "editar_gasto": ("text, integer, numeric, text, integer, text", '''
+        UPDATE gastos
+        SET valor = COALESCE($3, valor), categoria = COALESCE($4, categoria),
+            categoria_id = COALESCE($5, categoria_id), forma_pagamento = COALESCE($6, forma_pagamento),
+            alterado_em = now()
+        WHERE usuario = $1 AND id = $2
+    '''),
+    "editar_entrada": ("text, integer, numeric, text", '''
+        UPDATE entradas
+        SET valor = COALESCE($3, valor), descricao = COALESCE($4, descricao)
+        WHERE usuario = $1 AND id = $2
+    '''),
+}
+
+# Mesmas consultas como SQL comum, para conexões sem PREPARE: $n -> CAST(%s AS tipo) na ordem em
+# que aparecem (o mesmo $n pode se repetir), com os tipos declarados no PREPARE
+def sem_preparar(tipos, sql):
+    tipos = [tipo.strip() for tipo in tipos.split(",")]
+    ordem = [int(n) - 1 for n in re.findall(r"\$(\d+)", sql)]
+    return re.sub(r"\$(\d+)", lambda encontrado: f"CAST(%s AS {tipos[int(encontrado[1]) - 1]})", sql), ordem
+
+CONSULTAS_SEM_PREPARAR = {nome: sem_preparar(*consulta) for nome, consulta in CONSULTAS_PREPARADAS.items()}
+
+# Função para executar uma consulta preparada, preparando-a antes se for a primeira vez nesta conexão
+def executar_preparada(cursor, nome, parametros):
+    conn = cursor.connection
+    if not conn.preparar:
+        sql, ordem = CONSULTAS_SEM_PREPARAR[nome]
+        cursor.execute(sql, [parametros[i] for i in ordem])
+        return
+    if nome not in conn.preparadas:
+        tipos, sql = CONSULTAS_PREPARADAS[nome]
+        cursor.execute(f"PREPARE {nome} ({tipos}) AS {sql}")
+        conn.preparadas.add(nome)
+    cursor.execute(f"EXECUTE {nome} ({', '.join(['%s'] * len(parametros))})", parametros)
+
+# SQL registrado para um EXECUTE de consulta preparada (para o log de consultas lentas)
+EXECUTE_PREPARADA = re.compile(r"^EXECUTE (\w+)")
+
+def sql_efetivo(sql):
+    encontrado = EXECUTE_PREPARADA.match(sql)
+    if encontrado and encontrado[1] in CONSULTAS_PREPARADAS:
+        return " ".join(CONSULTAS_PREPARADAS[encontrado[1]][1].split())
+    return sql
+
+# Tabelas e índices criados pelo próprio bot (idempotente, executado na inicialização)
+SCHEMA_DDL = [
+    '''
+    CREATE TABLE IF NOT EXISTS envios_relatorio_mensal (
+        usuario TEXT NOT NULL,
+        ano INTEGER NOT NULL,
+        mes INTEGER NOT NULL,
+        reservado_em TIMESTAMP NOT NULL DEFAULT now(),
+        enviado_em TIMESTAMP,
+        PRIMARY KEY (ano, mes, usuario)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS limites_categoria (
+        usuario TEXT NOT NULL,
+        categoria TEXT NOT NULL,
+        limite NUMERIC(12, 2) NOT NULL,
+        PRIMARY KEY (usuario, categoria)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS alertas_limite (
+        usuario TEXT NOT NULL,
+        categoria TEXT NOT NULL,
+        ano INTEGER NOT NULL,
+        mes INTEGER NOT NULL,
+        nivel TEXT NOT NULL,
+        enviado_em TIMESTAMP NOT NULL DEFAULT now(),
+        PRIMARY KEY (usuario, categoria, ano, mes, nivel)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS baseline_gastos (
+        usuario TEXT NOT NULL,
+        categoria TEXT NOT NULL,
+        media NUMERIC(12, 2) NOT NULL,
+        desvio NUMERIC(12, 2) NOT NULL,
+        ewma NUMERIC(12, 2) NOT NULL,
+        meses SMALLINT NOT NULL,
+        PRIMARY KEY (usuario, categoria)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS previsao_mensal (
+        usuario TEXT NOT NULL,
+        ano INTEGER NOT NULL,
+        mes INTEGER NOT NULL,
+        gasto_variavel NUMERIC(12, 2) NOT NULL DEFAULT 0,
+        gasto_fixo NUMERIC(12, 2) NOT NULL DEFAULT 0,
+        compromissos JSONB NOT NULL DEFAULT '{}',
+        PRIMARY KEY (usuario, ano, mes)
+    )
+    ''',
+    # Estados da previsão do formato anterior (compromissos com "valor" em reais) são descartados
+    # e reconstruídos, com "centavos", na próxima leitura
+    '''
+    DELETE FROM previsao_mensal WHERE jsonb_path_exists(compromissos, '$.*.valor')
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS perfil_gastos_diario (
+        usuario TEXT PRIMARY KEY,
+        fracao DOUBLE PRECISION[] NOT NULL,
+        meses SMALLINT NOT NULL
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS gastos_arquivados (
+        usuario TEXT NOT NULL,
+        mes DATE NOT NULL,
+        categoria TEXT NOT NULL,
+        total NUMERIC(14, 2) NOT NULL,
+        quantidade INTEGER NOT NULL,
+        PRIMARY KEY (usuario, mes, categoria)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS entradas_arquivadas (
+        usuario TEXT NOT NULL,
+        mes DATE NOT NULL,
+        total NUMERIC(14, 2) NOT NULL,
+        quantidade INTEGER NOT NULL,
+        PRIMARY KEY (usuario, mes)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS particoes_arquivadas (
+        particao TEXT PRIMARY KEY,
+        tabela TEXT NOT NULL,
+        inicio DATE NOT NULL,
+        fim DATE NOT NULL,
+        linhas INTEGER NOT NULL,
+        dados BYTEA NOT NULL,
+        arquivado_em TIMESTAMP NOT NULL DEFAULT now()
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS categorias (
+        id SERIAL PRIMARY KEY,
+        chave TEXT NOT NULL UNIQUE,
+        nome TEXT NOT NULL
+    )
+    ''',
+    "ALTER TABLE gastos ADD COLUMN IF NOT EXISTS categoria_id INTEGER",
+    "ALTER TABLE limites_categoria ADD COLUMN IF NOT EXISTS categoria_id INTEGER",
+    '''
+    CREATE TABLE IF NOT EXISTS updates_processados (
+        update_id BIGINT PRIMARY KEY,
+        recebido_em TIMESTAMP NOT NULL DEFAULT now()
+    )
+    ''',
+    "CREATE INDEX IF NOT EXISTS idx_updates_processados_recebido_em ON updates_processados (recebido_em)",
+    # Painel operacional: contadores diários acumulados pelo bot e os chats já contados no dia
+    '''
+    CREATE TABLE IF NOT EXISTS metricas_diarias (
+        dia DATE NOT NULL,
+        metrica TEXT NOT NULL,
+        valor BIGINT NOT NULL,
+        PRIMARY KEY (dia, metrica)
+    )
+    ''',
+    "CREATE TABLE IF NOT EXISTS usuarios_ativos_diarios (dia DATE NOT NULL, usuario TEXT NOT NULL, PRIMARY KEY (dia, usuario))",
+    # Palavras dos gastos em uma mensagem e a categoria em que o usuário as usou por último
+    '''
+    CREATE TABLE IF NOT EXISTS palavras_categoria (
+        usuario TEXT NOT NULL,
+        palavra TEXT NOT NULL,
+        categoria_id INTEGER NOT NULL,
+        usos INTEGER NOT NULL DEFAULT 1,
+        PRIMARY KEY (usuario, palavra)
+    )
+    ''',
+    # Chave de idempotência das escritas; inclui a data porque, com as tabelas particionadas,
+    # toda restrição de unicidade precisa conter a chave de partição
+    "ALTER TABLE gastos ADD COLUMN IF NOT EXISTS chave_idempotencia TEXT",
+    "ALTER TABLE entradas ADD COLUMN IF NOT EXISTS chave_idempotencia TEXT",
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_gastos_idempotencia ON gastos (chave_idempotencia, data)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_entradas_idempotencia ON entradas (chave_idempotencia, data)",
+    # Marca d'água das alterações de gastos para a carga incremental do esquema de relatórios
+    "ALTER TABLE gastos ADD COLUMN IF NOT EXISTS alterado_em TIMESTAMP NOT NULL DEFAULT now()",
+    "CREATE INDEX IF NOT EXISTS idx_gastos_alterado_em ON gastos (alterado_em)",
+    '''
+    CREATE TABLE IF NOT EXISTS gastos_removidos (
+        usuario TEXT NOT NULL,
+        data DATE NOT NULL,
+        removido_em TIMESTAMP NOT NULL DEFAULT now()
+    )
+    ''',
+    # Esquema estrela lido pelo Power BI: fato agregado por usuário/dia/categoria/forma de pagamento
+    "CREATE SCHEMA IF NOT EXISTS relatorios",
+    '''
+    CREATE TABLE IF NOT EXISTS relatorios.dim_data (
+        data DATE PRIMARY KEY,
+        ano SMALLINT NOT NULL,
+        trimestre SMALLINT NOT NULL,
+        mes SMALLINT NOT NULL,
+        dia SMALLINT NOT NULL,
+        dia_semana SMALLINT NOT NULL,
+        ano_mes TEXT NOT NULL
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS relatorios.dim_categoria (
+        categoria_id INTEGER PRIMARY KEY,
+        nome TEXT NOT NULL
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS relatorios.dim_forma_pagamento (
+        forma_pagamento_id SERIAL PRIMARY KEY,
+        nome TEXT NOT NULL UNIQUE
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS relatorios.fato_gastos (
+        usuario TEXT NOT NULL,
+        data DATE NOT NULL,
+        categoria_id INTEGER NOT NULL,
+        forma_pagamento_id INTEGER NOT NULL,
+        total NUMERIC(14, 2) NOT NULL,
+        quantidade INTEGER NOT NULL,
+        PRIMARY KEY (usuario, data, categoria_id, forma_pagamento_id)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS relatorios.controle_carga (
+        tabela TEXT PRIMARY KEY,
+        marca TIMESTAMP NOT NULL,
+        atualizado_em TIMESTAMP NOT NULL DEFAULT now()
+    )
+    ''',
+    '''
+    CREATE OR REPLACE VIEW relatorios.gastos_bi AS
+    SELECT f.usuario, f.data, d.ano, d.trimestre, d.mes, d.dia_semana, d.ano_mes,
+           c.nome AS categoria, fp.nome AS forma_pagamento, f.total, f.quantidade
+    FROM relatorios.fato_gastos f
+    JOIN relatorios.dim_data d ON d.data = f.data
+    JOIN relatorios.dim_categoria c ON c.categoria_id = f.categoria_id
+    JOIN relatorios.dim_forma_pagamento fp ON fp.forma_pagamento_id = f.forma_pagamento_id
+    ''',
+    "CREATE INDEX IF NOT EXISTS idx_gastos_usuario_data ON gastos (usuario, data)",
+    "CREATE INDEX IF NOT EXISTS idx_entradas_usuario_data ON entradas (usuario, data)",
+]
+
+# Função para criar as tabelas auxiliares do bot
+def inicializar_schema():
+    try:
+        repositorio.inicializar()
+        logger.info("Schema do banco verificado.")
+    except Exception as e:
+        logger.error(f"Erro ao inicializar o schema: {e}")
+        raise
+
+# Função para avançar ou voltar meses
+def deslocar_mes(mes, ano, delta):
+    indice = ano * 12 + (mes - 1) + delta
+    return indice % 12 + 1, indice // 12
+
+# Função para obter o intervalo [início, fim) de um mês, usado nos filtros por data
+def intervalo_mes(mes, ano):
+    mes_seguinte, ano_seguinte = deslocar_mes(mes, ano, 1)
+    return date(ano, mes, 1), date(ano_seguinte, mes_seguinte, 1)
+
+# Dinheiro em centavos inteiros (int): valores digitados, totais dos resumos e as somas do bot não
+# passam por float. O banco guarda NUMERIC(12, 2), que já é ponto fixo, e as consultas de agregação
+# devolvem centavos; Decimal só aparece na gravação (em_reais) e na leitura de linhas (em_centavos)
+VALOR_DIGITADO = re.compile(r"(?:r\$\s*)?(\d{1,3}(?:\.\d{3})+|\d+)(?:[.,](\d{1,2}))?", re.IGNORECASE)
+
+# Função para ler um valor digitado ("100", "32,50", "32.50", "1.500", "R$ 1.500,75") em centavos
+def ler_centavos(texto):
+    encontrado = VALOR_DIGITADO.fullmatch(texto.strip())
+    if encontrado is None:
+        raise ValueError(f"valor inválido: {texto!r}")
+    return int(encontrado[1].replace(".", "")) * 100 + int((encontrado[2] or "0").ljust(2, "0"))
+
+# Centavos de um valor lido do banco (Decimal no PostgreSQL; int ou float no SQLite)
+def em_centavos(valor):
+    return int((Decimal(str(valor)) * 100).to_integral_value(ROUND_HALF_UP))
+
+# Valor exato em reais para gravar no banco
+def em_reais(centavos):
+    return Decimal(centavos).scaleb(-2)
+
+def formatar_reais(centavos):
+    return f"R${em_reais(centavos)}"
+
+# Configuração do particionamento de gastos/entradas por data ("mensal", "anual" ou vazio para
+# desativar). Partições que terminam antes do horizonte de retenção (em meses; 0 desativa) são
+# arquivadas: os totais por mês vão para as tabelas *_arquivados e as linhas, comprimidas, para
+# particoes_arquivadas. O horizonte deve cobrir as tendências e os baselines (12 meses). Os
+# lançamentos arquivados saem da busca, das listagens e do backup (que leva só os totais mensais);
+# a busca e o /backup avisam a data de corte (ver obter_corte_arquivo)
+PARTICIONAMENTO = config("PARTICIONAMENTO", default="")
+PARTICOES_FUTURAS = config("PARTICOES_FUTURAS", default=3, cast=int)
+ARQUIVAMENTO_MESES = config("ARQUIVAMENTO_MESES", default=24, cast=int)
+PARTICOES_HORA = config("PARTICOES_HORA", default=3, cast=int)
+TABELAS_PARTICIONADAS = ["gastos", "entradas"]
+LIMITES_PARTICAO = re.compile(r"FROM \('([\d-]+)'\) TO \('([\d-]+)'\)")
+
+# Função para calcular a partição que contém uma data: (inicio, fim, sufixo do nome)
+def intervalo_particao(data, granularidade):
+    if granularidade == "anual":
+        return date(data.year, 1, 1), date(data.year + 1, 1, 1), f"p{data.year}"
+    inicio, fim = intervalo_mes(data.month, data.year)
+    return inicio, fim, f"p{data.year}_{data.month:02d}"
+
+def tabela_particionada(cursor, tabela):
+    cursor.execute("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(%s)", (tabela,))
+    resultado = cursor.fetchone()
+    return bool(resultado and resultado[0])
+
+# Função para listar as partições de intervalo de uma tabela: [(nome, inicio, fim)]
+def listar_particoes(cursor, tabela):
+    cursor.execute('''
+    SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+    FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = to_regclass(%s)
+    ''', (tabela,))
+    particoes = []
+    for nome, limites in cursor.fetchall():
+        encontrado = LIMITES_PARTICAO.search(limites)
+        if encontrado:
+            particoes.append((nome, date.fromisoformat(encontrado[1]), date.fromisoformat(encontrado[2])))
+    return sorted(particoes, key=lambda particao: particao[1])
+
+# Função para criar a partição de um intervalo, movendo para ela as linhas que tenham caído na
+# partição padrão (que recebe datas sem partição própria, para nenhuma escrita falhar)
+def criar_particao(cursor, tabela, inicio, fim, sufixo):
+    nome = f"{tabela}_{sufixo}"
+    cursor.execute("SELECT to_regclass(%s) IS NOT NULL", (nome,))
+    if cursor.fetchone()[0]:
+        return False
+    identificadores = {
+        "tabela": psycopg2.sql.Identifier(tabela),
+        "particao": psycopg2.sql.Identifier(nome),
+        "padrao": psycopg2.sql.Identifier(f"{tabela}_padrao"),
+    }
+    cursor.execute(psycopg2.sql.SQL("CREATE TABLE {particao} (LIKE {tabela} INCLUDING DEFAULTS)").format(**identificadores))
+    cursor.execute(psycopg2.sql.SQL('''
+    WITH movidas AS (DELETE FROM {padrao} WHERE data >= %s AND data < %s RETURNING *)
+    INSERT INTO {particao} SELECT * FROM movidas
+    ''').format(**identificadores), (inicio, fim))
+    cursor.execute(psycopg2.sql.SQL("ALTER TABLE {tabela} ATTACH PARTITION {particao} FOR VALUES FROM (%s) TO (%s)").format(**identificadores), (inicio, fim))
+    logger.info(f"Partição {nome} criada ({inicio} a {fim}).")
+    return True
+
+# Função para converter uma tabela comum em particionada por data, na mesma transação:
+# renomeia a original, cria a particionada com as partições do histórico e copia as linhas
+def migrar_para_particoes(cursor, tabela, granularidade):
+    identificadores = {
+        "tabela": psycopg2.sql.Identifier(tabela),
+        "legado": psycopg2.sql.Identifier(f"{tabela}_legado"),
+        "padrao": psycopg2.sql.Identifier(f"{tabela}_padrao"),
+        "indice": psycopg2.sql.Identifier(f"idx_{tabela}_usuario_data"),
+        "idempotencia": psycopg2.sql.Identifier(f"idx_{tabela}_idempotencia"),
+        "alterado_em": psycopg2.sql.Identifier(f"idx_{tabela}_alterado_em"),
+    }
+    cursor.execute(psycopg2.sql.SQL("LOCK TABLE {tabela} IN ACCESS EXCLUSIVE MODE").format(**identificadores))
+    cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", (tabela,))
+    sequencia = cursor.fetchone()[0]
+    cursor.execute(psycopg2.sql.SQL("SELECT min(data), max(data) FROM {tabela}").format(**identificadores))
+    primeira, ultima = cursor.fetchone()
+
+    cursor.execute(psycopg2.sql.SQL("ALTER TABLE {tabela} RENAME TO {legado}").format(**identificadores))
+    cursor.execute(psycopg2.sql.SQL('''
+    CREATE TABLE {tabela} (LIKE {legado} INCLUDING DEFAULTS INCLUDING CONSTRAINTS, PRIMARY KEY (id, data))
+    PARTITION BY RANGE (data)
+    ''').format(**identificadores))
+    cursor.execute(psycopg2.sql.SQL("CREATE TABLE {padrao} PARTITION OF {tabela} DEFAULT").format(**identificadores))
+    data = primeira
+    while data is not None and data <= ultima:
+        inicio, fim, sufixo = intervalo_particao(data, granularidade)
+        criar_particao(cursor, tabela, inicio, fim, sufixo)
+        data = fim
+
+    cursor.execute(psycopg2.sql.SQL("INSERT INTO {tabela} SELECT * FROM {legado}").format(**identificadores))
+    if sequencia:
+        # A sequência do id passa para a nova tabela antes de a original ser removida
+        cursor.execute(psycopg2.sql.SQL("ALTER SEQUENCE {} OWNED BY {}.id").format(psycopg2.sql.SQL(sequencia), identificadores["tabela"]))
+    cursor.execute(psycopg2.sql.SQL("DROP TABLE {legado}").format(**identificadores))
+    cursor.execute(psycopg2.sql.SQL("CREATE INDEX {indice} ON {tabela} (usuario, data)").format(**identificadores))
+    cursor.execute(psycopg2.sql.SQL("CREATE UNIQUE INDEX {idempotencia} ON {tabela} (chave_idempotencia, data)").format(**identificadores))
+    if tabela == "gastos":
+        cursor.execute(psycopg2.sql.SQL("CREATE INDEX {alterado_em} ON {tabela} (alterado_em)").format(**identificadores))
+    logger.info(f"Tabela {tabela} convertida para particionamento {granularidade}.")
+
+# Função para arquivar uma partição antiga: totais por usuário/mês(/categoria) nas tabelas
+# de resumo, linhas comprimidas (JSON Lines + gzip) em particoes_arquivadas, e a partição removida
+def arquivar_particao(cursor, tabela, nome, inicio, fim):
+    identificadores = {"tabela": psycopg2.sql.Identifier(tabela), "particao": psycopg2.sql.Identifier(nome)}
+    if tabela == "gastos":
+        cursor.execute(psycopg2.sql.SQL('''
+        INSERT INTO gastos_arquivados (usuario, mes, categoria, total, quantidade)
+        SELECT t.usuario, t.mes, c.nome, t.total, t.quantidade
+        FROM (
+            SELECT usuario, date_trunc('month', data)::date AS mes, categoria_id, SUM(valor) AS total, COUNT(*) AS quantidade
+            FROM {particao}
+            GROUP BY 1, 2, 3
+        ) t
+        JOIN categorias c ON c.id = t.categoria_id
+        ON CONFLICT (usuario, mes, categoria) DO UPDATE
+        SET total = gastos_arquivados.total + EXCLUDED.total, quantidade = gastos_arquivados.quantidade + EXCLUDED.quantidade
+        ''').format(**identificadores))
+    else:
+        cursor.execute(psycopg2.sql.SQL('''
+        INSERT INTO entradas_arquivadas (usuario, mes, total, quantidade)
+        SELECT usuario, date_trunc('month', data)::date, SUM(valor), COUNT(*)
+        FROM {particao}
+        GROUP BY 1, 2
+        ON CONFLICT (usuario, mes) DO UPDATE
+        SET total = entradas_arquivadas.total + EXCLUDED.total, quantidade = entradas_arquivadas.quantidade + EXCLUDED.quantidade
+        ''').format(**identificadores))
+
+    cursor.execute(psycopg2.sql.SQL("SELECT row_to_json(t)::text FROM {particao} t").format(**identificadores))
+    linhas = [linha for linha, in cursor.fetchall()]
+    dados = gzip.compress(("\n".join(linhas) + "\n").encode("utf-8"))
+    cursor.execute('''
+    INSERT INTO particoes_arquivadas (particao, tabela, inicio, fim, linhas, dados)
+    VALUES (%s, %s, %s, %s, %s, %s)
+    ''', (nome, tabela, inicio, fim, len(linhas), psycopg2.Binary(dados)))
+    cursor.execute(psycopg2.sql.SQL("ALTER TABLE {tabela} DETACH PARTITION {particao}").format(**identificadores))
+    cursor.execute(psycopg2.sql.SQL("DROP TABLE {particao}").format(**identificadores))
+    logger.info(f"Partição {nome} arquivada ({len(linhas)} linhas, {len(dados)} bytes comprimidos).")
+
+# Função de manutenção das partições: migra as tabelas na primeira execução, cria as partições
+# dos próximos PARTICOES_FUTURAS intervalos e arquiva as que passaram do horizonte de retenção
+def manter_particoes(hoje=None):
+    if not PARTICIONAMENTO:
+        return
+    hoje = hoje or date.today()
+    try:
+        with conectar() as conn:
+            with conn.cursor() as cursor:
+                for tabela in TABELAS_PARTICIONADAS:
+                    if not tabela_particionada(cursor, tabela):
+                        migrar_para_particoes(cursor, tabela, PARTICIONAMENTO)
+                    data = hoje
+                    for _ in range(PARTICOES_FUTURAS + 1):
+                        inicio, fim, sufixo = intervalo_particao(data, PARTICIONAMENTO)
+                        criar_particao(cursor, tabela, inicio, fim, sufixo)
+                        data = fim
+                    conn.commit()
+
+                    if ARQUIVAMENTO_MESES > 0:
+                        mes_limite, ano_limite = deslocar_mes(hoje.month, hoje.year, -ARQUIVAMENTO_MESES)
+                        horizonte = date(ano_limite, mes_limite, 1)
+                        for nome, inicio, fim in listar_particoes(cursor, tabela):
+                            if fim <= horizonte:
+                                arquivar_particao(cursor, tabela, nome, inicio, fim)
+                                conn.commit()
+    except Exception as e:
+        logger.error(f"Erro na manutenção das partições: {e}")
+        raise
+
+# Período de consulta [inicio, fim) usado pelo resumo e pela planilha.
+# tipo: "mes", "trimestre", "ano", "ano_ate_hoje" ou "personalizado"
+class Periodo(NamedTuple):
+    inicio: date
+    fim: date
+    tipo: str
+
+def deslocar_data(data, meses):
+    mes, ano = deslocar_mes(data.month, data.year, meses)
+    return date(ano, mes, min(data.day, calendar.monthrange(ano, mes)[1]))
+
+def periodo_mes(mes, ano):
+    return Periodo(*intervalo_mes(mes, ano), "mes")
+
+def periodo_trimestre(mes, ano):
+    inicio = date(ano, (mes - 1) // 3 * 3 + 1, 1)
+    return Periodo(inicio, deslocar_data(inicio, 3), "trimestre")
+
+def periodo_ano(ano):
+    return Periodo(date(ano, 1, 1), date(ano + 1, 1, 1), "ano")
+
+def periodo_ano_ate_hoje(hoje):
+    return Periodo(date(hoje.year, 1, 1), hoje + timedelta(days=1), "ano_ate_hoje")
+
+def periodo_personalizado(inicio, fim_inclusivo):
+    return Periodo(inicio, fim_inclusivo + timedelta(days=1), "personalizado")
+
+# Meses avançados por "Anterior"/"Próximo" em cada tipo de período
+PASSO_PERIODO = {"mes": 1, "trimestre": 3, "ano": 12, "ano_ate_hoje": 12}
+
+# Função para deslocar um período para o anterior/próximo do mesmo tamanho
+def deslocar_periodo(periodo, delta):
+    passo = PASSO_PERIODO.get(periodo.tipo)
+    if passo is None:
+        duracao = periodo.fim - periodo.inicio
+        return Periodo(periodo.inicio + duracao * delta, periodo.fim + duracao * delta, periodo.tipo)
+    return Periodo(deslocar_data(periodo.inicio, passo * delta), deslocar_data(periodo.fim, passo * delta), periodo.tipo)
+
+# Função para descrever um período (ex.: "10/2024", "3º trimestre de 2024")
+def rotulo_periodo(periodo):
+    ultimo_dia = periodo.fim - timedelta(days=1)
+    if periodo.tipo == "mes":
+        return f"{periodo.inicio.month:02d}/{periodo.inicio.year}"
+    if periodo.tipo == "trimestre":
+        return f"{(periodo.inicio.month - 1) // 3 + 1}º trimestre de {periodo.inicio.year}"
+    if periodo.tipo == "ano":
+        return str(periodo.inicio.year)
+    if periodo.tipo == "ano_ate_hoje":
+        return f"{periodo.inicio.year} (até {ultimo_dia:%d/%m})"
+    return f"{periodo.inicio:%d/%m/%Y} a {ultimo_dia:%d/%m/%Y}"
+
+# Função para interpretar um período digitado: "2024", "10/2024", "T3 2024" ou "01/02/2024 15/03/2024";
+# None se o texto não for um período válido (inclusive anos fora do calendário, como "0000")
+def interpretar_periodo(texto, hoje):
+    texto = texto.strip().upper()
+    try:
+        if re.fullmatch(r"\d{4}", texto):
+            return periodo_ano(int(texto))
+        if texto == "ANO":
+            return periodo_ano_ate_hoje(hoje)
+        encontrado = re.fullmatch(r"(\d{1,2})/(\d{4})", texto)
+        if encontrado and 1 <= int(encontrado[1]) <= 12:
+            return periodo_mes(int(encontrado[1]), int(encontrado[2]))
+        encontrado = re.fullmatch(r"T([1-4])\s*/?\s*(\d{4})", texto)
+        if encontrado:
+            return periodo_trimestre(int(encontrado[1]) * 3, int(encontrado[2]))
+        datas = texto.split()
+        if len(datas) == 2:
+            inicio, fim = (datetime.strptime(d, "%d/%m/%Y").date() for d in datas)
+            if inicio <= fim:
+                return periodo_personalizado(inicio, fim)
+    except ValueError:
+        return None
+    return None
+
+# Granularidade da evolução mostrada no resumo de um período
+# (o resumo de um único mês não mostra evolução, e sim a recomendação)
+def granularidade_periodo(periodo):
+    if periodo.tipo == "mes" or (periodo.fim - periodo.inicio).days > 62:
+        return "month"
+    return "week"
+
+# Versão dos dados de cada usuário: muda a cada escrita e faz parte da chave dos caches
+versoes_dados = {}
+
+def versao_dados(usuario):
+    return versoes_dados.get(usuario, 0)
+
+def marcar_alteracao(usuario):
+    versoes_dados[usuario] = versao_dados(usuario) + 1
+    roteador_leitura.registrar_escrita(usuario)
+
+# Cache em memória com expiração e limite de itens (descarta os menos usados)
+class CacheTTL:
+    def __init__(self, ttl, max_itens=1000):
+        self.ttl = ttl
+        self.max_itens = max_itens
+        self.itens = OrderedDict()
+
+    def obter(self, chave):
+        item = self.itens.get(chave)
+        if item is None:
+            return None
+        expira_em, valor = item
+        if expira_em < time.monotonic():
+            del self.itens[chave]
+            return None
+        self.itens.move_to_end(chave)
+        return valor
+
+    def guardar(self, chave, valor):
+        self.itens[chave] = (time.monotonic() + self.ttl, valor)
+        self.itens.move_to_end(chave)
+        while len(self.itens) > self.max_itens:
+            self.itens.popitem(last=False)
+
+    def descartar(self, chave):
+        self.itens.pop(chave, None)
+
+# Estado da previsão de fim de mês: totais do mês e compromissos fixos, atualizados a cada gasto
+SQL_GASTO_FIXO = r"categoria ~ '\((DI[AÁ]RIO|SEMANAL|MENSAL)\)'"
+
+def atualizar_estado_previsao(cursor, usuario, valor, categoria, data):
+    data = date.fromisoformat(str(data)[:10])
+    periodicidade = SUFIXO_GASTO_FIXO.search(categoria)
+    compromisso = {}
+    if periodicidade:
+        compromisso[categoria] = {
+            "periodicidade": periodicidade.group(1).replace("DIARIO", "DIÁRIO"),
+            "centavos": em_centavos(valor),
+            "neste_mes": True,
+        }
+    # Só atualiza um estado já existente; se não houver, ele é reconstruído na próxima leitura
+    cursor.execute('''
+    UPDATE previsao_mensal
+    SET gasto_variavel = gasto_variavel + %s,
+        gasto_fixo = gasto_fixo + %s,
+        compromissos = compromissos || %s::jsonb
+    WHERE usuario = %s AND ano = %s AND mes = %s
+    ''', (0 if periodicidade else valor, valor if periodicidade else 0, json.dumps(compromisso),
+          usuario, data.year, data.month))
+
+def descartar_estado_previsao(cursor, usuario):
+    cursor.execute("DELETE FROM previsao_mensal WHERE usuario = %s", (usuario,))
+
+# Camada de armazenamento: as funções de dados abaixo delegam a um repositório, escolhido por
+# BANCO_DADOS: "postgres" (padrão, Neon) ou "sqlite" (arquivo local em modo WAL, para instâncias
+# pequenas em um único nó e para rodar o bot sem rede)
+BANCO_DADOS = config("BANCO_DADOS", default="postgres")
+SQLITE_CAMINHO = config("SQLITE_CAMINHO", default="smartmoney.db")
+
+# Dicionário de categorias: cada gasto e limite aponta para um id da tabela categorias, cuja
+# chave é o nome sem o sufixo do gasto fixo, sem acentos, em minúsculas e com os espaços
+# normalizados ("Lazer", "lazer " e "Lazer (MENSAL)" são a mesma categoria)
+SUFIXO_CHAVE_CATEGORIA = re.compile(r"\s*\((DI[AÁ]RIO|SEMANAL|MENSAL)\)")
+
+def chave_categoria(categoria):
+    return normalizar_texto(SUFIXO_CHAVE_CATEGORIA.sub("", categoria))
+
+# Texto sem acentos, em minúsculas e com os espaços normalizados
+def normalizar_texto(texto):
+    sem_acentos = unicodedata.normalize("NFKD", texto)
+    return " ".join("".join(c for c in sem_acentos if not unicodedata.combining(c)).casefold().split())
+
+# Nome exibido da categoria: o primeiro nome usado para a chave, sem o sufixo e com inicial maiúscula
+def nome_categoria(categoria):
+    nome = " ".join(SUFIXO_CHAVE_CATEGORIA.sub("", categoria).split())
+    return nome[:1].upper() + nome[1:]
+
+# Função para migrar gastos e limites gravados antes do dicionário: a normalização é feita no
+# Python (sem depender do unaccent) e os ids são atribuídos em lote, na mesma transação
+def migrar_categorias(cursor):
+    # A grafia mais usada de cada categoria vem primeiro e dá o nome exibido
+    cursor.execute('''
+    SELECT categoria
+    FROM (
+        SELECT categoria, COUNT(*) AS usos FROM gastos WHERE categoria_id IS NULL GROUP BY 1
+        UNION ALL
+        SELECT categoria, 0 FROM limites_categoria WHERE categoria_id IS NULL
+    ) t
+    GROUP BY categoria
+    ORDER BY SUM(usos) DESC, categoria
+    ''')
+    pendentes = [linha[0] for linha in cursor.fetchall()]
+    if not pendentes:
+        return
+    parametros = {
+        "categorias": pendentes,
+        "chaves": [chave_categoria(categoria) for categoria in pendentes],
+        "nomes": [nome_categoria(categoria) for categoria in pendentes],
+    }
+    cursor.execute('''
+    INSERT INTO categorias (chave, nome)
+    SELECT chave, nome FROM unnest(%(chaves)s::text[], %(nomes)s::text[]) WITH ORDINALITY AS m(chave, nome, ordem)
+    ORDER BY ordem
+    ON CONFLICT (chave) DO NOTHING
+    ''', parametros)
+    for tabela in ["gastos", "limites_categoria"]:
+        cursor.execute(psycopg2.sql.SQL('''
+        UPDATE {tabela} AS t
+        SET categoria_id = c.id
+        FROM unnest(%(categorias)s::text[], %(chaves)s::text[]) AS m(categoria, chave)
+        JOIN categorias c ON c.chave = m.chave
+        WHERE t.categoria = m.categoria AND t.categoria_id IS NULL
+        ''').format(tabela=psycopg2.sql.Identifier(tabela)), parametros)
+    logger.info(f"{len(pendentes)} categorias migradas para o dicionário de categorias.")
+
+# Configuração da busca (/buscar): semelhança mínima entre o termo e a categoria/descrição
+BUSCA_LIMIAR = config("BUSCA_LIMIAR", default=0.4, cast=float)
+BUSCA_POR_PAGINA = config("BUSCA_POR_PAGINA", default=5, cast=int)
+
+# Filtros opcionais da busca; valores em centavos e fim exclusivo, como nos períodos
+class FiltrosBusca(NamedTuple):
+    valor_min: Optional[int] = None
+    valor_max: Optional[int] = None
+    inicio: Optional[date] = None
+    fim: Optional[date] = None
+
+# Trigramas no formato do pg_trgm (palavras em minúsculas com dois espaços antes e um depois)
+def trigramas(texto):
+    conjunto = set()
+    for palavra in re.findall(r"\w+", (texto or "").lower()):
+        palavra = f"  {palavra} "
+        conjunto.update(palavra[i:i + 3] for i in range(len(palavra) - 2))
+    return conjunto
+
+# Semelhança usada quando o pg_trgm não está disponível: fração dos trigramas do termo presentes
+# no texto (próxima ao word_similarity do PostgreSQL)
+def similaridade_texto(termo, texto):
+    alvo = trigramas(termo)
+    if not alvo:
+        return 0.0
+    return len(alvo & trigramas(texto)) / len(alvo)
+
+def padrao_like(termo):
+    return "%" + re.sub(r"([%_\\])", r"\\\1", termo) + "%"
+
+# Filtros da busca aplicados sobre a união de gastos e entradas (mesmo SQL nos dois backends,
+# mudando só o marcador de parâmetro)
+SQL_FILTROS_BUSCA = '''
+    ({valor_min} IS NULL OR round(valor * 100) >= {valor_min}) AND ({valor_max} IS NULL OR round(valor * 100) <= {valor_max})
+    AND ({inicio} IS NULL OR data >= {inicio}) AND ({fim} IS NULL OR data < {fim})
+'''
+
+def sql_filtros_busca(marcador):
+    return SQL_FILTROS_BUSCA.format(**{campo: marcador.format(campo) for campo in FiltrosBusca._fields})
+
+# Interface dos repositórios. "analises" indica se o backend tem os recursos que dependem do
+# PostgreSQL (tendências, baselines, previsão, relatório mensal em lote e partições)
+class Repositorio(ABC):
+    analises = False
+
+    @abstractmethod
+    def inicializar(self):
+        raise NotImplementedError
+
+    # As escritas recebem uma chave de idempotência opcional e retornam False quando a chave
+    # já foi gravada (reentrega do mesmo update), sem inserir de novo
+    @abstractmethod
+    def salvar_gasto(self, usuario, valor, categoria, forma_pagamento, data, chave_idempotencia=None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def salvar_entrada(self, usuario, valor, descricao, data, chave_idempotencia=None):
+        raise NotImplementedError
+
+    # Gasto em uma mensagem: grava o gasto e as palavras que levaram à categoria e devolve
+    # (id do gasto ou None na reentrega, linhas de avaliar_limites do período [inicio, fim))
+    @abstractmethod
+    def salvar_gasto_livre(self, usuario, valor, categoria, forma_pagamento, data, chave_idempotencia, palavras, inicio, fim):
+        raise NotImplementedError
+
+    # ({palavra: nome da categoria}, [(forma de pagamento, quantidade de gastos)]) do usuário
+    @abstractmethod
+    def carregar_modelo_gastos(self, usuario):
+        raise NotImplementedError
+
+    # Pares (tipo, linha) com todos os dados do usuário, lidos aos poucos, nas colunas de COLUNAS_BACKUP
+    @abstractmethod
+    def exportar_conta(self, usuario):
+        raise NotImplementedError
+
+    # Carrega os pares (tipo, linha) de um backup em uma única transação, sem duplicar o que já
+    # existe; devolve {tipo: registros inseridos}
+    @abstractmethod
+    def restaurar_conta(self, usuario, registros):
+        raise NotImplementedError
+
+    # Registra um update_id processado; False se ele já estava registrado
+    @abstractmethod
+    def registrar_update(self, update_id):
+        raise NotImplementedError
+
+    # Remove os update_ids registrados há mais de `horas` horas
+    @abstractmethod
+    def podar_updates(self, horas):
+        raise NotImplementedError
+
+    # Soma os incrementos {(dia, metrica): quantidade} aos contadores diários; os chats de
+    # {dia: {usuario}} ainda não contados naquele dia somam em "usuarios_ativos"
+    @abstractmethod
+    def registrar_metricas(self, incrementos, usuarios):
+        raise NotImplementedError
+
+    # Linhas (dia, metrica, valor) a partir de `inicio`
+    @abstractmethod
+    def obter_metricas(self, inicio):
+        raise NotImplementedError
+
+    # (id, nome) da categoria no dicionário, criando-a na primeira vez que aparece. Os ids só
+    # entram no cache em memória depois de gravados, então nunca apontam para uma linha desfeita
+    def internar_categoria(self, categoria):
+        chave = chave_categoria(categoria)
+        if chave not in self.categorias:
+            self.categorias[chave] = self.gravar_categoria(chave, nome_categoria(categoria))
+        return self.categorias[chave]
+
+    @abstractmethod
+    def gravar_categoria(self, chave, nome):
+        raise NotImplementedError
+
+    # Linhas (nome da categoria, quantidade de gastos) do usuário
+    @abstractmethod
+    def contar_categorias(self, usuario):
+        raise NotImplementedError
+
+    # Linhas (inicio_intervalo, categoria, total em centavos), com categoria None para as entradas
+    @abstractmethod
+    def obter_totais_periodo(self, usuario, inicio, fim, granularidade):
+        raise NotImplementedError
+
+    @abstractmethod
+    def listar_gastos_periodo(self, usuario, inicio, fim):
+        raise NotImplementedError
+
+    @abstractmethod
+    def listar_entradas_periodo(self, usuario, inicio, fim):
+        raise NotImplementedError
+
+    @abstractmethod
+    def editar_gasto(self, usuario, gasto_id, campos):
+        raise NotImplementedError
+
+    @abstractmethod
+    def editar_entrada(self, usuario, entrada_id, campos):
+        raise NotImplementedError
+
+    @abstractmethod
+    def remover_gasto(self, usuario, gasto_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def remover_entrada(self, usuario, entrada_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def obter_limite(self, usuario):
+        raise NotImplementedError
+
+    @abstractmethod
+    def definir_limite(self, usuario, limite):
+        raise NotImplementedError
+
+    @abstractmethod
+    def definir_limite_categoria(self, usuario, categoria, limite):
+        raise NotImplementedError
+
+    # Linhas (categoria, limite, total), com categoria None para o limite geral
+    @abstractmethod
+    def avaliar_limites(self, usuario, inicio, fim):
+        raise NotImplementedError
+
+    # Linhas (tipo, id, valor, texto, forma_pagamento, data) ordenadas por relevância, com tipo
+    # "gasto" (texto = categoria) ou "entrada" (texto = descrição)
+    @abstractmethod
+    def buscar(self, usuario, termo, filtros, limite, deslocamento):
+        raise NotImplementedError
+
+    # Primeiro dia depois do último mês arquivado do usuário (antes dele só há totais mensais), ou
+    # None; só o PostgreSQL arquiva partições
+    def obter_corte_arquivo(self, usuario):
+        return None
+
+class RepositorioPostgres(Repositorio):
+    analises = True
+
+    def __init__(self):
+        self.trigramas = False
+        self.categorias = {}
+
+    def inicializar(self):
+        with conectar() as conn:
+            with conn.cursor() as cursor:
+                for ddl in SCHEMA_DDL:
+                    cursor.execute(ddl)
+                migrar_categorias(cursor)
+                # Índices de trigramas para a busca; sem o pg_trgm a busca ranqueia no Python
+                cursor.execute("SAVEPOINT trigramas")
+                try:
+                    cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+                    cursor.execute("CREATE INDEX IF NOT EXISTS idx_gastos_categoria_trgm ON gastos USING gin (categoria gin_trgm_ops)")
+                    cursor.execute("CREATE INDEX IF NOT EXISTS idx_entradas_descricao_trgm ON entradas USING gin (descricao gin_trgm_ops)")
+                    cursor.execute("RELEASE SAVEPOINT trigramas")
+                    self.trigramas = True
+                except psycopg2.Error as e:
+                    cursor.execute("ROLLBACK TO SAVEPOINT trigramas")
+                    logger.warning(f"pg_trgm indisponível, a busca usará o ranqueamento no Python: {e}")
+                conn.commit()
+
+    def salvar_gasto(self, usuario, valor, categoria, forma_pagamento, data, chave_idempotencia=None):
+        categoria_id, _ = self.internar_categoria(categoria)
+        with conectar() as conn:
+            with conn.cursor() as cursor:
+                executar_preparada(cursor, "inserir_gasto", (usuario, valor, categoria, categoria_id, forma_pagamento, data, chave_idempotencia))
+                inserido = cursor.rowcount == 1
+                if inserido:
+                    atualizar_estado_previsao(cursor, usuario, valor, categoria, data)
+                conn.commit()
+                return inserido
+
+    def salvar_entrada(self, usuario, valor, descricao, data, chave_idempotencia=None):
+        with conectar() as conn:
+            with conn.cursor() as cursor:
+                executar_preparada(cursor, "inserir_entrada", (usuario, valor, descricao, data, chave_idempotencia))
+                conn.commit()
+                return cursor.rowcount == 1
+
+    def salvar_gasto_livre(self, usuario, valor, categoria, forma_pagamento, data, chave_idempotencia, palavras, inicio, fim):
+        categoria_id, _ = self.internar_categoria(categoria)
+        with conectar() as conn:
+            with conn.cursor() as cursor:
+                executar_preparada(cursor, "registrar_gasto_livre", (
+                    usuario, valor, categoria, categoria_id, forma_pagamento, data, chave_idempotencia, inicio, fim, list(palavras)
+                ))
+                linhas = cursor.fetchall()
+                conn.commit()
+                return linhas[0][0], [linha[1:] for linha in linhas if linha[2] is not None]
+
+    def carregar_modelo_gastos(self, usuario):
+        with conectar_leitura(usuario) as conn:
+            with conn.cursor() as cursor:
+                cursor.execute('''
+                SELECT p.palavra, c.nome
+                FROM palavras_categoria p
+                JOIN categorias c ON c.id = p.categoria_id
+                WHERE p.usuario = %s
+                ''', (usuario,))
+                palavras = dict(cursor.fetchall())
+                cursor.execute("SELECT forma_pagamento, COUNT(*) FROM gastos WHERE usuario = %s GROUP BY 1", (usuario,))
+                return palavras, cursor.fetchall()
+
+    CONSULTAS_BACKUP = [
+        ("gasto", "SELECT id, valor, categoria, forma_pagamento, data FROM gastos WHERE usuario = %s ORDER BY data, id"),
+        ("entrada", "SELECT id, valor, descricao, data FROM entradas WHERE usuario = %s ORDER BY data, id"),
+        ("limite", "SELECT limite FROM limites WHERE usuario = %s"),
+        ("limite_categoria", "SELECT categoria, limite FROM limites_categoria WHERE usuario = %s ORDER BY categoria"),
+        ("gasto_arquivado", "SELECT mes, categoria, total, quantidade FROM gastos_arquivados WHERE usuario = %s ORDER BY mes, categoria"),
+        ("entrada_arquivada", "SELECT mes, total, quantidade FROM entradas_arquivadas WHERE usuario = %s ORDER BY mes"),
+    ]
+
+    # Cursores no servidor: as linhas chegam em lotes de BACKUP_LOTE, sem carregar a conta inteira
+    def exportar_conta(self, usuario):
+        with conectar_leitura(usuario) as conn:
+            for tipo, sql in self.CONSULTAS_BACKUP:
+                with conn.cursor(name=f"backup_{tipo}") as cursor:
+                    cursor.itersize = BACKUP_LOTE
+                    cursor.execute(sql, (usuario,))
+                    for linha in cursor:
+                        yield tipo, linha
+
+    # Gastos e entradas passam por tabelas temporárias; limites e meses arquivados vão direto
+    # (a chave primária já impede duplicatas)
+    INSERCOES_RESTAURACAO = {
+        "gasto": "INSERT INTO restauracao_gastos (usuario, id_original, valor, categoria, forma_pagamento, data, categoria_id) VALUES %s ON CONFLICT DO NOTHING",
+        "entrada": "INSERT INTO restauracao_entradas (usuario, id_original, valor, descricao, data) VALUES %s ON CONFLICT DO NOTHING",
+        "limite": "INSERT INTO limites (usuario, limite) VALUES %s ON CONFLICT DO NOTHING",
+        "limite_categoria": "INSERT INTO limites_categoria (usuario, categoria, limite, categoria_id) VALUES %s ON CONFLICT DO NOTHING",
+        "gasto_arquivado": "INSERT INTO gastos_arquivados (usuario, mes, categoria, total, quantidade) VALUES %s ON CONFLICT DO NOTHING",
+        "entrada_arquivada": "INSERT INTO entradas_arquivadas (usuario, mes, total, quantidade) VALUES %s ON CONFLICT DO NOTHING",
+    }
+
+    def restaurar_conta(self, usuario, registros):
+        inseridos = Counter()
+        lotes = {tipo: [] for tipo in self.INSERCOES_RESTAURACAO}
+        with conectar() as conn:
+            with conn.cursor() as cursor:
+                def gravar(tipo):
+                    psycopg2.extras.execute_values(cursor, self.INSERCOES_RESTAURACAO[tipo], lotes[tipo], page_size=len(lotes[tipo]))
+                    if tipo not in ("gasto", "entrada"):
+                        inseridos[tipo] += cursor.rowcount
+                    lotes[tipo].clear()
+
+                cursor.execute('''
+                CREATE TEMP TABLE restauracao_gastos (
+                    usuario TEXT, id_original BIGINT PRIMARY KEY, valor NUMERIC(12, 2), categoria TEXT,
+                    forma_pagamento TEXT, data DATE, categoria_id INTEGER
+                ) ON COMMIT DROP
+                ''')
+                cursor.execute('''
+                CREATE TEMP TABLE restauracao_entradas (
+                    usuario TEXT, id_original BIGINT PRIMARY KEY, valor NUMERIC(12, 2), descricao TEXT, data DATE
+                ) ON COMMIT DROP
+                ''')
+                for tipo, linha in registros:
+                    if tipo == "gasto":
+                        linha = (*linha, self.internar_categoria(linha[2])[0])
+                    elif tipo == "limite_categoria":
+                        linha = (*linha, self.internar_categoria(linha[0])[0])
+                    lotes[tipo].append((usuario, *linha))
+                    if len(lotes[tipo]) >= BACKUP_LOTE:
+                        gravar(tipo)
+                for tipo in lotes:
+                    if lotes[tipo]:
+                        gravar(tipo)
+
+                # Deduplicação por multiconjunto: a n-ésima linha do backup com o mesmo conteúdo só
+                # entra se a conta tiver menos de n iguais (dois cafés iguais no mesmo dia continuam
+                # dois). Os ids do arquivo não são reaproveitados: as linhas novas recebem ids da
+                # sequência do destino, na ordem original
+                cursor.execute('''
+                INSERT INTO gastos (usuario, valor, categoria, categoria_id, forma_pagamento, data)
+                SELECT r.usuario, r.valor, r.categoria, r.categoria_id, r.forma_pagamento, r.data
+                FROM (
+                    SELECT *, row_number() OVER (PARTITION BY valor, categoria, forma_pagamento, data ORDER BY id_original) AS ordem
+                    FROM restauracao_gastos
+                ) r
+                WHERE r.ordem > (
+                    SELECT COUNT(*) FROM gastos g
+                    WHERE g.usuario = r.usuario AND g.data = r.data AND g.valor = r.valor
+                      AND g.categoria = r.categoria AND g.forma_pagamento IS NOT DISTINCT FROM r.forma_pagamento
+                )
+                ORDER BY r.id_original
+                ''')
+                inseridos["gasto"] = cursor.rowcount
+                cursor.execute('''
+                INSERT INTO entradas (usuario, valor, descricao, data)
+                SELECT r.usuario, r.valor, r.descricao, r.data
+                FROM (
+                    SELECT *, row_number() OVER (PARTITION BY valor, descricao, data ORDER BY id_original) AS ordem
+                    FROM restauracao_entradas
+                ) r
+                WHERE r.ordem > (
+                    SELECT COUNT(*) FROM entradas e
+                    WHERE e.usuario = r.usuario AND e.data = r.data AND e.valor = r.valor
+                      AND e.descricao IS NOT DISTINCT FROM r.descricao
+                )
+                ORDER BY r.id_original
+                ''')
+                inseridos["entrada"] = cursor.rowcount
+                if inseridos["gasto"]:
+                    descartar_estado_previsao(cursor, usuario)
+                conn.commit()
+        return inseridos
+
+    def registrar_update(self, update_id):
+        with conectar() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    "INSERT INTO updates_processados (update_id) VALUES (%s) ON CONFLICT (update_id) DO NOTHING",
+                    (update_id,),
+                )
+                conn.commit()
+                return cursor.rowcount == 1
+
+    def podar_updates(self, horas):
+        with conectar() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("DELETE FROM updates_processados WHERE recebido_em < now() - make_interval(hours => %s)", (horas,))
+                conn.commit()
+                return cursor.rowcount
+
+    def registrar_metricas(self, incrementos, usuarios):
+        incrementos = Counter(incrementos)
+        with conectar() as conn:
+            with conn.cursor() as cursor:
+                for dia, chats in usuarios.items():
+                    cursor.execute('''
+                    WITH novos AS (
+                        INSERT INTO usuarios_ativos_diarios (dia, usuario)
+                        SELECT %s, unnest(%s::text[])
+                        ON CONFLICT DO NOTHING
+                        RETURNING 1
+                    )
+                    SELECT count(*) FROM novos
+                    ''', (dia, list(chats)))
+                    incrementos[(dia, "usuarios_ativos")] += cursor.fetchone()[0]
+                psycopg2.extras.execute_values(cursor, '''
+                INSERT INTO metricas_diarias (dia, metrica, valor) VALUES %s
+                ON CONFLICT (dia, metrica) DO UPDATE SET valor = metricas_diarias.valor + EXCLUDED.valor
+                ''', [(dia, metrica, valor) for (dia, metrica), valor in incrementos.items() if valor])
+                # Só o dia corrente (e o anterior, na virada) ainda recebe chats
+                if usuarios:
+                    cursor.execute("DELETE FROM usuarios_ativos_diarios WHERE dia < %s", (min(usuarios) - timedelta(days=1),))
+                conn.commit()
+
+    def obter_metricas(self, inicio):
+        with conectar() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT dia, metrica, valor FROM metricas_diarias WHERE dia >= %s ORDER BY dia", (inicio,))
+                return cursor.fetchall()
+
+    def gravar_categoria(self, chave, nome):
+        with conectar() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute('''
+                INSERT INTO categorias (chave, nome)
+                VALUES (%s, %s)
+                ON CONFLICT (chave)
+                DO UPDATE SET chave = EXCLUDED.chave
+                RETURNING id, nome
+                ''', (chave, nome))
+                categoria = cursor.fetchone()
+                conn.commit()
+                return categoria
+
+    def contar_categorias(self, usuario):
+        with conectar_leitura(usuario) as conn:
+            with conn.cursor() as cursor:
+                cursor.execute('''
+                SELECT c.nome, t.quantidade
+                FROM (
+                    SELECT categoria_id, COUNT(*) AS quantidade
+                    FROM gastos
+                    WHERE usuario = %s
+                    GROUP BY 1
+                ) t
+                JOIN categorias c ON c.id = t.categoria_id
+                ''', (usuario,))
+                return cursor.fetchall()
+
+    def obter_totais_periodo(self, usuario, inicio, fim, granularidade):
+        with conectar_leitura(usuario) as conn:
+            with conn.cursor() as cursor:
+                executar_preparada(cursor, "totais_periodo", (usuario, granularidade, inicio, fim))
+                return cursor.fetchall()
+
+    def listar_gastos_periodo(self, usuario, inicio, fim):
+        with conectar_leitura(usuario) as conn:
+            with conn.cursor() as cursor:
+                executar_preparada(cursor, "listar_gastos", (usuario, inicio, fim))
+                return cursor.fetchall()
+
+    def listar_entradas_periodo(self, usuario, inicio, fim):
+        with conectar_leitura(usuario) as conn:
+            with conn.cursor() as cursor:
+                executar_preparada(cursor, "listar_entradas", (usuario, inicio, fim))
+                return cursor.fetchall()
+
+    def editar_gasto(self, usuario, gasto_id, campos):
+        categoria = campos.get("categoria")
+        categoria_id = self.internar_categoria(categoria)[0] if categoria is not None else None
+        with conectar() as conn:
+            with conn.cursor() as cursor:
+                executar_preparada(cursor, "editar_gasto", (
+                    usuario, gasto_id, campos.get("valor"), categoria, categoria_id, campos.get("forma_pagamento")
+                ))
+                descartar_estado_previsao(cursor, usuario)
+                conn.commit()
+
+    def editar_entrada(self, usuario, entrada_id, campos):
+        with conectar() as conn:
+            with conn.cursor() as cursor:
+                executar_preparada(cursor, "editar_entrada", (usuario, entrada_id, campos.get("valor"), campos.get("descricao")))
+                conn.commit()
+
+    # O dia do gasto removido fica registrado para a carga incremental dos relatórios
+    def remover_gasto(self, usuario, gasto_id):
+        with conectar() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute('''
+                WITH removido AS (
+                    DELETE FROM gastos
+                    WHERE usuario = %s AND id = %s
+                    RETURNING usuario, data
+                )
+                INSERT INTO gastos_removidos (usuario, data)
+                SELECT usuario, data FROM removido
+                ''', (usuario, gasto_id))
+                descartar_estado_previsao(cursor, usuario)
+                conn.commit()
+
+    def remover_entrada(self, usuario, entrada_id):
+        with conectar() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute('''
+                DELETE FROM entradas
+                WHERE usuario = %s AND id = %s
+                ''', (usuario, entrada_id))
+                conn.commit()
+
+    def obter_limite(self, usuario):
+        with conectar_leitura(usuario) as conn:
+            with conn.cursor() as cursor:
+                executar_preparada(cursor, "obter_limite", (usuario,))
+                resultado = cursor.fetchone()
+                return resultado[0] if resultado else None
+
+    def definir_limite(self, usuario, limite):
+        with conectar() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute('''
+                INSERT INTO limites (usuario, limite)
+                VALUES (%s, %s)
+                ON CONFLICT (usuario)
+                DO UPDATE SET limite = EXCLUDED.limite
+                ''', (usuario, limite))
+                conn.commit()
+
+    def definir_limite_categoria(self, usuario, categoria, limite):
+        categoria_id, _ = self.internar_categoria(categoria)
+        with conectar() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute('''
+                INSERT INTO limites_categoria (usuario, categoria, categoria_id, limite)
+                VALUES (%s, %s, %s, %s)
+                ON CONFLICT (usuario, categoria)
+                DO UPDATE SET limite = EXCLUDED.limite, categoria_id = EXCLUDED.categoria_id
+                ''', (usuario, categoria, categoria_id, limite))
+                conn.commit()
+
+    def avaliar_limites(self, usuario, inicio, fim):
+        with conectar_leitura(usuario) as conn:
+            with conn.cursor() as cursor:
+                executar_preparada(cursor, "avaliar_limites", (usuario, inicio, fim))
+                return cursor.fetchall()
+
+    def obter_corte_arquivo(self, usuario):
+        with conectar_leitura(usuario) as conn:
+            with conn.cursor() as cursor:
+                cursor.execute('''
+                SELECT GREATEST(
+                    (SELECT max(mes) FROM gastos_arquivados WHERE usuario = %s),
+                    (SELECT max(mes) FROM entradas_arquivadas WHERE usuario = %s)
+                )
+                ''', (usuario, usuario))
+                mes = cursor.fetchone()[0]
+                return deslocar_data(mes, 1) if mes else None
+
+    def buscar(self, usuario, termo, filtros, limite, deslocamento):
+        parametros = {"usuario": usuario, "termo": termo, "padrao": padrao_like(termo), "limiar": BUSCA_LIMIAR,
+                      "limite": limite, "deslocamento": deslocamento, **filtros._asdict()}
+        filtros_sql = sql_filtros_busca("%({})s")
+        with conectar_leitura(usuario) as conn:
+            with conn.cursor() as cursor:
+                if self.trigramas:
+                    # <% usa o índice GIN com o limiar da sessão; ILIKE cobre trechos curtos do termo
+                    cursor.execute("SELECT set_config('pg_trgm.word_similarity_threshold', %s, true)", (str(BUSCA_LIMIAR),))
+                    cursor.execute(f'''
+                    SELECT tipo, id, valor, texto, forma_pagamento, data
+                    FROM (
+                        SELECT 'gasto' AS tipo, id, valor, categoria AS texto, forma_pagamento, data,
+                               word_similarity(%(termo)s, categoria) AS relevancia
+                        FROM gastos
+                        WHERE usuario = %(usuario)s AND (%(termo)s <%% categoria OR categoria ILIKE %(padrao)s)
+                        UNION ALL
+                        SELECT 'entrada', id, valor, descricao, NULL, data, word_similarity(%(termo)s, descricao)
+                        FROM entradas
+                        WHERE usuario = %(usuario)s AND (%(termo)s <%% descricao OR descricao ILIKE %(padrao)s)
+                    ) resultados
+                    WHERE {filtros_sql}
+                    ORDER BY relevancia DESC, data DESC, id DESC
+                    LIMIT %(limite)s OFFSET %(deslocamento)s
+                    ''', parametros)
+                    return cursor.fetchall()
+
+                # Sem pg_trgm: ranqueia no Python os textos distintos do usuário e pagina no banco
+                cursor.execute('''
+                SELECT categoria FROM gastos WHERE usuario = %(usuario)s
+                UNION
+                SELECT descricao FROM entradas WHERE usuario = %(usuario)s AND descricao IS NOT NULL
+                ''', parametros)
+                relevancias = {}
+                for texto, in cursor.fetchall():
+                    relevancia = similaridade_texto(termo, texto)
+                    if relevancia >= BUSCA_LIMIAR or termo.lower() in texto.lower():
+                        relevancias[texto] = relevancia
+                if not relevancias:
+                    return []
+                cursor.execute(f'''
+                SELECT tipo, id, valor, texto, forma_pagamento, data
+                FROM (
+                    SELECT 'gasto' AS tipo, id, valor, categoria AS texto, forma_pagamento, data
+                    FROM gastos
+                    WHERE usuario = %(usuario)s AND categoria = ANY(%(textos)s)
+                    UNION ALL
+                    SELECT 'entrada', id, valor, descricao, NULL, data
+                    FROM entradas
+                    WHERE usuario = %(usuario)s AND descricao = ANY(%(textos)s)
+                ) resultados
+                JOIN unnest(%(textos)s::text[], %(relevancias)s::float8[]) AS r(texto, relevancia) USING (texto)
+                WHERE {filtros_sql}
+                ORDER BY r.relevancia DESC, data DESC, id DESC
+                LIMIT %(limite)s OFFSET %(deslocamento)s
+                ''', {**parametros, "textos": list(relevancias), "relevancias": list(relevancias.values())})
+                return cursor.fetchall()
+
+# Funções registradas no SQLite para as expressões que não existem nele
+def date_trunc_sqlite(granularidade, data):
+    data = date.fromisoformat(str(data)[:10])
+    if granularidade == "week":
+        return (data - timedelta(days=data.weekday())).isoformat()
+    if granularidade == "year":
+        return date(data.year, 1, 1).isoformat()
+    return date(data.year, data.month, 1).isoformat()
+
+sqlite3.register_adapter(date, date.isoformat)
+# Valores em reais (em_reais) chegam como Decimal; o texto é convertido pela afinidade NUMERIC da coluna
+sqlite3.register_adapter(Decimal, str)
+sqlite3.register_converter("DATE", lambda valor: date.fromisoformat(valor.decode()[:10]))
+
+class RepositorioSQLite(Repositorio):
+    SCHEMA = [
+        '''
+        CREATE TABLE IF NOT EXISTS gastos (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            usuario TEXT NOT NULL,
+            valor NUMERIC(12, 2) NOT NULL,
+            categoria TEXT NOT NULL,
+            forma_pagamento TEXT,
+            data DATE NOT NULL,
+            categoria_id INTEGER,
+            chave_idempotencia TEXT
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS entradas (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            usuario TEXT NOT NULL,
+            valor NUMERIC(12, 2) NOT NULL,
+            descricao TEXT,
+            data DATE NOT NULL,
+            chave_idempotencia TEXT
+        )
+        ''',
+        "CREATE TABLE IF NOT EXISTS limites (usuario TEXT PRIMARY KEY, limite NUMERIC(12, 2) NOT NULL)",
+        '''
+        CREATE TABLE IF NOT EXISTS limites_categoria (
+            usuario TEXT NOT NULL,
+            categoria TEXT NOT NULL,
+            limite NUMERIC(12, 2) NOT NULL,
+            categoria_id INTEGER,
+            PRIMARY KEY (usuario, categoria)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS categorias (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chave TEXT NOT NULL UNIQUE,
+            nome TEXT NOT NULL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS updates_processados (
+            update_id INTEGER PRIMARY KEY,
+            recebido_em TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS metricas_diarias (
+            dia DATE NOT NULL,
+            metrica TEXT NOT NULL,
+            valor INTEGER NOT NULL,
+            PRIMARY KEY (dia, metrica)
+        )
+        ''',
+        "CREATE TABLE IF NOT EXISTS usuarios_ativos_diarios (dia DATE NOT NULL, usuario TEXT NOT NULL, PRIMARY KEY (dia, usuario))",
+        '''
+        CREATE TABLE IF NOT EXISTS palavras_categoria (
+            usuario TEXT NOT NULL,
+            palavra TEXT NOT NULL,
+            categoria_id INTEGER NOT NULL,
+            usos INTEGER NOT NULL DEFAULT 1,
+            PRIMARY KEY (usuario, palavra)
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_gastos_usuario_data ON gastos (usuario, data)",
+        "CREATE INDEX IF NOT EXISTS idx_entradas_usuario_data ON entradas (usuario, data)",
+    ]
+
+    COLUNAS_ADICIONADAS = [
+        ("gastos", "categoria_id", "INTEGER"),
+        ("limites_categoria", "categoria_id", "INTEGER"),
+        ("gastos", "chave_idempotencia", "TEXT"),
+        ("entradas", "chave_idempotencia", "TEXT"),
+    ]
+
+    COLUNAS_MONETARIAS = [("gastos", "valor"), ("entradas", "valor"), ("limites", "limite"), ("limites_categoria", "limite")]
+
+    def __init__(self, caminho):
+        self.caminho = caminho
+        self.local = threading.local()
+        self.categorias = {}
+
+    # Uma conexão por thread: além do laço de eventos, o repositório é usado pelos jobs em
+    # asyncio.to_thread e pelo executor, e uma conexão compartilhada misturaria os comandos de
+    # transações diferentes. No modo WAL as leituras seguem em paralelo com a escrita
+    def conexao(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.caminho, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=5000")
+            conn.create_function("date_trunc", 2, date_trunc_sqlite, deterministic=True)
+            conn.create_function("chave_categoria", 1, chave_categoria, deterministic=True)
+            conn.create_function("nome_categoria", 1, nome_categoria, deterministic=True)
+            conn.create_function("similaridade", 2, similaridade_texto, deterministic=True)
+            self.local.conn = conn
+        return conn
+
+    def executar(self, sql, parametros=()):
+        conn = self.conexao()
+        with conn:
+            return conn.execute(sql, parametros)
+
+    def inicializar(self):
+        conn = self.conexao()
+        with conn:
+            for ddl in self.SCHEMA:
+                conn.execute(ddl)
+            # Bancos criados por versões anteriores recebem as colunas novas; as categorias
+            # existentes são normalizadas pelas funções registradas na conexão
+            for tabela, coluna, tipo in self.COLUNAS_ADICIONADAS:
+                if coluna not in {linha[1] for linha in conn.execute(f"PRAGMA table_info({tabela})")}:
+                    conn.execute(f"ALTER TABLE {tabela} ADD COLUMN {coluna} {tipo}")
+            for tabela in ["gastos", "entradas"]:
+                conn.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS idx_{tabela}_idempotencia ON {tabela} (chave_idempotencia, data)")
+            # O SQLite não arredonda NUMERIC(12, 2): valores gravados de um float() antigo podem ter
+            # frações de centavo, que passam a ser arredondadas para centavos inteiros
+            for tabela, coluna in self.COLUNAS_MONETARIAS:
+                conn.execute(f"UPDATE {tabela} SET {coluna} = round({coluna}, 2) WHERE {coluna} <> round({coluna}, 2)")
+            conn.execute('''
+            INSERT OR IGNORE INTO categorias (chave, nome)
+            SELECT chave_categoria(categoria), nome_categoria(categoria)
+            FROM (
+                SELECT categoria, COUNT(*) AS usos FROM gastos WHERE categoria_id IS NULL GROUP BY 1
+                UNION ALL
+                SELECT categoria, 0 FROM limites_categoria WHERE categoria_id IS NULL
+            )
+            GROUP BY categoria
+            ORDER BY SUM(usos) DESC, categoria
+            ''')
+            for tabela in ["gastos", "limites_categoria"]:
+                conn.execute(f'''
+                UPDATE {tabela}
+                SET categoria_id = (SELECT id FROM categorias WHERE chave = chave_categoria({tabela}.categoria))
+                WHERE categoria_id IS NULL
+                ''')
+
+    def gravar_categoria(self, chave, nome):
+        self.executar("INSERT OR IGNORE INTO categorias (chave, nome) VALUES (?, ?)", (chave, nome))
+        return self.executar("SELECT id, nome FROM categorias WHERE chave = ?", (chave,)).fetchone()
+
+    def contar_categorias(self, usuario):
+        return self.executar('''
+        SELECT c.nome, t.quantidade
+        FROM (SELECT categoria_id, COUNT(*) AS quantidade FROM gastos WHERE usuario = ? GROUP BY 1) t
+        JOIN categorias c ON c.id = t.categoria_id
+        ''', (usuario,)).fetchall()
+
+    def salvar_gasto(self, usuario, valor, categoria, forma_pagamento, data, chave_idempotencia=None):
+        categoria_id, _ = self.internar_categoria(categoria)
+        return self.executar('''
+        INSERT INTO gastos (usuario, valor, categoria, categoria_id, forma_pagamento, data, chave_idempotencia)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (chave_idempotencia, data) DO NOTHING
+        ''', (usuario, valor, categoria, categoria_id, forma_pagamento, data, chave_idempotencia)).rowcount == 1
+
+    def salvar_entrada(self, usuario, valor, descricao, data, chave_idempotencia=None):
+        return self.executar('''
+        INSERT INTO entradas (usuario, valor, descricao, data, chave_idempotencia)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (chave_idempotencia, data) DO NOTHING
+        ''', (usuario, valor, descricao, data, chave_idempotencia)).rowcount == 1
+
+    # Sem rede, os comandos separados na mesma transação não custam idas e voltas
+    def salvar_gasto_livre(self, usuario, valor, categoria, forma_pagamento, data, chave_idempotencia, palavras, inicio, fim):
+        categoria_id, _ = self.internar_categoria(categoria)
+        conn = self.conexao()
+        with conn:
+            cursor = conn.execute('''
+            INSERT INTO gastos (usuario, valor, categoria, categoria_id, forma_pagamento, data, chave_idempotencia)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (chave_idempotencia, data) DO NOTHING
+            ''', (usuario, valor, categoria, categoria_id, forma_pagamento, data, chave_idempotencia))
+            gasto_id = cursor.lastrowid if cursor.rowcount == 1 else None
+            if gasto_id is not None:
+                conn.executemany('''
+                INSERT INTO palavras_categoria (usuario, palavra, categoria_id, usos) VALUES (?, ?, ?, 1)
+                ON CONFLICT (usuario, palavra) DO UPDATE
+                SET usos = CASE WHEN categoria_id = excluded.categoria_id THEN usos + 1 ELSE 1 END,
+                    categoria_id = excluded.categoria_id
+                ''', [(usuario, palavra, categoria_id) for palavra in palavras])
+        return gasto_id, self.avaliar_limites(usuario, inicio, fim)
+
+    def carregar_modelo_gastos(self, usuario):
+        palavras = dict(self.executar('''
+        SELECT p.palavra, c.nome
+        FROM palavras_categoria p
+        JOIN categorias c ON c.id = p.categoria_id
+        WHERE p.usuario = ?
+        ''', (usuario,)).fetchall())
+        return palavras, self.executar("SELECT forma_pagamento, COUNT(*) FROM gastos WHERE usuario = ? GROUP BY 1", (usuario,)).fetchall()
+
+    CONSULTAS_BACKUP = [
+        ("gasto", "SELECT id, valor, categoria, forma_pagamento, data FROM gastos WHERE usuario = ? ORDER BY data, id"),
+        ("entrada", "SELECT id, valor, descricao, data FROM entradas WHERE usuario = ? ORDER BY data, id"),
+        ("limite", "SELECT limite FROM limites WHERE usuario = ?"),
+        ("limite_categoria", "SELECT categoria, limite FROM limites_categoria WHERE usuario = ? ORDER BY categoria"),
+    ]
+
+    # O cursor do sqlite3 já lê as linhas sob demanda
+    def exportar_conta(self, usuario):
+        conn = self.conexao()
+        for tipo, sql in self.CONSULTAS_BACKUP:
+            for linha in conn.execute(sql, (usuario,)):
+                yield tipo, linha
+
+    # Meses arquivados só existem no PostgreSQL e são ignorados aqui
+    INSERCOES_RESTAURACAO = {
+        "gasto": "INSERT OR IGNORE INTO temp.restauracao_gastos (usuario, id_original, valor, categoria, forma_pagamento, data) VALUES (?, ?, ?, ?, ?, ?)",
+        "entrada": "INSERT OR IGNORE INTO temp.restauracao_entradas (usuario, id_original, valor, descricao, data) VALUES (?, ?, ?, ?, ?)",
+        "limite": "INSERT OR IGNORE INTO limites (usuario, limite) VALUES (?, ?)",
+        "limite_categoria": "INSERT OR IGNORE INTO limites_categoria (usuario, categoria, limite) VALUES (?, ?, ?)",
+    }
+
+    # Mesma deduplicação do PostgreSQL; as categorias novas são internadas em SQL no fim, como em
+    # inicializar, porque internar_categoria faria commit no meio da transação
+    def restaurar_conta(self, usuario, registros):
+        inseridos = Counter()
+        conn = self.conexao()
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS restauracao_gastos (usuario TEXT, id_original INTEGER PRIMARY KEY, valor NUMERIC, categoria TEXT, forma_pagamento TEXT, data DATE)")
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS restauracao_entradas (usuario TEXT, id_original INTEGER PRIMARY KEY, valor NUMERIC, descricao TEXT, data DATE)")
+        try:
+            with conn:
+                for tipo, linha in registros:
+                    if tipo in self.INSERCOES_RESTAURACAO:
+                        inseridos[tipo] += conn.execute(self.INSERCOES_RESTAURACAO[tipo], (usuario, *linha)).rowcount
+                inseridos["gasto"] = conn.execute('''
+                INSERT INTO gastos (usuario, valor, categoria, forma_pagamento, data)
+                SELECT r.usuario, r.valor, r.categoria, r.forma_pagamento, r.data
+                FROM (
+                    SELECT *, row_number() OVER (PARTITION BY valor, categoria, forma_pagamento, data ORDER BY id_original) AS ordem
+                    FROM temp.restauracao_gastos
+                ) r
+                WHERE r.ordem > (
+                    SELECT COUNT(*) FROM gastos g
+                    WHERE g.usuario = r.usuario AND g.data = r.data AND g.valor = r.valor
+                      AND g.categoria = r.categoria AND g.forma_pagamento IS r.forma_pagamento
+                )
+                ORDER BY r.id_original
+                ''').rowcount
+                inseridos["entrada"] = conn.execute('''
+                INSERT INTO entradas (usuario, valor, descricao, data)
+                SELECT r.usuario, r.valor, r.descricao, r.data
+                FROM (
+                    SELECT *, row_number() OVER (PARTITION BY valor, descricao, data ORDER BY id_original) AS ordem
+                    FROM temp.restauracao_entradas
+                ) r
+                WHERE r.ordem > (
+                    SELECT COUNT(*) FROM entradas e
+                    WHERE e.usuario = r.usuario AND e.data = r.data AND e.valor = r.valor AND e.descricao IS r.descricao
+                )
+                ORDER BY r.id_original
+                ''').rowcount
+                conn.execute('''
+                INSERT OR IGNORE INTO categorias (chave, nome)
+                SELECT chave_categoria(categoria), nome_categoria(categoria)
+                FROM (
+                    SELECT categoria FROM gastos WHERE usuario = ? AND categoria_id IS NULL
+                    UNION
+                    SELECT categoria FROM limites_categoria WHERE usuario = ? AND categoria_id IS NULL
+                )
+                ''', (usuario, usuario))
+                for tabela in ["gastos", "limites_categoria"]:
+                    conn.execute(f'''
+                    UPDATE {tabela}
+                    SET categoria_id = (SELECT id FROM categorias WHERE chave = chave_categoria({tabela}.categoria))
+                    WHERE usuario = ? AND categoria_id IS NULL
+                    ''', (usuario,))
+        finally:
+            conn.execute("DELETE FROM temp.restauracao_gastos")
+            conn.execute("DELETE FROM temp.restauracao_entradas")
+            conn.commit()
+        return inseridos
+
+    def registrar_update(self, update_id):
+        return self.executar("INSERT OR IGNORE INTO updates_processados (update_id) VALUES (?)", (update_id,)).rowcount == 1
+
+    def podar_updates(self, horas):
+        return self.executar("DELETE FROM updates_processados WHERE recebido_em < datetime('now', ?)", (f"-{horas} hours",)).rowcount
+
+    def registrar_metricas(self, incrementos, usuarios):
+        incrementos = Counter(incrementos)
+        conn = self.conexao()
+        with conn:
+            for dia, chats in usuarios.items():
+                novos = conn.executemany(
+                    "INSERT OR IGNORE INTO usuarios_ativos_diarios (dia, usuario) VALUES (?, ?)", [(dia, chat) for chat in chats]
+                ).rowcount
+                incrementos[(dia, "usuarios_ativos")] += novos
+            conn.executemany('''
+            INSERT INTO metricas_diarias (dia, metrica, valor) VALUES (?, ?, ?)
+            ON CONFLICT (dia, metrica) DO UPDATE SET valor = valor + excluded.valor
+            ''', [(dia, metrica, valor) for (dia, metrica), valor in incrementos.items() if valor])
+            if usuarios:
+                conn.execute("DELETE FROM usuarios_ativos_diarios WHERE dia < ?", (min(usuarios) - timedelta(days=1),))
+
+    def obter_metricas(self, inicio):
+        return self.executar("SELECT dia, metrica, valor FROM metricas_diarias WHERE dia >= ? ORDER BY dia", (inicio,)).fetchall()
+
+    def obter_totais_periodo(self, usuario, inicio, fim, granularidade):
+        linhas = self.executar('''
+        SELECT t.intervalo, c.nome, t.total
+        FROM (
+            SELECT date_trunc(:granularidade, data) AS intervalo, categoria_id, SUM(CAST(round(valor * 100) AS INTEGER)) AS total
+            FROM gastos
+            WHERE usuario = :usuario AND data >= :inicio AND data < :fim
+            GROUP BY 1, 2
+        ) t
+        JOIN categorias c ON c.id = t.categoria_id
+        UNION ALL
+        SELECT date_trunc(:granularidade, data), NULL, SUM(CAST(round(valor * 100) AS INTEGER))
+        FROM entradas
+        WHERE usuario = :usuario AND data >= :inicio AND data < :fim
+        GROUP BY 1
+        ''', {"granularidade": granularidade, "usuario": usuario, "inicio": inicio, "fim": fim}).fetchall()
+        return [(date.fromisoformat(intervalo), categoria, total) for intervalo, categoria, total in linhas]
+
+    def listar_gastos_periodo(self, usuario, inicio, fim):
+        return self.executar('''
+        SELECT id, valor, categoria, forma_pagamento, data
+        FROM gastos
+        WHERE usuario = ? AND data >= ? AND data < ?
+        ORDER BY data DESC
+        ''', (usuario, inicio, fim)).fetchall()
+
+    def listar_entradas_periodo(self, usuario, inicio, fim):
+        return self.executar('''
+        SELECT id, valor, descricao, data
+        FROM entradas
+        WHERE usuario = ? AND data >= ? AND data < ?
+        ORDER BY data DESC
+        ''', (usuario, inicio, fim)).fetchall()
+
+    # SQL fixo nas edições: o sqlite3 guarda as instruções compiladas por texto na própria conexão
+    def editar_gasto(self, usuario, gasto_id, campos):
+        categoria = campos.get("categoria")
+        self.executar('''
+        UPDATE gastos
+        SET valor = COALESCE(?, valor), categoria = COALESCE(?, categoria),
+            categoria_id = COALESCE(?, categoria_id), forma_pagamento = COALESCE(?, forma_pagamento)
+        WHERE usuario = ? AND id = ?
+        ''', (campos.get("valor"), categoria, self.internar_categoria(categoria)[0] if categoria is not None else None,
+              campos.get("forma_pagamento"), usuario, gasto_id))
+
+    def editar_entrada(self, usuario, entrada_id, campos):
+        self.executar('''
+        UPDATE entradas
+        SET valor = COALESCE(?, valor), descricao = COALESCE(?, descricao)
+        WHERE usuario = ? AND id = ?
+        ''', (campos.get("valor"), campos.get("descricao"), usuario, entrada_id))
+
+    def remover_gasto(self, usuario, gasto_id):
+        self.executar("DELETE FROM gastos WHERE usuario = ? AND id = ?", (usuario, gasto_id))
+
+    def remover_entrada(self, usuario, entrada_id):
+        self.executar("DELETE FROM entradas WHERE usuario = ? AND id = ?", (usuario, entrada_id))
+
+    def obter_limite(self, usuario):
+        resultado = self.executar("SELECT limite FROM limites WHERE usuario = ?", (usuario,)).fetchone()
+        return resultado[0] if resultado else None
+
+    def definir_limite(self, usuario, limite):
+        self.executar('''
+        INSERT INTO limites (usuario, limite)
+        VALUES (?, ?)
+        ON CONFLICT (usuario)
+        DO UPDATE SET limite = excluded.limite
+        ''', (usuario, limite))
+
+    def definir_limite_categoria(self, usuario, categoria, limite):
+        categoria_id, _ = self.internar_categoria(categoria)
+        self.executar('''
+        INSERT INTO limites_categoria (usuario, categoria, categoria_id, limite)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (usuario, categoria)
+        DO UPDATE SET limite = excluded.limite, categoria_id = excluded.categoria_id
+        ''', (usuario, categoria, categoria_id, limite))
+
+    def avaliar_limites(self, usuario, inicio, fim):
+        return self.executar('''
+        WITH totais AS (
+            SELECT categoria_id, SUM(valor) AS total
+            FROM gastos
+            WHERE usuario = :usuario AND data >= :inicio AND data < :fim
+            GROUP BY 1
+        )
+        SELECT NULL AS categoria, l.limite, COALESCE((SELECT SUM(total) FROM totais), 0) AS total
+        FROM limites l
+        WHERE l.usuario = :usuario
+        UNION ALL
+        SELECT lc.categoria, lc.limite, COALESCE(t.total, 0) AS total
+        FROM limites_categoria lc
+        LEFT JOIN totais t ON t.categoria_id = lc.categoria_id
+        WHERE lc.usuario = :usuario
+        ''', {"usuario": usuario, "inicio": inicio, "fim": fim}).fetchall()
+
+    def buscar(self, usuario, termo, filtros, limite, deslocamento):
+        return self.executar(f'''
+        SELECT tipo, id, valor, texto, forma_pagamento, data
+        FROM (
+            SELECT 'gasto' AS tipo, id, valor, categoria AS texto, forma_pagamento, data
+            FROM gastos
+            WHERE usuario = :usuario
+            UNION ALL
+            SELECT 'entrada', id, valor, descricao, NULL, data
+            FROM entradas
+            WHERE usuario = :usuario
+        )
+        WHERE (similaridade(:termo, texto) >= :limiar OR texto LIKE :padrao ESCAPE '\\') AND {sql_filtros_busca(":{}")}
+        ORDER BY similaridade(:termo, texto) DESC, data DESC, id DESC
+        LIMIT :limite OFFSET :deslocamento
+        ''', {"usuario": usuario, "termo": termo, "padrao": padrao_like(termo), "limiar": BUSCA_LIMIAR,
+              "limite": limite, "deslocamento": deslocamento, **filtros._asdict()}).fetchall()
+
+REPOSITORIOS = {
+    "postgres": RepositorioPostgres,
+    "sqlite": lambda: RepositorioSQLite(SQLITE_CAMINHO),
+}
+repositorio = REPOSITORIOS[BANCO_DADOS]()
+
+# Categorias mais usadas por usuário, em memória: o contador é carregado do banco na primeira vez
+# que o teclado de categorias é montado e depois atualizado a cada gasto salvo, sem consultas.
+# Edições e remoções descartam o contador, que é recarregado no próximo teclado
+CATEGORIAS_TECLADO = config("CATEGORIAS_TECLADO", default=6, cast=int)
+categorias_frequentes = CacheTTL(ttl=86400, max_itens=5000)
+
+# Função para obter o contador de uso das categorias do usuário: {nome: quantidade de gastos}
+def obter_categorias_frequentes(usuario):
+    contador = categorias_frequentes.obter(usuario)
+    if contador is not None:
+        return contador
+    try:
+        contador = Counter(dict(repositorio.contar_categorias(usuario)))
+        categorias_frequentes.guardar(usuario, contador)
+        return contador
+    except Exception as e:
+        logger.error(f"Erro ao obter categorias frequentes: {e}")
+        raise
+
+# Função para salvar um gasto (False se a chave de idempotência já tinha sido gravada)
+def salvar_gasto(usuario, valor, categoria, forma_pagamento, data, chave_idempotencia=None):
+    try:
+        if not repositorio.salvar_gasto(usuario, valor, categoria, forma_pagamento, data, chave_idempotencia):
+            logger.info(f"Gasto com a chave {chave_idempotencia} já registrado; reentrega ignorada")
+            return False
+        marcar_alteracao(usuario)
+        contador = categorias_frequentes.obter(usuario)
+        if contador is not None:
+            contador[repositorio.internar_categoria(categoria)[1]] += 1
+        metricas.incrementar("gastos")
+        logger.info(f"Gasto salvo: R${valor} em {categoria} por {usuario}")
+        return True
+    except Exception as e:
+        logger.error(f"Erro ao salvar gasto: {e}")
+        raise
+
+# Modelo de categorização dos gastos em uma mensagem, por usuário: as palavras já usadas e a
+# categoria em que foram usadas, e a contagem das formas de pagamento (a mais usada é o padrão).
+# Fica em memória como as categorias frequentes e é atualizado a cada gasto em uma mensagem
+class ModeloGastos(NamedTuple):
+    palavras: dict
+    formas: Counter
+
+modelos_gastos = CacheTTL(ttl=86400, max_itens=5000)
+
+def obter_modelo_gastos(usuario):
+    modelo = modelos_gastos.obter(usuario)
+    if modelo is not None:
+        return modelo
+    try:
+        palavras, formas = repositorio.carregar_modelo_gastos(usuario)
+        modelo = ModeloGastos(palavras, Counter(dict(formas)))
+        modelos_gastos.guardar(usuario, modelo)
+        return modelo
+    except Exception as e:
+        logger.error(f"Erro ao carregar o modelo de gastos: {e}")
+        raise
+
+# Função para salvar um gasto em uma mensagem: (id do gasto ou None na reentrega, limites do mês do gasto)
+def salvar_gasto_livre(usuario, gasto, chave_idempotencia):
+    try:
+        gasto_id, limites = repositorio.salvar_gasto_livre(
+            usuario, em_reais(gasto.valor), gasto.categoria, gasto.forma_pagamento, gasto.data, chave_idempotencia,
+            gasto.palavras, *intervalo_mes(gasto.data.month, gasto.data.year)
+        )
+        limites = limites_em_centavos(limites)
+        if gasto_id is None:
+            logger.info(f"Gasto com a chave {chave_idempotencia} já registrado; reentrega ignorada")
+            return None, limites
+        marcar_alteracao(usuario)
+        nome = repositorio.internar_categoria(gasto.categoria)[1]
+        contador = categorias_frequentes.obter(usuario)
+        if contador is not None:
+            contador[nome] += 1
+        modelo = modelos_gastos.obter(usuario)
+        if modelo is not None:
+            modelo.palavras.update(dict.fromkeys(gasto.palavras, nome))
+            modelo.formas[gasto.forma_pagamento] += 1
+        metricas.incrementar("gastos")
+        logger.info(f"Gasto salvo: {formatar_reais(gasto.valor)} em {gasto.categoria} por {usuario} (mensagem única)")
+        return gasto_id, limites
+    except Exception as e:
+        logger.error(f"Erro ao salvar gasto em uma mensagem: {e}")
+        raise
+
+# Função para salvar uma entrada (False se a chave de idempotência já tinha sido gravada)
+def salvar_entrada(usuario, valor, descricao, data, chave_idempotencia=None):
+    try:
+        if not repositorio.salvar_entrada(usuario, valor, descricao, data, chave_idempotencia):
+            logger.info(f"Entrada com a chave {chave_idempotencia} já registrada; reentrega ignorada")
+            return False
+        marcar_alteracao(usuario)
+        metricas.incrementar("entradas")
+        logger.info(f"Entrada salva: R${valor} - {descricao} por {usuario}")
+        return True
+    except Exception as e:
+        logger.error(f"Erro ao salvar entrada: {e}")
+        raise
+
+# Resumo de um período, em centavos: gastos por categoria, total de entradas e evolução por
+# intervalo (lista de (inicio_intervalo, gastos, entradas) quando o período tem mais de um intervalo)
+class ResumoPeriodo(NamedTuple):
+    gastos: list
+    entradas: int
+    serie: list
+
+# Função para obter o resumo de um período em uma única consulta agregada por date_trunc
+def obter_resumo_periodo(usuario, inicio, fim, granularidade="month"):
+    try:
+        linhas = repositorio.obter_totais_periodo(usuario, inicio, fim, granularidade)
+    except Exception as e:
+        logger.error(f"Erro ao obter resumo do período: {e}")
+        raise
+
+    # Acumuladores int64 contíguos (array("q")), indexados pela posição da categoria/do intervalo
+    categorias, totais = {}, array("q")
+    intervalos, gastos_serie, entradas_serie = {}, array("q"), array("q")
+    for intervalo, categoria, total in linhas:
+        i = intervalos.setdefault(intervalo, len(intervalos))
+        if i == len(gastos_serie):
+            gastos_serie.append(0)
+            entradas_serie.append(0)
+        if categoria is None:
+            entradas_serie[i] += total
+        else:
+            j = categorias.setdefault(categoria, len(categorias))
+            if j == len(totais):
+                totais.append(0)
+            totais[j] += total
+            gastos_serie[i] += total
+    return ResumoPeriodo(
+        sorted(zip(categorias, totais), key=lambda item: item[1], reverse=True),
+        sum(entradas_serie),
+        [(intervalo, gastos_serie[i], entradas_serie[i]) for intervalo, i in sorted(intervalos.items())] if len(intervalos) > 1 else []
+    )
+
+# Função para listar gastos de um período [inicio, fim)
+def listar_gastos_periodo(usuario, inicio, fim):
+    try:
+        return repositorio.listar_gastos_periodo(usuario, inicio, fim)
+    except Exception as e:
+        logger.error(f"Erro ao listar gastos do período: {e}")
+        raise
+
+# Função para listar entradas de um período [inicio, fim)
+def listar_entradas_periodo(usuario, inicio, fim):
+    try:
+        return repositorio.listar_entradas_periodo(usuario, inicio, fim)
+    except Exception as e:
+        logger.error(f"Erro ao listar entradas do período: {e}")
+        raise
+
+# Função para listar gastos de um mês específico
+def listar_gastos_mensais(usuario, mes, ano):
+    return listar_gastos_periodo(usuario, *intervalo_mes(mes, ano))
+
+# Função para listar entradas de um mês específico
+def listar_entradas_mensais(usuario, mes, ano):
+    return listar_entradas_periodo(usuario, *intervalo_mes(mes, ano))
+
+# Função para editar um gasto
+def editar_gasto(usuario, gasto_id, valor=None, categoria=None, forma_pagamento=None):
+    try:
+        campos = {"valor": valor, "categoria": categoria, "forma_pagamento": forma_pagamento}
+        repositorio.editar_gasto(usuario, gasto_id, {coluna: v for coluna, v in campos.items() if v is not None})
+        marcar_alteracao(usuario)
+        if categoria is not None:
+            categorias_frequentes.descartar(usuario)
+        metricas.incrementar("edicoes")
+        logger.info(f"Gasto ID {gasto_id} editado por {usuario}")
+    except Exception as e:
+        logger.error(f"Erro ao editar gasto: {e}")
+        raise
+
+# Função para editar uma entrada
+def editar_entrada(usuario, entrada_id, valor=None, descricao=None):
+    try:
+        campos = {"valor": valor, "descricao": descricao}
+        repositorio.editar_entrada(usuario, entrada_id, {coluna: v for coluna, v in campos.items() if v is not None})
+        marcar_alteracao(usuario)
+        metricas.incrementar("edicoes")
+        logger.info(f"Entrada ID {entrada_id} editada por {usuario}")
+    except Exception as e:
+        logger.error(f"Erro ao editar entrada: {e}")
+        raise
+
+# Função para remover um gasto
+def remover_gasto(usuario, gasto_id):
+    try:
+        repositorio.remover_gasto(usuario, gasto_id)
+        marcar_alteracao(usuario)
+        categorias_frequentes.descartar(usuario)
+        metricas.incrementar("remocoes")
+        logger.info(f"Gasto ID {gasto_id} removido por {usuario}")
+    except Exception as e:
+        logger.error(f"Erro ao remover gasto: {e}")
+        raise
+
+# Função para remover uma entrada
+def remover_entrada(usuario, entrada_id):
+    try:
+        repositorio.remover_entrada(usuario, entrada_id)
+        marcar_alteracao(usuario)
+        metricas.incrementar("remocoes")
+        logger.info(f"Entrada ID {entrada_id} removida por {usuario}")
+    except Exception as e:
+        logger.error(f"Erro ao remover entrada: {e}")
+        raise
+
+# Função para obter o limite do usuário
+def obter_limite(usuario):
+    try:
+        return repositorio.obter_limite(usuario)
+    except Exception as e:
+        logger.error(f"Erro ao obter limite: {e}")
+        raise
+
+# Função para definir ou atualizar o limite do usuário
+def definir_limite(usuario, limite):
+    try:
+        repositorio.definir_limite(usuario, limite)
+        logger.info(f"Limite de R${limite} definido para o usuário {usuario}")
+    except Exception as e:
+        logger.error(f"Erro ao definir limite: {e}")
+        raise
+
+# Função para definir ou atualizar o limite de uma categoria
+def definir_limite_categoria(usuario, categoria, limite):
+    try:
+        repositorio.definir_limite_categoria(usuario, categoria, limite)
+        logger.info(f"Limite de R${limite} definido para a categoria {categoria} do usuário {usuario}")
+    except Exception as e:
+        logger.error(f"Erro ao definir limite da categoria: {e}")
+        raise
+
+# Linhas (categoria, limite, total) do repositório com os valores em centavos
+def limites_em_centavos(linhas):
+    return [(categoria, em_centavos(limite), em_centavos(total)) for categoria, limite, total in linhas]
+
+# Função para avaliar, em uma única consulta, o limite geral e os limites por categoria do usuário:
+# linhas (categoria, limite, total) em centavos, com categoria None para o limite geral
+def avaliar_limites(usuario, mes, ano):
+    try:
+        return limites_em_centavos(repositorio.avaliar_limites(usuario, *intervalo_mes(mes, ano)))
+    except Exception as e:
+        logger.error(f"Erro ao avaliar limites: {e}")
+        raise
+
+# Função para buscar gastos e entradas de todo o histórico do usuário (uma página por vez)
+def buscar_lancamentos(usuario, termo, filtros, pagina, por_pagina=BUSCA_POR_PAGINA):
+    try:
+        return repositorio.buscar(usuario, termo, filtros, por_pagina + 1, pagina * por_pagina)
+    except Exception as e:
+        logger.error(f"Erro ao buscar lançamentos: {e}")
+        raise
+
+# Função para obter a data de corte do arquivamento do usuário (ver Repositorio.obter_corte_arquivo)
+def obter_corte_arquivo(usuario):
+    try:
+        return repositorio.obter_corte_arquivo(usuario)
+    except Exception as e:
+        logger.error(f"Erro ao obter o corte do arquivo: {e}")
+        raise
+
+# Aviso de que os lançamentos antes do corte estão arquivados e não aparecem em `onde`
+def aviso_arquivo(corte, onde):
+    return f"\n\nℹ️ Lançamentos anteriores a {corte:%m/%Y} estão arquivados e {onde}."
+
+# Carga incremental do esquema de relatórios (relatorios.*): só os dias (usuario, data) com gastos
+# inseridos, editados ou removidos desde a última marca d'água são recalculados no fato. A janela
+# de sobreposição cobre transações que gravaram antes da marca mas só confirmaram depois dela;
+# recalcular um dia é idempotente
+RELATORIOS_INTERVALO_MINUTOS = config("RELATORIOS_INTERVALO_MINUTOS", default=15, cast=int)
+RELATORIOS_SOBREPOSICAO = timedelta(minutes=5)
+
+def atualizar_relatorios():
+    try:
+        with conectar() as conn:
+            with conn.cursor() as cursor:
+                # Uma carga por vez, mesmo com mais de uma instância do bot
+                cursor.execute("SELECT pg_try_advisory_xact_lock(hashtext('relatorios.fato_gastos'))")
+                if not cursor.fetchone()[0]:
+                    return None
+                cursor.execute("SELECT now()::timestamp")
+                nova_marca = cursor.fetchone()[0]
+                cursor.execute("SELECT marca FROM relatorios.controle_carga WHERE tabela = 'fato_gastos'")
+                resultado = cursor.fetchone()
+                desde = resultado[0] - RELATORIOS_SOBREPOSICAO if resultado else None
+
+                cursor.execute("CREATE TEMP TABLE dias_alterados (usuario TEXT, data DATE, PRIMARY KEY (usuario, data)) ON COMMIT DROP")
+                if desde is None:
+                    cursor.execute("TRUNCATE relatorios.fato_gastos")
+                    cursor.execute("INSERT INTO dias_alterados SELECT DISTINCT usuario, data FROM gastos")
+                else:
+                    cursor.execute('''
+                    INSERT INTO dias_alterados
+                    SELECT usuario, data FROM gastos WHERE alterado_em > %(desde)s
+                    UNION
+                    SELECT usuario, data FROM gastos_removidos WHERE removido_em > %(desde)s
+                    ''', {"desde": desde})
+                    cursor.execute('''
+                    DELETE FROM relatorios.fato_gastos f
+                    USING dias_alterados a
+                    WHERE f.usuario = a.usuario AND f.data = a.data
+                    ''')
+
+                cursor.execute('''
+                INSERT INTO relatorios.dim_categoria (categoria_id, nome)
+                SELECT id, nome FROM categorias
+                ON CONFLICT (categoria_id) DO UPDATE SET nome = EXCLUDED.nome
+                ''')
+                cursor.execute('''
+                INSERT INTO relatorios.dim_data (data, ano, trimestre, mes, dia, dia_semana, ano_mes)
+                SELECT DISTINCT data, EXTRACT(YEAR FROM data), EXTRACT(QUARTER FROM data), EXTRACT(MONTH FROM data),
+                       EXTRACT(DAY FROM data), EXTRACT(ISODOW FROM data), to_char(data, 'YYYY-MM')
+                FROM dias_alterados
+                ON CONFLICT (data) DO NOTHING
+                ''')
+                cursor.execute('''
+                INSERT INTO relatorios.dim_forma_pagamento (nome)
+                SELECT DISTINCT COALESCE(g.forma_pagamento, '')
+                FROM gastos g
+                JOIN dias_alterados a ON a.usuario = g.usuario AND a.data = g.data
+                ON CONFLICT (nome) DO NOTHING
+                ''')
+                cursor.execute('''
+                INSERT INTO relatorios.fato_gastos (usuario, data, categoria_id, forma_pagamento_id, total, quantidade)
+                SELECT g.usuario, g.data, g.categoria_id, fp.forma_pagamento_id, SUM(g.valor), COUNT(*)
+                FROM gastos g
+                JOIN dias_alterados a ON a.usuario = g.usuario AND a.data = g.data
+                JOIN relatorios.dim_forma_pagamento fp ON fp.nome = COALESCE(g.forma_pagamento, '')
+                GROUP BY 1, 2, 3, 4
+                ''')
+                cursor.execute("SELECT COUNT(*) FROM dias_alterados")
+                dias = cursor.fetchone()[0]
+
+                cursor.execute("DELETE FROM gastos_removidos WHERE removido_em <= %s", (nova_marca - RELATORIOS_SOBREPOSICAO,))
+                cursor.execute('''
+                INSERT INTO relatorios.controle_carga (tabela, marca)
+                VALUES ('fato_gastos', %s)
+                ON CONFLICT (tabela) DO UPDATE SET marca = EXCLUDED.marca, atualizado_em = now()
+                ''', (nova_marca,))
+                conn.commit()
+                logger.info(f"Relatórios atualizados: {dias} dias recalculados ({'carga completa' if desde is None else f'desde {desde}'}).")
+                return dias
+    except Exception as e:
+        logger.error(f"Erro ao atualizar o esquema de relatórios: {e}")
+        raise
+
+# Função para obter a tendência dos últimos meses por categoria (e o total) em uma única consulta:
+# linhas (categoria, mes, total, variacao, media_acumulada), com categoria None para o total do mês
+cache_tendencias = CacheTTL(ttl=3600)
+
+def obter_tendencias(usuario, meses=12):
+    hoje = date.today()
+    chave = (usuario, versao_dados(usuario), hoje.month, hoje.year, meses)
+    tendencias = cache_tendencias.obter(chave)
+    if tendencias is not None:
+        return tendencias
+    mes_inicial, ano_inicial = deslocar_mes(hoje.month, hoje.year, -(meses - 1))
+    inicio = date(ano_inicial, mes_inicial, 1)
+    ultimo, fim = intervalo_mes(hoje.month, hoje.year)
+    try:
+        with conectar_leitura(usuario) as conn:
+            with conn.cursor() as cursor:
+                cursor.execute('''
+                WITH meses AS (
+                    SELECT generate_series(%(inicio)s::date, %(ultimo)s::date, interval '1 month')::date AS mes
+                ), mensal AS (
+                    SELECT categoria_id, date_trunc('month', data)::date AS mes, (SUM(valor) * 100)::bigint AS total
+                    FROM gastos
+                    WHERE usuario = %(usuario)s AND data >= %(inicio)s AND data < %(fim)s
+                    GROUP BY GROUPING SETS ((categoria_id, date_trunc('month', data)), (date_trunc('month', data)))
+                ), grade AS (
+                    SELECT c.categoria_id, m.mes, COALESCE(t.total, 0) AS total
+                    FROM (SELECT DISTINCT categoria_id FROM mensal) c
+                    CROSS JOIN meses m
+                    LEFT JOIN mensal t ON t.categoria_id IS NOT DISTINCT FROM c.categoria_id AND t.mes = m.mes
+                )
+                SELECT c.nome AS categoria, g.mes, g.total,
+                       g.total - LAG(g.total) OVER w AS variacao,
+                       round(AVG(g.total) OVER (w ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW))::bigint AS media_acumulada
+                FROM grade g
+                LEFT JOIN categorias c ON c.id = g.categoria_id
+                WINDOW w AS (PARTITION BY g.categoria_id ORDER BY g.mes)
+                ORDER BY c.nome NULLS FIRST, g.mes
+                ''', {"usuario": usuario, "inicio": inicio, "ultimo": ultimo, "fim": fim})
+                tendencias = cursor.fetchall()
+        cache_tendencias.guardar(chave, tendencias)
+        return tendencias
+    except Exception as e:
+        logger.error(f"Erro ao obter tendências: {e}")
+        raise
+
+# Função para reconstruir o estado da previsão a partir dos gastos (usada só quando o estado não existe);
+# devolve os totais em centavos
+def reconstruir_estado_previsao(cursor, usuario, mes, ano):
+    inicio, fim = intervalo_mes(mes, ano)
+    inicio_anterior, _ = intervalo_mes(*deslocar_mes(mes, ano, -1))
+    cursor.execute(f'''
+    SELECT categoria, valor, data >= %s AS neste_mes, {SQL_GASTO_FIXO} AS fixo
+    FROM gastos
+    WHERE usuario = %s AND data >= %s AND data < %s
+    ORDER BY data, id
+    ''', (inicio, usuario, inicio_anterior, fim))
+    gasto_variavel = gasto_fixo = 0
+    compromissos = {}
+    for categoria, valor, neste_mes, fixo in cursor.fetchall():
+        centavos = em_centavos(valor)
+        if neste_mes:
+            if fixo:
+                gasto_fixo += centavos
+            else:
+                gasto_variavel += centavos
+        if fixo:
+            # Vale o último valor registrado de cada gasto fixo nos dois últimos meses
+            registrado = compromissos.get(categoria, {}).get("neste_mes", False) or neste_mes
+            compromissos[categoria] = {
+                "periodicidade": SUFIXO_GASTO_FIXO.search(categoria).group(1).replace("DIARIO", "DIÁRIO"),
+                "centavos": centavos,
+                "neste_mes": registrado,
+            }
+    cursor.execute('''
+    INSERT INTO previsao_mensal (usuario, ano, mes, gasto_variavel, gasto_fixo, compromissos)
+    VALUES (%s, %s, %s, %s, %s, %s)
+    ON CONFLICT (usuario, ano, mes) DO NOTHING
+    ''', (usuario, ano, mes, em_reais(gasto_variavel), em_reais(gasto_fixo), json.dumps(compromissos)))
+    return gasto_variavel, gasto_fixo, compromissos
 
-# Função para salvar um gasto
-def salvar_gasto(usuario, valor, categoria, forma_pagamento, data):
+# Função para obter o estado da previsão, o perfil diário e o limite geral do usuário:
+# (gasto_variavel, gasto_fixo, compromissos, fracao, limite), com os valores em centavos
+# (limite None quando não há limite geral)
+def obter_estado_previsao(usuario, mes, ano):
     try:
         with conectar() as conn:
             with conn.cursor() as cursor:
                 cursor.execute('''
-                INSERT INTO gastos (usuario, valor, categoria, forma_pagamento, data)
-                VALUES (%s, %s, %s, %s, %s)
-                ''', (usuario, valor, categoria, forma_pagamento, data))
-                conn.commit()
-        logger.info(f"Gasto salvo: R${valor} em {categoria} por {usuario}")
+                SELECT p.gasto_variavel, p.gasto_fixo, p.compromissos, pd.fracao, l.limite
+                FROM (SELECT %s::text AS usuario) u
+                LEFT JOIN previsao_mensal p ON p.usuario = u.usuario AND p.ano = %s AND p.mes = %s
+                LEFT JOIN perfil_gastos_diario pd ON pd.usuario = u.usuario
+                LEFT JOIN limites l ON l.usuario = u.usuario
+                ''', (usuario, ano, mes))
+                gasto_variavel, gasto_fixo, compromissos, fracao, limite = cursor.fetchone()
+                if gasto_variavel is None:
+                    gasto_variavel, gasto_fixo, compromissos = reconstruir_estado_previsao(cursor, usuario, mes, ano)
+                    conn.commit()
+                else:
+                    gasto_variavel, gasto_fixo = em_centavos(gasto_variavel), em_centavos(gasto_fixo)
+                return gasto_variavel, gasto_fixo, compromissos, fracao, None if limite is None else em_centavos(limite)
     except Exception as e:
-        logger.error(f"Erro ao salvar gasto: {e}")
+        logger.error(f"Erro ao obter estado da previsão: {e}")
         raise
 
-# Função para salvar uma entrada
-def salvar_entrada(usuario, valor, descricao, data):
+# Função para obter os gastos variáveis por dia de todos os usuários (lote noturno do perfil diário)
+def obter_gastos_diarios(inicio, fim):
     try:
-        with conectar() as conn:
+        with conectar_leitura() as conn:
             with conn.cursor() as cursor:
-                cursor.execute('''
-                INSERT INTO entradas (usuario, valor, descricao, data)
-                VALUES (%s, %s, %s, %s)
-                ''', (usuario, valor, descricao, data))
-                conn.commit()
-        logger.info(f"Entrada salva: R${valor} - {descricao} por {usuario}")
+                cursor.execute(f'''
+                SELECT usuario, date_trunc('month', data)::date AS mes, EXTRACT(DAY FROM data)::int AS dia, SUM(valor)
+                FROM gastos
+                WHERE data >= %s AND data < %s AND NOT {SQL_GASTO_FIXO}
+                GROUP BY 1, 2, 3
+                ''', (inicio, fim))
+                return cursor.fetchall()
     except Exception as e:
-        logger.error(f"Erro ao salvar entrada: {e}")
+        logger.error(f"Erro ao obter gastos diários: {e}")
         raise
 
-# Função para obter gastos mensais (para resumo e planilha)
-def obter_gastos_mensais(usuario, mes, ano):
+# Função para substituir os perfis diários (usuario, fracao, meses)
+def salvar_perfis_diarios(perfis):
     try:
         with conectar() as conn:
             with conn.cursor() as cursor:
-                cursor.execute('''
-                SELECT categoria, SUM(valor) as total
-                FROM gastos
-                WHERE usuario = %s AND EXTRACT(MONTH FROM data) = %s AND EXTRACT(YEAR FROM data) = %s
-                GROUP BY categoria
-                ''', (usuario, mes, ano))
-                return cursor.fetchall()
+                cursor.execute("DELETE FROM perfil_gastos_diario")
+                psycopg2.extras.execute_values(cursor, '''
+                INSERT INTO perfil_gastos_diario (usuario, fracao, meses)
+                VALUES %s
+                ''', perfis, page_size=1000)
+                conn.commit()
+        logger.info(f"{len(perfis)} perfis diários de gastos atualizados.")
     except Exception as e:
-        logger.error(f"Erro ao obter gastos: {e}")
+        logger.error(f"Erro ao salvar perfis diários: {e}")
         raise
 
-# Função para obter o total de gastos mensais
-def obter_total_gastos_mensais(usuario, mes, ano):
+# Função para listar uma página dos usuários ativos no mês ainda sem relatório (inclusive os de
+# reservas antigas nunca confirmadas, deixadas por uma execução interrompida), em ordem e a partir
+# do último usuário da página anterior: cada página é uma consulta curta, sem transação aberta
+# durante os envios
+def listar_usuarios_para_relatorio(mes, ano, apos, tamanho_lote):
+    inicio, fim = intervalo_mes(mes, ano)
     try:
         with conectar() as conn:
             with conn.cursor() as cursor:
                 cursor.execute('''
-                SELECT SUM(valor) as total
-                FROM gastos
-                WHERE usuario = %s AND EXTRACT(MONTH FROM data) = %s AND EXTRACT(YEAR FROM data) = %s
-                ''', (usuario, mes, ano))
-                resultado = cursor.fetchone()
-                return resultado[0] if resultado[0] is not None else 0
+                SELECT ativos.usuario
+                FROM (
+                    SELECT usuario FROM gastos WHERE data >= %s AND data < %s AND usuario > %s
+                    UNION
+                    SELECT usuario FROM entradas WHERE data >= %s AND data < %s AND usuario > %s
+                ) ativos
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM envios_relatorio_mensal e
+                    WHERE e.ano = %s AND e.mes = %s AND e.usuario = ativos.usuario
+                      AND (e.enviado_em IS NOT NULL OR e.reservado_em >= now() - make_interval(mins => %s))
+                )
+                ORDER BY ativos.usuario
+                LIMIT %s
+                ''', (inicio, fim, apos, inicio, fim, apos, ano, mes, RELATORIO_RESERVA_MINUTOS, tamanho_lote))
+                usuarios = [usuario for (usuario,) in cursor.fetchall()]
+                conn.commit()
+                return usuarios
     except Exception as e:
-        logger.error(f"Erro ao obter total de gastos: {e}")
+        logger.error(f"Erro ao listar usuários para o relatório mensal: {e}")
         raise
 
-# Função para obter entradas mensais
-def obter_entradas_mensais(usuario, mes, ano):
+# Função para obter o resumo do mês de vários usuários de uma vez: {usuario: (gastos, entradas)}
+def obter_resumos_em_lote(usuarios, mes, ano):
+    inicio, fim = intervalo_mes(mes, ano)
     try:
-        with conectar() as conn:
+        with conectar_leitura() as conn:
             with conn.cursor() as cursor:
+                resumos = {usuario: ([], 0) for usuario in usuarios}
+                cursor.execute('''
+                SELECT t.usuario, c.nome, t.total
+                FROM (
+                    SELECT usuario, categoria_id, (SUM(valor) * 100)::bigint as total
+                    FROM gastos
+                    WHERE usuario = ANY(%s) AND data >= %s AND data < %s
+                    GROUP BY usuario, categoria_id
+                ) t
+                JOIN categorias c ON c.id = t.categoria_id
+                ORDER BY t.usuario, c.nome
+                ''', (list(usuarios), inicio, fim))
+                for usuario, categoria, total in cursor.fetchall():
+                    resumos[usuario][0].append((categoria, total))
                 cursor.execute('''
-                SELECT SUM(valor) as total
+                SELECT usuario, (SUM(valor) * 100)::bigint as total
                 FROM entradas
-                WHERE usuario = %s AND EXTRACT(MONTH FROM data) = %s AND EXTRACT(YEAR FROM data) = %s
-                ''', (usuario, mes, ano))
-                resultado = cursor.fetchone()
-                return resultado[0] if resultado[0] is not None else 0
+                WHERE usuario = ANY(%s) AND data >= %s AND data < %s
+                GROUP BY usuario
+                ''', (list(usuarios), inicio, fim))
+                for usuario, total in cursor.fetchall():
+                    resumos[usuario] = (resumos[usuario][0], total)
+                return resumos
     except Exception as e:
-        logger.error(f"Erro ao obter entradas: {e}")
+        logger.error(f"Erro ao obter resumos em lote: {e}")
         raise
 
-# Função para listar gastos de um mês específico
-def listar_gastos_mensais(usuario, mes, ano):
+# Função para reservar o envio do relatório (retorna só os usuários que ainda não estavam reservados
+# ou cuja reserva expirou sem confirmação)
+def reservar_envios_relatorio(usuarios, mes, ano):
     try:
         with conectar() as conn:
             with conn.cursor() as cursor:
                 cursor.execute('''
-                SELECT id, valor, categoria, forma_pagamento, data
-                FROM gastos
-                WHERE usuario = %s AND EXTRACT(MONTH FROM data) = %s AND EXTRACT(YEAR FROM data) = %s
-                ORDER BY data DESC
-                ''', (usuario, mes, ano))
-                return cursor.fetchall()
+                INSERT INTO envios_relatorio_mensal AS e (usuario, ano, mes)
+                SELECT unnest(%s::text[]), %s, %s
+                ON CONFLICT (ano, mes, usuario) DO UPDATE SET reservado_em = now()
+                WHERE e.enviado_em IS NULL AND e.reservado_em < now() - make_interval(mins => %s)
+                RETURNING usuario
+                ''', (list(usuarios), ano, mes, RELATORIO_RESERVA_MINUTOS))
+                reservados = [usuario for (usuario,) in cursor.fetchall()]
+                conn.commit()
+                return reservados
     except Exception as e:
-        logger.error(f"Erro ao listar gastos mensais: {e}")
+        logger.error(f"Erro ao reservar envios do relatório: {e}")
         raise
 
-# Função para listar entradas de um mês específico
-def listar_entradas_mensais(usuario, mes, ano):
+# Função para registrar o checkpoint do lote: confirma os enviados e libera as falhas para a próxima execução
+def registrar_envios_relatorio(enviados, falhas, mes, ano):
     try:
         with conectar() as conn:
             with conn.cursor() as cursor:
                 cursor.execute('''
-                SELECT id, valor, descricao, data
-                FROM entradas
-                WHERE usuario = %s AND EXTRACT(MONTH FROM data) = %s AND EXTRACT(YEAR FROM data) = %s
-                ORDER BY data DESC
-                ''', (usuario, mes, ano))
-                return cursor.fetchall()
+                UPDATE envios_relatorio_mensal SET enviado_em = now()
+                WHERE ano = %s AND mes = %s AND usuario = ANY(%s)
+                ''', (ano, mes, list(enviados)))
+                cursor.execute('''
+                DELETE FROM envios_relatorio_mensal
+                WHERE ano = %s AND mes = %s AND usuario = ANY(%s)
+                ''', (ano, mes, list(falhas)))
+                conn.commit()
     except Exception as e:
-        logger.error(f"Erro ao listar entradas mensais: {e}")
+        logger.error(f"Erro ao registrar envios do relatório: {e}")
         raise
 
-# Função para editar um gasto
-def editar_gasto(usuario, gasto_id, valor=None, categoria=None, forma_pagamento=None):
+# Função para obter limites e totais (em centavos) de todos os usuários em um único resultado
+# (lote noturno), sem os alertas já enviados no mês
+def obter_limites_todos_usuarios(mes, ano):
+    inicio, fim = intervalo_mes(mes, ano)
     try:
         with conectar() as conn:
             with conn.cursor() as cursor:
-                query = "UPDATE gastos SET "
-                params = []
-                if valor is not None:
-                    query += "valor = %s, "
-                    params.append(valor)
-                if categoria is not None:
-                    query += "categoria = %s, "
-                    params.append(categoria)
-                if forma_pagamento is not None:
-                    query += "forma_pagamento = %s, "
-                    params.append(forma_pagamento)
-                query = query.rstrip(", ") + " WHERE usuario = %s AND id = %s"
-                params.extend([usuario, gasto_id])
-                cursor.execute(query, params)
-                conn.commit()
-        logger.info(f"Gasto ID {gasto_id} editado por {usuario}")
+                cursor.execute('''
+                WITH totais AS (
+                    SELECT usuario, categoria_id, SUM(valor) AS total
+                    FROM gastos
+                    WHERE data >= %(inicio)s AND data < %(fim)s
+                      AND usuario IN (SELECT usuario FROM limites UNION SELECT usuario FROM limites_categoria)
+                    GROUP BY 1, 2
+                ), avaliacao AS (
+                    SELECT l.usuario, '' AS categoria, l.limite,
+                           COALESCE((SELECT SUM(t.total) FROM totais t WHERE t.usuario = l.usuario), 0) AS total
+                    FROM limites l
+                    UNION ALL
+                    SELECT lc.usuario, lc.categoria, lc.limite, COALESCE(t.total, 0) AS total
+                    FROM limites_categoria lc
+                    LEFT JOIN totais t ON t.usuario = lc.usuario AND t.categoria_id = lc.categoria_id
+                )
+                SELECT a.usuario, a.categoria, (a.limite * 100)::bigint AS limite, (a.total * 100)::bigint AS total,
+                       array_remove(array_agg(al.nivel), NULL) AS niveis_enviados
+                FROM avaliacao a
+                LEFT JOIN alertas_limite al
+                       ON al.usuario = a.usuario AND al.categoria = a.categoria AND al.ano = %(ano)s AND al.mes = %(mes)s
+                GROUP BY a.usuario, a.categoria, a.limite, a.total
+                ''', {"inicio": inicio, "fim": fim, "ano": ano, "mes": mes})
+                return cursor.fetchall()
     except Exception as e:
-        logger.error(f"Erro ao editar gasto: {e}")
+        logger.error(f"Erro ao obter limites de todos os usuários: {e}")
         raise
 
-# Função para editar uma entrada
-def editar_entrada(usuario, entrada_id, valor=None, descricao=None):
+# Função para registrar os alertas de limite enviados
+def registrar_alertas_limite(alertas, mes, ano):
     try:
         with conectar() as conn:
             with conn.cursor() as cursor:
-                query = "UPDATE entradas SET "
-                params = []
-                if valor is not None:
-                    query += "valor = %s, "
-                    params.append(valor)
-                if descricao is not None:
-                    query += "descricao = %s, "
-                    params.append(descricao)
-                query = query.rstrip(", ") + " WHERE usuario = %s AND id = %s"
-                params.extend([usuario, entrada_id])
-                cursor.execute(query, params)
+                cursor.execute('''
+                INSERT INTO alertas_limite (usuario, categoria, nivel, ano, mes)
+                SELECT unnest(%s::text[]), unnest(%s::text[]), unnest(%s::text[]), %s, %s
+                ON CONFLICT DO NOTHING
+                ''', ([a[0] for a in alertas], [a[1] for a in alertas], [a[2] for a in alertas], ano, mes))
                 conn.commit()
-        logger.info(f"Entrada ID {entrada_id} editada por {usuario}")
     except Exception as e:
-        logger.error(f"Erro ao editar entrada: {e}")
+        logger.error(f"Erro ao registrar alertas de limite: {e}")
         raise
 
-# Função para remover um gasto
-def remover_gasto(usuario, gasto_id):
+# Função para verificar se o limite geral ou algum limite de categoria foi excedido (limites em centavos,
+# como os de avaliar_limites)
+async def verificar_limite(update: Update, usuario, mes, ano, limites=None):
     try:
-        with conectar() as conn:
+        mes_atual = repositorio.analises and (mes, ano) == (datetime.now().month, datetime.now().year)
+        for categoria, limite, total_gastos in avaliar_limites(usuario, mes, ano) if limites is None else limites:
+            if categoria is None:
+                previsao = prever_gasto_mensal(usuario)[0] if mes_atual else None
+                if total_gastos > limite:
+                    alerta = (f"⚠️ Alerta: Você ultrapassou seu limite de gastos mensal de {formatar_reais(limite)}! "
+                              f"Seu total de gastos em {mes:02d}/{ano} é {formatar_reais(total_gastos)}.")
+                    if previsao is not None:
+                        alerta += f" Projeção para o fim do mês: {formatar_reais(previsao)}."
+                    await responder(update, alerta)
+                elif previsao is not None and previsao > limite:
+                    await responder(
+                        update,
+                        f"🔔 Previsão: no ritmo atual seus gastos devem chegar a {formatar_reais(previsao)} no fim do mês, "
+                        f"acima do seu limite de {formatar_reais(limite)}."
+                    )
+            elif total_gastos > limite:
+                await responder(
+                    update,
+                    f"⚠️ Alerta: Você ultrapassou o limite de {formatar_reais(limite)} da categoria '{categoria}'! "
+                    f"Seu total nessa categoria em {mes:02d}/{ano} é {formatar_reais(total_gastos)}."
+                )
+    except Exception as e:
+        logger.error(f"Erro ao verificar limite: {e}")
+
+# Função para obter o histórico mensal por usuário e categoria de todos os usuários (lote noturno)
+def obter_historico_mensal(inicio, fim):
+    try:
+        with conectar_leitura() as conn:
             with conn.cursor() as cursor:
                 cursor.execute('''
-                DELETE FROM gastos
-                WHERE usuario = %s AND id = %s
-                ''', (usuario, gasto_id))
-                conn.commit()
-        logger.info(f"Gasto ID {gasto_id} removido por {usuario}")
+                SELECT t.usuario, c.nome, t.mes, t.total
+                FROM (
+                    SELECT usuario, categoria_id, date_trunc('month', data)::date AS mes, SUM(valor) AS total
+                    FROM gastos
+                    WHERE data >= %s AND data < %s
+                    GROUP BY usuario, categoria_id, date_trunc('month', data)
+                ) t
+                JOIN categorias c ON c.id = t.categoria_id
+                ''', (inicio, fim))
+                return cursor.fetchall()
     except Exception as e:
-        logger.error(f"Erro ao remover gasto: {e}")
+        logger.error(f"Erro ao obter histórico mensal: {e}")
         raise
 
-# Função para remover uma entrada
-def remover_entrada(usuario, entrada_id):
+# Função para substituir as linhas de base de gastos (usuario, categoria, media, desvio, ewma, meses)
+def salvar_baselines(baselines):
     try:
         with conectar() as conn:
             with conn.cursor() as cursor:
-                cursor.execute('''
-                DELETE FROM entradas
-                WHERE usuario = %s AND id = %s
-                ''', (usuario, entrada_id))
+                cursor.execute("DELETE FROM baseline_gastos")
+                psycopg2.extras.execute_values(cursor, '''
+                INSERT INTO baseline_gastos (usuario, categoria, media, desvio, ewma, meses)
+                VALUES %s
+                ''', baselines, page_size=1000)
                 conn.commit()
-        logger.info(f"Entrada ID {entrada_id} removida por {usuario}")
+        logger.info(f"{len(baselines)} linhas de base de gastos atualizadas.")
     except Exception as e:
-        logger.error(f"Erro ao remover entrada: {e}")
+        logger.error(f"Erro ao salvar linhas de base: {e}")
         raise
 
-# Função para obter o limite do usuário
-def obter_limite(usuario):
+# Função para obter as linhas de base do usuário: {categoria: (media, desvio, ewma)}
+def obter_baselines(usuario):
     try:
-        with conectar() as conn:
+        with conectar_leitura(usuario) as conn:
             with conn.cursor() as cursor:
                 cursor.execute('''
-                SELECT limite
-                FROM limites
+                SELECT categoria, media, desvio, ewma
+                FROM baseline_gastos
                 WHERE usuario = %s
                 ''', (usuario,))
-                resultado = cursor.fetchone()
-                return resultado[0] if resultado else None
+                return {categoria: (media, desvio, ewma) for categoria, media, desvio, ewma in cursor.fetchall()}
     except Exception as e:
-        logger.error(f"Erro ao obter limite: {e}")
+        logger.error(f"Erro ao obter linhas de base: {e}")
+        raise
+
+# Configuração do motor de gastos atípicos
+ANOMALIAS_MESES_HISTORICO = config("ANOMALIAS_MESES_HISTORICO", default=12, cast=int)
+ANOMALIAS_MESES_MINIMOS = config("ANOMALIAS_MESES_MINIMOS", default=3, cast=int)
+ANOMALIAS_ALFA_EWMA = config("ANOMALIAS_ALFA_EWMA", default=0.3, cast=float)
+ANOMALIAS_LIMIAR_Z = config("ANOMALIAS_LIMIAR_Z", default=2.0, cast=float)
+
+# Função para calcular média, desvio padrão e EWMA de cada (usuario, categoria) de forma vetorizada.
+# O histórico de cada usuário começa no primeiro mês em que ele teve algum gasto; meses sem gasto
+# na categoria a partir daí contam como zero
+def calcular_baselines(historico, meses):
+    if not historico:
+        return []
+    df = pd.DataFrame(historico, columns=['usuario', 'categoria', 'mes', 'total'])
+    df['total'] = np.fromiter(map(em_centavos, df['total']), dtype=np.int64, count=len(df))
+    grade = df.pivot_table(index=['usuario', 'categoria'], columns='mes', values='total', aggfunc='sum')
+    grade = grade.reindex(columns=meses, fill_value=np.nan)
+    # Estatísticas em reais (as médias e desvios não são múltiplos exatos de centavo)
+    valores = grade.to_numpy(dtype=float) / 100
+
+    usuarios = grade.index.get_level_values('usuario')
+    ativo = pd.DataFrame(~np.isnan(valores), index=usuarios).groupby(level=0).transform('any').to_numpy()
+    ativo = np.maximum.accumulate(ativo, axis=1)
+    valores = np.where(ativo, np.nan_to_num(valores), np.nan)
+
+    n = ativo.sum(axis=1)
+    media = np.nanmean(np.where(ativo, valores, np.nan), axis=1)
+    desvio = np.sqrt(np.nansum((valores - media[:, None]) ** 2, axis=1) / np.maximum(n - 1, 1))
+    pesos = (1 - ANOMALIAS_ALFA_EWMA) ** np.arange(len(meses) - 1, -1, -1) * ativo
+    ewma = np.nansum(np.nan_to_num(valores) * pesos, axis=1) / pesos.sum(axis=1)
+
+    validos = n >= ANOMALIAS_MESES_MINIMOS
+    return [
+        (usuario, categoria, round(float(m), 2), round(float(d), 2), round(float(e), 2), int(q))
+        for (usuario, categoria), m, d, e, q in zip(
+            grade.index[validos], media[validos], desvio[validos], ewma[validos], n[validos]
+        )
+    ]
+
+# Função para encontrar o gasto mais atípico do mês em relação ao histórico do usuário; as linhas
+# de base (em reais no banco) são comparadas em centavos e a referência devolvida é em centavos
+def detectar_gasto_atipico(gastos, baselines):
+    mais_atipico = None
+    for categoria, total in gastos:
+        if categoria not in baselines:
+            continue
+        media, desvio, ewma = (em_centavos(valor) for valor in baselines[categoria])
+        if desvio <= 0:
+            continue
+        referencia = max(media, ewma)
+        if total > referencia + ANOMALIAS_LIMIAR_Z * desvio:
+            z = (total - media) / desvio
+            if mais_atipico is None or z > mais_atipico[3]:
+                mais_atipico = (categoria, total, referencia, z)
+    return mais_atipico
+
+# Configuração da previsão de fim de mês
+PREVISAO_MESES_HISTORICO = config("PREVISAO_MESES_HISTORICO", default=6, cast=int)
+PREVISAO_MESES_MINIMOS = config("PREVISAO_MESES_MINIMOS", default=2, cast=int)
+PREVISAO_FRACAO_MINIMA = config("PREVISAO_FRACAO_MINIMA", default=0.1, cast=float)
+
+# Função para calcular o perfil diário de cada usuário: fração média do gasto variável do mês
+# já realizada até cada dia (31 posições), a partir dos meses fechados
+def calcular_perfis_diarios(linhas):
+    if not linhas:
+        return []
+    df = pd.DataFrame(linhas, columns=['usuario', 'mes', 'dia', 'total'])
+    df['total'] = np.fromiter(map(em_centavos, df['total']), dtype=np.int64, count=len(df))
+    grade = df.pivot_table(index=['usuario', 'mes'], columns='dia', values='total', aggfunc='sum', fill_value=0)
+    grade = grade.reindex(columns=range(1, 32), fill_value=0)
+    acumulado = grade.to_numpy(dtype=np.int64).cumsum(axis=1)
+    totais = acumulado[:, -1]
+    validos = totais > 0
+    fracoes = pd.DataFrame(acumulado[validos] / totais[validos, None], index=grade.index[validos].get_level_values('usuario'))
+    medias = fracoes.groupby(level=0).mean()
+    meses = fracoes.groupby(level=0).size()
+    return [
+        (usuario, [round(float(f), 4) for f in medias.loc[usuario]], int(meses[usuario]))
+        for usuario in medias.index if meses[usuario] >= PREVISAO_MESES_MINIMOS
+    ]
+
+# Função para projetar o total de gastos do mês, em centavos: gasto variável extrapolado pelo perfil
+# diário (ou linearmente, sem histórico), mais os fixos já lançados e a carga fixa que ainda vai ocorrer
+def calcular_previsao(gasto_variavel, gasto_fixo, compromissos, fracao, hoje):
+    dias_mes = calendar.monthrange(hoje.year, hoje.month)[1]
+    dias_restantes = dias_mes - hoje.day
+    linear = hoje.day / dias_mes
+    fracao_hoje = fracao[hoje.day - 1] if fracao else linear
+    # Um perfil com pouco gasto no início do mês não pode multiplicar demais o valor atual
+    fracao_hoje = min(max(fracao_hoje, linear / 2, PREVISAO_FRACAO_MINIMA), 1)
+    carga_fixa = 0
+    for compromisso in compromissos.values():
+        if compromisso["periodicidade"] == "DIÁRIO":
+            carga_fixa += compromisso["centavos"] * dias_restantes
+        elif compromisso["periodicidade"] == "SEMANAL":
+            carga_fixa += compromisso["centavos"] * (dias_restantes // 7)
+        elif not compromisso["neste_mes"]:
+            carga_fixa += compromisso["centavos"]
+    return round(gasto_variavel / fracao_hoje) + gasto_fixo + carga_fixa
+
+# Função para obter a previsão de fim do mês atual e o limite geral do usuário, em centavos: (previsao, limite)
+def prever_gasto_mensal(usuario):
+    hoje = datetime.now()
+    gasto_variavel, gasto_fixo, compromissos, fracao, limite = obter_estado_previsao(usuario, hoje.month, hoje.year)
+    return calcular_previsao(gasto_variavel, gasto_fixo, compromissos, fracao, hoje), limite
+
+# Função para gerar recomendações (personalizadas quando há histórico do usuário)
+def gerar_recomendacao(gastos, baselines=None):
+    if baselines:
+        atipico = detectar_gasto_atipico(gastos, baselines)
+        if atipico:
+            categoria, total, referencia, _ = atipico
+            return (f"Seus gastos com '{categoria}' ({formatar_reais(total)}) estão bem acima do seu normal "
+                    f"(cerca de {formatar_reais(referencia)} por mês). Vale rever essa categoria.")
+        if any(categoria in baselines for categoria, _ in gastos):
+            return "Seus gastos estão dentro do seu padrão habitual. Parabéns!"
+    total_gastos = sum(total for _, total in gastos)
+    for categoria, total in gastos:
+        if total > 100000 and categoria.lower() in ['lazer', 'compras', 'entretenimento']:
+            return f"Considere reduzir gastos com '{categoria}' ({formatar_reais(total)})."
+    if total_gastos > 300000:
+        return "Você está gastando muito! Reduza despesas gerais."
+    elif total_gastos > 150000:
+        return "Seus gastos estão moderados. Tente economizar um pouco mais."
+    return "Seus gastos estão sob controle. Parabéns!"
+
+# Configuração dos limites de envio para a API do Telegram
+TELEGRAM_API_URL = config("TELEGRAM_API_URL", default="https://api.telegram.org/bot")
+TAXA_GLOBAL_ENVIOS = config("TAXA_GLOBAL_ENVIOS", default=25, cast=float)
+TAXA_ENVIOS_POR_CHAT = config("TAXA_ENVIOS_POR_CHAT", default=1, cast=float)
+RAJADA_ENVIOS_POR_CHAT = config("RAJADA_ENVIOS_POR_CHAT", default=3, cast=int)
+MAX_TENTATIVAS_ENVIO = config("MAX_TENTATIVAS_ENVIO", default=5, cast=int)
+
+# Balde de tokens: libera `taxa` envios por segundo com rajadas de até `capacidade`
+class BaldeTokens:
+    def __init__(self, taxa, capacidade=1):
+        self.taxa = taxa
+        self.capacidade = max(1, capacidade)
+        self.tokens = float(self.capacidade)
+        self.atualizado = time.monotonic()
+        self.trava = asyncio.Lock()
+
+    def repor(self):
+        agora = time.monotonic()
+        self.tokens = min(self.capacidade, self.tokens + (agora - self.atualizado) * self.taxa)
+        self.atualizado = agora
+
+    def ocioso(self):
+        self.repor()
+        return self.tokens >= self.capacidade and not self.trava.locked()
+
+    async def adquirir(self):
+        async with self.trava:
+            self.repor()
+            while self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.taxa)
+                self.repor()
+            self.tokens -= 1
+
+# Camada de saída: todo envio/edição passa por aqui, respeitando os limites do Telegram,
+# aguardando o RetryAfter (429) e descartando edições substituídas por outra mais recente
+class AgendadorEnvios:
+    def __init__(self, taxa_global, taxa_por_chat, rajada_por_chat, max_tentativas):
+        self.bot = None
+        self.balde_global = BaldeTokens(taxa_global, capacidade=int(taxa_global))
+        self.baldes_chat = {}
+        self.taxa_por_chat = taxa_por_chat
+        self.rajada_por_chat = rajada_por_chat
+        self.max_tentativas = max_tentativas
+        self.pausado_ate = 0.0
+        self.edicoes_pendentes = {}
+        self.travas_edicao = {}
+
+    def configurar(self, bot):
+        self.bot = bot
+
+    def balde_chat(self, chat_id):
+        balde = self.baldes_chat.get(chat_id)
+        if balde is None:
+            if len(self.baldes_chat) > 10000:
+                self.baldes_chat = {chave: b for chave, b in self.baldes_chat.items() if not b.ocioso()}
+            balde = self.baldes_chat[chat_id] = BaldeTokens(self.taxa_por_chat, self.rajada_por_chat)
+        return balde
+
+    async def aguardar_vez(self, chat_id):
+        await self.balde_chat(chat_id).adquirir()
+        await self.balde_global.adquirir()
+        espera = self.pausado_ate - time.monotonic()
+        if espera > 0:
+            await asyncio.sleep(espera)
+
+    async def executar(self, chat_id, chamada, cancelada=None):
+        for tentativa in range(1, self.max_tentativas + 1):
+            await self.aguardar_vez(chat_id)
+            if cancelada and cancelada():
+                return None
+            try:
+                return await chamada()
+            except RetryAfter as e:
+                segundos = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+                self.pausado_ate = max(self.pausado_ate, time.monotonic() + segundos)
+                logger.warning(f"Flood control do Telegram no chat {chat_id}: aguardando {segundos}s (tentativa {tentativa})")
+                if tentativa == self.max_tentativas:
+                    raise
+
+    async def enviar_texto(self, chat_id, texto, **kwargs):
+        return await self.executar(chat_id, lambda: self.bot.send_message(chat_id=chat_id, text=texto, **kwargs))
+
+    async def enviar_documento(self, chat_id, documento, **kwargs):
+        async def chamada():
+            if hasattr(documento, "seek"):
+                documento.seek(0)
+            return await self.bot.send_document(chat_id=chat_id, document=documento, **kwargs)
+        return await self.executar(chat_id, chamada)
+
+    async def enviar_foto(self, chat_id, foto, **kwargs):
+        async def chamada():
+            if hasattr(foto, "seek"):
+                foto.seek(0)
+            return await self.bot.send_photo(chat_id=chat_id, photo=foto, **kwargs)
+        return await self.executar(chat_id, chamada)
+
+    async def editar_texto(self, chat_id, message_id, texto, **kwargs):
+        # Edições da mesma mensagem são serializadas; enquanto uma está em andamento,
+        # apenas a última que chegar é enviada em seguida e as intermediárias são descartadas
+        chave = (chat_id, message_id)
+        marcador = object()
+        self.edicoes_pendentes[chave] = marcador
+        trava = self.travas_edicao.setdefault(chave, asyncio.Lock())
+        try:
+            async with trava:
+                substituida = lambda: self.edicoes_pendentes.get(chave) is not marcador
+                if substituida():
+                    return None
+                try:
+                    return await self.executar(
+                        chat_id,
+                        lambda: self.bot.edit_message_text(text=texto, chat_id=chat_id, message_id=message_id, **kwargs),
+                        cancelada=substituida
+                    )
+                except BadRequest as e:
+                    if "not modified" in str(e).lower():
+                        return None
+                    raise
+        finally:
+            if self.edicoes_pendentes.get(chave) is marcador:
+                del self.edicoes_pendentes[chave]
+                del self.travas_edicao[chave]
+
+agendador_envios = AgendadorEnvios(TAXA_GLOBAL_ENVIOS, TAXA_ENVIOS_POR_CHAT, RAJADA_ENVIOS_POR_CHAT, MAX_TENTATIVAS_ENVIO)
+
+# Periodicidades dos gastos fixos (gravadas como sufixo na categoria)
+PERIODICIDADES = ["DIÁRIO", "SEMANAL", "MENSAL"]
+SUFIXO_GASTO_FIXO = re.compile(r"\((DI[AÁ]RIO|SEMANAL|MENSAL)\)")
+
+# Função para identificar se um gasto é fixo pela categoria
+def eh_gasto_fixo(categoria):
+    return SUFIXO_GASTO_FIXO.search(categoria) is not None
+
+# Teclados estáticos: montados uma única vez (InlineKeyboardMarkup é imutável)
+BOTAO_VOLTAR = InlineKeyboardButton("Voltar", callback_data="voltar")
+TECLADO_VOLTAR = InlineKeyboardMarkup([[BOTAO_VOLTAR]])
+
+def montar_teclado(opcoes, colunas=1, voltar=True):
+    linhas = [
+        [InlineKeyboardButton(rotulo, callback_data=dados) for rotulo, dados in opcoes[i:i + colunas]]
+        for i in range(0, len(opcoes), colunas)
+    ]
+    if voltar:
+        linhas.append([BOTAO_VOLTAR])
+    return InlineKeyboardMarkup(linhas)
+
+CATEGORIAS = ["Alimentação", "Lazer", "Transporte", "Saúde", "Outros"]
+FORMAS_PAGAMENTO = ["Cartão de Crédito", "Cartão de Débito", "Pix", "Dinheiro"]
+
+# Teclado de categorias: as mais usadas pelo usuário primeiro, completadas pelas categorias padrão
+# (nomes que não cabem nos 64 bytes do callback_data ficam de fora)
+def teclado_categorias(acao, frequentes=()):
+    nomes = list(frequentes)
+    chaves = {chave_categoria(nome) for nome in nomes}
+    nomes += [cat for cat in CATEGORIAS if chave_categoria(cat) not in chaves][:max(len(CATEGORIAS), CATEGORIAS_TECLADO) - len(nomes)]
+    opcoes = [(nome, f"{acao}:{nome}") for nome in nomes if len(f"{acao}:{nome}".encode()) <= 64]
+    opcoes.append(("Escrever Categoria", f"{acao}_texto"))
+    return montar_teclado(opcoes, colunas=2)
+
+def teclado_formas_pagamento(acao):
+    return montar_teclado([(fp, f"{acao}:{fp}") for fp in FORMAS_PAGAMENTO], colunas=2)
+
+TECLADO_RESUMO = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("⬅️ Anterior", callback_data="resumo_prev"),
+        BOTAO_VOLTAR,
+        InlineKeyboardButton("Próximo ➡️", callback_data="resumo_next")
+    ],
+    [
+        InlineKeyboardButton("📅 PERÍODO", callback_data="resumo_periodos"),
+        InlineKeyboardButton("📊 VER GRÁFICO", callback_data="resumo_grafico")
+    ]
+])
+
+TECLADO_EXCEL = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("⬅️ Anterior", callback_data="excel_prev"),
+        InlineKeyboardButton("Gerar Planilha", callback_data="excel_gerar"),
+        InlineKeyboardButton("Próximo ➡️", callback_data="excel_next")
+    ],
+    [InlineKeyboardButton("📅 PERÍODO", callback_data="excel_periodos")],
+    [BOTAO_VOLTAR]
+])
+
+# Teclado de escolha do período do resumo ou da planilha (destino: "resumo" ou "excel")
+# Telas que guardam um período selecionado (EstadoConversa.periodo_<destino>)
+DESTINOS_PERIODO = ("resumo", "excel")
+
+def teclado_periodos(destino):
+    return montar_teclado([
+        ("MÊS ATUAL", f"periodo:{destino}:mes"),
+        ("TRIMESTRE ATUAL", f"periodo:{destino}:trimestre"),
+        ("ANO ATÉ HOJE", f"periodo:{destino}:ano_ate_hoje"),
+        ("ANO ANTERIOR COMPLETO", f"periodo:{destino}:ano"),
+        ("PERSONALIZADO", f"periodo:{destino}:personalizado")
+    ], colunas=2)
+
+TECLADO_CONFIRMAR_REMOCAO = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("SIM", callback_data="confirmar_remover:sim"),
+        InlineKeyboardButton("NÃO", callback_data="confirmar_remover:nao")
+    ],
+    [BOTAO_VOLTAR]
+])
+
+# Telas estáticas: texto, teclado e o estado do fluxo de texto que a tela ativa
+class Tela(NamedTuple):
+    texto: str
+    teclado: InlineKeyboardMarkup
+    estado: Optional[str] = None
+
+TELAS = {
+    "start": Tela("Escolha uma opção:", montar_teclado([
+        ("GASTO", "start_gasto"),
+        ("VALOR RECEBIDO", "start_entrada"),
+        ("RESUMO", "start_resumo"),
+        ("TENDÊNCIAS", "start_tendencias"),
+        ("BUSCAR", "start_buscar"),
+        ("PLANILHA EXCEL", "start_excel"),
+        ("POWER BI", "start_powerbi")
+    ], voltar=False)),
+    "start_gasto": Tela("Escolha o tipo de gasto:", montar_teclado([
+        ("GASTO NORMAL", "gasto_normal"),
+        ("GASTO FIXO", "gasto_fixo")
+    ])),
+    "start_entrada": Tela("Escolha uma ação para Valor Recebido:", montar_teclado([
+        ("ADICIONAR VALOR RECEBIDO", "entrada_adicionar"),
+        ("EDITAR VALOR RECEBIDO", "editar_entrada"),
+        ("REMOVER VALOR RECEBIDO", "remover_entrada")
+    ])),
+    "gasto_normal": Tela("Escolha uma ação para Gasto Normal:", montar_teclado([
+        ("ADICIONAR GASTO NORMAL", "gasto_normal_adicionar"),
+        ("EDITAR GASTO NORMAL", "editar_gasto"),
+        ("REMOVER GASTO NORMAL", "remover_gasto_normal"),
+        ("DEFINIR LIMITE DE GASTO", "definir_limite"),
+        ("DEFINIR LIMITE POR CATEGORIA", "definir_limite_categoria")
+    ])),
+    "gasto_fixo": Tela("Escolha uma ação para Gasto Fixo:", montar_teclado([
+        ("ADICIONAR GASTO FIXO", "gasto_fixo_adicionar"),
+        ("EDITAR GASTO FIXO", "editar_gasto_fixo"),
+        ("REMOVER GASTO FIXO", "remover_gasto_fixo")
+    ])),
+    "gasto_normal_adicionar": Tela("Por favor, insira o valor que você gastou (ex.: 100):", TECLADO_VOLTAR, 'awaiting_gasto_valor'),
+    "gasto_categoria_texto": Tela("Por favor, escreva a categoria personalizada:", TECLADO_VOLTAR, 'awaiting_gasto_categoria'),
+    "gasto_forma": Tela("Escolha a forma de pagamento:", teclado_formas_pagamento("gasto_forma"), 'awaiting_gasto_forma'),
+    "gasto_fixo_adicionar": Tela("Escolha a periodicidade do gasto fixo:", montar_teclado(
+        [(p, f"gasto_fixo_periodicidade:{p}") for p in PERIODICIDADES]
+    )),
+    "gasto_fixo_categoria_texto": Tela("Por favor, escreva a categoria personalizada para o gasto fixo:", TECLADO_VOLTAR, 'awaiting_gasto_fixo_categoria'),
+    "gasto_fixo_forma": Tela("Escolha a forma de pagamento do gasto fixo:", teclado_formas_pagamento("gasto_fixo_forma"), 'awaiting_gasto_fixo_forma'),
+    "entrada_adicionar": Tela("Por favor, insira o valor da entrada (ex.: 100) e a descrição (ex.: 'Salário'):", TECLADO_VOLTAR, 'awaiting_entrada'),
+    "definir_limite": Tela("Por favor, insira o valor do limite (ex.: 1000):", TECLADO_VOLTAR, 'awaiting_definirlimite'),
+    "definir_limite_categoria": Tela("Por favor, insira o valor do limite e a categoria (ex.: 500 Lazer):", TECLADO_VOLTAR, 'awaiting_limite_categoria'),
+    "editar_gasto_dados": Tela("Insira o novo valor (opcional), categoria (opcional) e forma de pagamento (opcional), separados por espaço (ex.: 200 Alimentação Cartão):", TECLADO_VOLTAR, 'awaiting_editar_dados_gasto'),
+    "resumo_periodos": Tela("Escolha o período do resumo:", teclado_periodos("resumo")),
+    "excel_periodos": Tela("Escolha o período da planilha:", teclado_periodos("excel")),
+    "buscar": Tela("O que você procura? Escreva parte da categoria ou da descrição e, se quiser, filtros de valor "
+                   "e data (ex.: mercado >50 <200 de:01/01/2024 ate:31/03/2024):", TECLADO_VOLTAR, 'awaiting_busca'),
+    "periodo_personalizado": Tela("Insira o período desejado: as datas de início e fim (ex.: 01/01/2024 31/03/2024), "
+                                  "um mês (ex.: 10/2024), um trimestre (ex.: T3 2024) ou um ano (ex.: 2024):",
+                                  TECLADO_VOLTAR, 'awaiting_periodo'),
+    "restaurar": Tela("Envie o arquivo .jsonl.gz gerado pelo /backup. Os registros que já estiverem na sua conta não serão duplicados.",
+                      TECLADO_VOLTAR, 'awaiting_backup'),
+    "editar_entrada_dados": Tela("Insira o novo valor (opcional) e descrição (opcional), separados por espaço (ex.: 200 Salário):", TECLADO_VOLTAR, 'awaiting_editar_dados_entrada'),
+}
+
+# Listagens de edição/remoção: tipo de item, ação de cada botão e mensagens
+class Listagem(NamedTuple):
+    tipo: str
+    acao_item: str
+    titulo: str
+    vazio: str
+    erro: str
+
+LISTAGENS = {
+    "editar_gasto": Listagem("gasto_normal", "editar_gasto_select", "Selecione o gasto normal para editar:",
+                             "Nenhum gasto normal registrado para editar.", "Erro ao carregar os gastos para edição."),
+    "editar_gasto_fixo": Listagem("gasto_fixo", "editar_gasto_select", "Selecione o gasto fixo para editar:",
+                                  "Nenhum gasto fixo registrado para editar.", "Erro ao carregar os gastos fixos para edição."),
+    "editar_entrada": Listagem("entrada", "editar_entrada_select", "Selecione o valor recebido para editar:",
+                               "Nenhum valor recebido registrado para editar.", "Erro ao carregar os valores recebidos para edição."),
+    "remover_gasto_normal": Listagem("gasto_normal", "remover_gasto_normal_select", "Selecione o gasto normal para remover:",
+                                     "Nenhum gasto normal registrado para remover.", "Erro ao carregar os gastos normais para remoção."),
+    "remover_gasto_fixo": Listagem("gasto_fixo", "remover_gasto_fixo_select", "Selecione o gasto fixo para remover:",
+                                   "Nenhum gasto fixo registrado para remover.", "Erro ao carregar os gastos fixos para remoção."),
+    "remover_entrada": Listagem("entrada", "remover_entrada_select", "Selecione o valor recebido para remover:",
+                                "Nenhum valor recebido registrado para remover.", "Erro ao carregar os valores recebidos para remoção."),
+}
+
+DESCRICAO_ITEM = {"gasto_normal": "o gasto normal", "gasto_fixo": "o gasto fixo", "entrada": "a entrada"}
+
+# Função para listar os itens do mês atual de um tipo como (id, rótulo)
+def carregar_itens(usuario, tipo):
+    mes, ano = datetime.now().month, datetime.now().year
+    if tipo == "entrada":
+        return [
+            (entrada[0], f"ID {entrada[0]} - {formatar_reais(em_centavos(entrada[1]))} - {entrada[2]}")
+            for entrada in listar_entradas_mensais(usuario, mes, ano)
+        ]
+    fixo = tipo == "gasto_fixo"
+    return [
+        (gasto[0], f"ID {gasto[0]} - {formatar_reais(em_centavos(gasto[1]))} - {gasto[2]} - {gasto[3]}")
+        for gasto in listar_gastos_mensais(usuario, mes, ano)
+        if eh_gasto_fixo(gasto[2]) == fixo
+    ]
+
+# Função para obter o chat de um update (mensagem ou callback)
+def obter_usuario(update: Update):
+    return str(update.effective_chat.id)
+
+# Chave de idempotência das escritas: uma reentrega do mesmo update gera a mesma chave
+def chave_idempotencia(update: Update):
+    return f"{update.effective_chat.id}:{update.update_id}"
+
+# Deduplicação de updates: o Telegram reenvia o webhook quando a resposta demora (cold start do
+# Neon, geração da planilha), e o mesmo update_id chegaria duas vezes aos handlers. Os ids
+# recentes ficam em um anel em memória; com DEDUP_PERSISTIDO eles também são gravados no banco
+# por DEDUP_JANELA_HORAS, cobrindo reinicializações e mais de uma instância
+DEDUP_TAMANHO = config("DEDUP_TAMANHO", default=10000, cast=int)
+DEDUP_PERSISTIDO = config("DEDUP_PERSISTIDO", default=False, cast=bool)
+DEDUP_JANELA_HORAS = config("DEDUP_JANELA_HORAS", default=48, cast=int)
+
+class FiltroUpdatesDuplicados:
+    def __init__(self, tamanho):
+        self.ordem = deque(maxlen=tamanho)
+        self.vistos = set()
+
+    # Registra o update_id; False se ele já foi visto
+    def registrar(self, update_id):
+        if update_id in self.vistos:
+            return False
+        if len(self.ordem) == self.ordem.maxlen:
+            self.vistos.discard(self.ordem[0])
+        self.ordem.append(update_id)
+        self.vistos.add(update_id)
+        return True
+
+filtro_updates = FiltroUpdatesDuplicados(DEDUP_TAMANHO)
+
+# Handler do grupo -1, executado antes de todos os outros: interrompe o processamento de um
+# update já visto. Se o banco falhar, o update segue (melhor processar do que perder)
+async def descartar_updates_duplicados(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not filtro_updates.registrar(update.update_id):
+        logger.info(f"Update {update.update_id} repetido descartado")
+        raise ApplicationHandlerStop
+    if DEDUP_PERSISTIDO:
+        try:
+            novo = repositorio.registrar_update(update.update_id)
+        except Exception as e:
+            logger.error(f"Erro ao registrar o update {update.update_id}: {e}")
+            return
+        if not novo:
+            logger.info(f"Update {update.update_id} já processado (registro persistido) descartado")
+            raise ApplicationHandlerStop
+
+# Job para remover do banco os update_ids fora da janela de deduplicação
+async def podar_updates_processados(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        removidos = repositorio.podar_updates(DEDUP_JANELA_HORAS)
+        logger.info(f"{removidos} registros de updates processados removidos")
+    except Exception as e:
+        logger.error(f"Erro ao podar os updates processados: {e}")
+
+# Perfilamento sob demanda: /perfil ROTA [cprofile|tracemalloc] [N] (só para ADMIN_IDS) liga a
+# captura nas próximas N execuções da rota — o prefixo do callback (start_excel, resumo_prev), o
+# comando (/resumo) ou o estado do fluxo de texto (awaiting_gasto_valor). Cada execução gera um
+# arquivo em PERFIL_DIRETORIO e um resumo no chat do admin. PERFIL_ROTA/PERFIL_MODO/PERFIL_UPDATES
+# ligam a mesma captura na inicialização, sem precisar do comando
+ADMIN_IDS = config("ADMIN_IDS", default="", cast=Csv())
+PERFIL_DIRETORIO = config("PERFIL_DIRETORIO", default="perfis")
+PERFIL_TOPO = config("PERFIL_TOPO", default=15, cast=int)
+PERFIL_ROTA = config("PERFIL_ROTA", default="")
+PERFIL_MODO = config("PERFIL_MODO", default="cprofile")
+PERFIL_UPDATES = config("PERFIL_UPDATES", default=5, cast=int)
+MODOS_PERFIL = ("cprofile", "tracemalloc")
+
+class Captura(NamedTuple):
+    modo: str
+    restantes: int
+    chat_admin: Optional[str]
+
+class PerfiladorRotas:
+    def __init__(self):
+        self.capturas = {}
+        self.em_andamento = False
+
+    def ativar(self, rota, modo, quantidade, chat_admin=None):
+        self.capturas[rota] = Captura(modo, quantidade, chat_admin)
+
+    def desativar(self, rota=None):
+        if rota is None:
+            self.capturas.clear()
+        else:
+            self.capturas.pop(rota, None)
+
+    # Executa a corrotina do handler, perfilando-a se a rota estiver marcada. Uma captura por vez:
+    # o cProfile é global ao interpretador, então um update concorrente da mesma rota roda sem
+    # perfil e não conta. O cProfile vê só a thread do event loop (o que roda em executor aparece
+    # como espera); o tracemalloc conta as alocações de todas as threads
+    async def executar(self, rota, update: Update, corrotina):
+        captura = self.capturas.get(rota)
+        if captura is None or self.em_andamento:
+            await corrotina
+            return
+        self.em_andamento = True
+        self.capturas[rota] = captura._replace(restantes=captura.restantes - 1)
+        if captura.restantes <= 1:
+            del self.capturas[rota]
+        perfil = None
+        tracemalloc_ativo = tracemalloc.is_tracing()
+        if captura.modo == "cprofile":
+            perfil = cProfile.Profile()
+            perfil.enable()
+        else:
+            if not tracemalloc_ativo:
+                tracemalloc.start()
+            antes = tracemalloc.take_snapshot()
+        inicio = time.perf_counter()
+        try:
+            await corrotina
+        finally:
+            duracao = time.perf_counter() - inicio
+            try:
+                if perfil is not None:
+                    perfil.disable()
+                    relatorio = self.salvar_cprofile(rota, update, perfil)
+                else:
+                    depois = tracemalloc.take_snapshot()
+                    if not tracemalloc_ativo:
+                        tracemalloc.stop()
+                    relatorio = self.salvar_tracemalloc(rota, update, antes, depois)
+                await self.relatar(rota, captura, duracao, relatorio)
+            except Exception as e:
+                logger.error(f"Erro ao salvar o perfil da rota {rota}: {e}")
+            finally:
+                self.em_andamento = False
+
+    def caminho(self, rota, update: Update, extensao):
+        os.makedirs(PERFIL_DIRETORIO, exist_ok=True)
+        nome = re.sub(r"\W", "_", rota)
+        return os.path.join(PERFIL_DIRETORIO, f"{nome}_{datetime.now():%Y%m%d_%H%M%S}_{update.update_id}.{extensao}")
+
+    # Arquivo .prof (pstats/snakeviz) e as funções com maior tempo acumulado
+    def salvar_cprofile(self, rota, update: Update, perfil):
+        arquivo = self.caminho(rota, update, "prof")
+        perfil.dump_stats(arquivo)
+        saida = StringIO()
+        pstats.Stats(perfil, stream=saida).strip_dirs().sort_stats("cumulative").print_stats(PERFIL_TOPO)
+        linhas = saida.getvalue().splitlines()
+        inicio_tabela = next((i for i, linha in enumerate(linhas) if linha.lstrip().startswith("ncalls")), 0)
+        return arquivo, "\n".join(linha for linha in linhas[inicio_tabela:] if linha.strip())
+
+    # Diferença entre os snapshots antes e depois, por linha, sem as alocações do próprio tracemalloc
+    def salvar_tracemalloc(self, rota, update: Update, antes, depois):
+        filtros = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, "<frozen importlib._bootstrap*>")]
+        diferencas = depois.filter_traces(filtros).compare_to(antes.filter_traces(filtros), "lineno")
+        arquivo = self.caminho(rota, update, "txt")
+        with open(arquivo, "w", encoding="utf-8") as saida:
+            saida.write("\n".join(str(diferenca) for diferenca in diferencas))
+        return arquivo, "\n".join(str(diferenca) for diferenca in diferencas[:PERFIL_TOPO])
+
+    async def relatar(self, rota, captura: Captura, duracao, relatorio):
+        arquivo, topo = relatorio
+        logger.info(f"Perfil da rota {rota} ({captura.modo}, {duracao * 1000:.0f} ms) salvo em {arquivo}")
+        if captura.chat_admin is None:
+            return
+        cabecalho = (
+            f"Perfil de {rota} ({captura.modo}): {duracao * 1000:.0f} ms, salvo em {arquivo}. "
+            f"Restam {captura.restantes - 1} captura(s)."
+        )
+        # Limite de 4096 caracteres por mensagem do Telegram
+        await agendador_envios.enviar_texto(
+            captura.chat_admin, f"{escape(cabecalho)}\n<pre>{escape(topo[:3500])}</pre>", parse_mode="HTML"
+        )
+
+perfilador = PerfiladorRotas()
+if PERFIL_ROTA and PERFIL_MODO in MODOS_PERFIL:
+    perfilador.ativar(PERFIL_ROTA, PERFIL_MODO, PERFIL_UPDATES, ADMIN_IDS[0] if ADMIN_IDS else None)
+
+# Função para envolver um handler de comando ou de texto no perfilador; a rota pode ser fixa ou
+# calculada a partir do update (o estado do fluxo de texto)
+def perfilado(rota, handler):
+    @functools.wraps(handler)
+    async def executar(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        nome = rota(update, context) if callable(rota) else rota
+        await perfilador.executar(nome, update, handler(update, context))
+    return executar
+
+def estado_fluxo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    return estado_conversa(update).estado or "texto"
+
+# Comando /perfil (admin): /perfil ROTA [cprofile|tracemalloc] [N], /perfil off [ROTA] ou /perfil para ver as capturas
+async def perfil(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if str(update.effective_user.id) not in ADMIN_IDS:
+        return
+    chat = str(update.effective_chat.id)
+    args = context.args
+    if not args:
+        ativas = "\n".join(f"{rota}: {c.modo}, {c.restantes} restante(s)" for rota, c in perfilador.capturas.items())
+        await responder(update, ativas or "Nenhuma captura ativa. Use: /perfil ROTA [cprofile|tracemalloc] [N].")
+        return
+    if args[0] == "off":
+        perfilador.desativar(args[1] if len(args) > 1 else None)
+        await responder(update, "Captura desativada.")
+        return
+    rota = args[0]
+    modo = args[1] if len(args) > 1 else "cprofile"
+    try:
+        quantidade = int(args[2]) if len(args) > 2 else 1
+    except ValueError:
+        quantidade = 0
+    if modo not in MODOS_PERFIL or quantidade <= 0:
+        await responder(update, "Uso: /perfil ROTA [cprofile|tracemalloc] [N], com N positivo.")
+        return
+    perfilador.ativar(rota, modo, quantidade, chat)
+    await responder(update, f"Capturando {modo} nas próximas {quantidade} execução(ões) de {rota}.")
+
+# Função para exibir uma tela: edita a mensagem do botão ou responde à mensagem de texto
+async def exibir(update: Update, texto, reply_markup=None, parse_mode=None):
+    if update.callback_query:
+        await agendador_envios.editar_texto(update.effective_chat.id, update.callback_query.message.message_id, texto, reply_markup=reply_markup, parse_mode=parse_mode)
+    else:
+        await responder(update, texto, reply_markup, parse_mode)
+
+# Função para enviar uma nova mensagem no chat do update
+async def responder(update: Update, texto, reply_markup=None, parse_mode=None):
+    await agendador_envios.enviar_texto(update.effective_chat.id, texto, reply_markup=reply_markup, parse_mode=parse_mode)
+
+# Painel operacional: contadores em memória incrementados pelos handlers (updates, chats ativos,
+# escritas, exportações, updates com erro) e descarregados a cada METRICAS_INTERVALO_SEGUNDOS na
+# tabela metricas_diarias. O /stats (admin) e o endpoint JSON em METRICAS_PORTA leem só essa tabela
+# e os contadores ainda não descarregados, nunca gastos/entradas
+METRICAS_INTERVALO_SEGUNDOS = config("METRICAS_INTERVALO_SEGUNDOS", default=60, cast=int)
+METRICAS_DIAS = config("METRICAS_DIAS", default=7, cast=int)
+METRICAS_PORTA = config("METRICAS_PORTA", default=0, cast=int)
+METRICAS_TOKEN = config("METRICAS_TOKEN", default="")
+COLUNAS_PAINEL = [
+    ("usuarios_ativos", "Usuár."), ("updates", "Updates"), ("gastos", "Gastos"), ("entradas", "Entr."),
+    ("exportacoes", "Export."), ("updates_com_erro", "Erros"),
+]
+METRICAS_EXPORTACAO = ("planilhas", "graficos", "links_powerbi")
+
+class MetricasOperacionais:
+    def __init__(self):
+        self.iniciado_em = time.time()
+        self.pendentes = Counter()
+        self.usuarios_pendentes = {}
+        self.dia = None
+        self.usuarios_do_dia = set()
+        self.desde_inicio = Counter()
+
+    def hoje(self):
+        return datetime.now(FUSO_HORARIO).date()
+
+    def incrementar(self, metrica, quantidade=1):
+        self.pendentes[(self.hoje(), metrica)] += quantidade
+        self.desde_inicio[metrica] += quantidade
+
+    # Cada chat entra uma vez por dia na fila de gravação; o banco descarta os já contados
+    # (por exemplo, antes de uma reinicialização)
+    def registrar_usuario(self, usuario):
+        dia = self.hoje()
+        if dia != self.dia:
+            self.dia = dia
+            self.usuarios_do_dia = set()
+        if usuario not in self.usuarios_do_dia:
+            self.usuarios_do_dia.add(usuario)
+            self.usuarios_pendentes.setdefault(dia, set()).add(usuario)
+
+    # Grava os incrementos acumulados; se o banco falhar, eles voltam para a próxima tentativa
+    def descarregar(self):
+        incrementos, self.pendentes = self.pendentes, Counter()
+        usuarios, self.usuarios_pendentes = self.usuarios_pendentes, {}
+        if not incrementos and not usuarios:
+            return
+        try:
+            repositorio.registrar_metricas(incrementos, usuarios)
+        except Exception:
+            self.pendentes.update(incrementos)
+            for dia, chats in usuarios.items():
+                self.usuarios_pendentes.setdefault(dia, set()).update(chats)
+            raise
+
+metricas = MetricasOperacionais()
+
+# Marcador do update em processamento na tarefa atual: um erro registrado no log durante o update
+# conta uma vez em "updates_com_erro"; fora de um update (jobs), cada erro conta em "erros_jobs"
+update_em_andamento = contextvars.ContextVar("update_em_andamento", default=None)
+
+class ContadorErros(logging.Handler):
+    def emit(self, record):
+        marcador = update_em_andamento.get()
+        if marcador is None:
+            metricas.incrementar("erros_jobs")
+        elif not marcador["erro"]:
+            marcador["erro"] = True
+            metricas.incrementar("updates_com_erro")
+
+logger.addHandler(ContadorErros(logging.ERROR))
+
+# Handler do grupo -2, antes da deduplicação: conta o update e o chat
+async def registrar_update_metricas(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    update_em_andamento.set({"erro": False})
+    metricas.incrementar("updates")
+    aquecimento.registrar_atividade()
+    if update.effective_chat is not None:
+        metricas.registrar_usuario(obter_usuario(update))
+
+# Erros não tratados pelos handlers: ficam no log (e, por ele, no contador)
+async def registrar_erro(update: object, context: ContextTypes.DEFAULT_TYPE):
+    logger.error(f"Erro não tratado ao processar um update: {context.error}")
+    if isinstance(context.error, BancoIndisponivel) and isinstance(update, Update) and update.effective_message:
+        await responder(update, MENSAGEM_BANCO_INDISPONIVEL, TECLADO_VOLTAR)
+
+# Job do aquecimento do banco (ver PoliticaAquecimento)
+async def manter_banco_aquecido(context: ContextTypes.DEFAULT_TYPE):
+    if not aquecimento.deve_pingar():
+        return
+    try:
+        await asyncio.to_thread(pool_primario.pingar)
+    except psycopg2.Error as e:
+        logger.warning(f"Ping de aquecimento do banco falhou: {e}")
+
+# Job que grava os contadores pendentes
+async def descarregar_metricas(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        metricas.descarregar()
+    except Exception as e:
+        logger.error(f"Erro ao gravar as métricas operacionais: {e}")
+
+# Função para montar o painel: um dicionário por dia (gravado + pendente em memória), do mais recente
+def painel_operacional(dias=METRICAS_DIAS):
+    hoje = metricas.hoje()
+    por_dia = {hoje - timedelta(days=n): Counter() for n in range(dias)}
+    try:
+        for dia, metrica, valor in repositorio.obter_metricas(hoje - timedelta(days=dias - 1)):
+            por_dia.setdefault(dia, Counter())[metrica] += valor
+    except Exception as e:
+        logger.error(f"Erro ao ler as métricas operacionais: {e}")
         raise
+    for (dia, metrica), valor in metricas.pendentes.items():
+        if dia in por_dia:
+            por_dia[dia][metrica] += valor
+    for dia, chats in metricas.usuarios_pendentes.items():
+        if dia in por_dia:
+            por_dia[dia]["usuarios_ativos"] += len(chats)
+    linhas = []
+    for dia in sorted(por_dia, reverse=True):
+        contadores = por_dia[dia]
+        contadores["exportacoes"] = sum(contadores[metrica] for metrica in METRICAS_EXPORTACAO)
+        linhas.append({
+            "dia": dia.isoformat(),
+            **contadores,
+            "taxa_erros": round(contadores["updates_com_erro"] / contadores["updates"], 4) if contadores["updates"] else 0.0,
+        })
+    return {
+        "gerado_em": datetime.now(FUSO_HORARIO).isoformat(timespec="seconds"),
+        "iniciado_em": datetime.fromtimestamp(metricas.iniciado_em, FUSO_HORARIO).isoformat(timespec="seconds"),
+        "desde_inicio": dict(metricas.desde_inicio),
+        "chats_em_memoria": len(estados_conversa.conversas),
+        "dias": linhas,
+    }
+
+def formatar_painel(painel):
+    texto = f"📊 Operação dos últimos {len(painel['dias'])} dias (iniciado em {painel['iniciado_em']})\n"
+    cabecalho = f"{'Dia':<5}" + "".join(f"{rotulo:>8}" for _, rotulo in COLUNAS_PAINEL)
+    linhas = [
+        f"{date.fromisoformat(dia['dia']):%d/%m}" + "".join(f"{dia.get(metrica, 0):>8}" for metrica, _ in COLUNAS_PAINEL)
+        for dia in painel["dias"]
+    ]
+    hoje = painel["dias"][0]
+    return (
+        texto + f"<pre>{cabecalho}\n" + "\n".join(linhas) + "</pre>\n"
+        f"Hoje: {hoje.get('planilhas', 0)} planilhas, {hoje.get('graficos', 0)} gráficos, {hoje.get('links_powerbi', 0)} links do Power BI, "
+        f"{hoje.get('edicoes', 0)} edições, {hoje.get('remocoes', 0)} remoções, {hoje.get('erros_jobs', 0)} erros em jobs; "
+        f"taxa de erros {hoje['taxa_erros']:.1%}. Chats em memória: {painel['chats_em_memoria']}."
+    )
+
+# Comando /stats (admin)
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if str(update.effective_user.id) not in ADMIN_IDS:
+        return
+    try:
+        await responder(update, formatar_painel(painel_operacional()), parse_mode="HTML")
+    except Exception:
+        await responder(update, "Erro ao montar o painel.")
+
+# Endpoint GET /stats com o mesmo painel em JSON (Authorization: Bearer METRICAS_TOKEN)
+class PainelHandler(tornado.web.RequestHandler):
+    def get(self):
+        if not METRICAS_TOKEN or self.request.headers.get("Authorization") != f"Bearer {METRICAS_TOKEN}":
+            raise tornado.web.HTTPError(401)
+        self.set_header("Content-Type", "application/json; charset=utf-8")
+        self.write(json.dumps(painel_operacional(), ensure_ascii=False))
+
+# Estado da conversa de cada chat (tela atual, pilha do "Voltar", dados do fluxo em andamento),
+# em objetos com __slots__ no lugar de chaves soltas no user_data, que nunca eram apagadas. A pilha
+# tem profundidade máxima (as telas mais antigas saem primeiro); o estado de um chat parado há
+# ESTADO_TTL_MINUTOS é descartado, assim como o dos menos recentes além de ESTADO_MAXIMO_CHATS
+NAVEGACAO_PROFUNDIDADE = config("NAVEGACAO_PROFUNDIDADE", default=15, cast=int)
+ESTADO_TTL_MINUTOS = config("ESTADO_TTL_MINUTOS", default=60, cast=int)
+ESTADO_MAXIMO_CHATS = config("ESTADO_MAXIMO_CHATS", default=10000, cast=int)
+
+# Os valores dos fluxos ficam em centavos (ler_centavos)
+class FluxoGasto:
+    __slots__ = ("valor", "categoria")
+
+    def __init__(self, valor):
+        self.valor = valor
+        self.categoria = None
+
+class FluxoGastoFixo:
+    __slots__ = ("periodicidade", "valor", "categoria")
+
+    def __init__(self, periodicidade):
+        self.periodicidade = periodicidade
+        self.valor = None
+        self.categoria = None
+
+class FluxoEdicao:
+    __slots__ = ("item_id",)
+
+    def __init__(self, item_id):
+        self.item_id = item_id
+
+class FluxoRemocao:
+    __slots__ = ("tipo", "item_id")
+
+    def __init__(self, tipo, item_id):
+        self.tipo = tipo
+        self.item_id = item_id
+
+# Busca atual; os rótulos dos resultados exibidos servem à confirmação de remoção
+class Busca:
+    __slots__ = ("termo", "filtros", "pagina", "rotulos")
+
+    def __init__(self, termo, filtros, pagina=0):
+        self.termo = termo
+        self.filtros = filtros
+        self.pagina = pagina
+        self.rotulos = {}
+
+class EstadoConversa:
+    __slots__ = ("estado", "tela_atual", "pilha", "fluxo", "busca", "periodo_resumo", "periodo_excel", "periodo_destino", "acesso")
+
+    def __init__(self):
+        self.estado = None
+        self.tela_atual = None
+        self.pilha = deque(maxlen=NAVEGACAO_PROFUNDIDADE)
+        self.fluxo = None
+        self.busca = None
+        self.periodo_resumo = None
+        self.periodo_excel = None
+        self.periodo_destino = "resumo"
+        self.acesso = 0.0
+
+# Função para estimar a memória de um objeto e do que ele referencia (slots, coleções)
+def tamanho_memoria(objeto, vistos=None):
+    vistos = set() if vistos is None else vistos
+    if id(objeto) in vistos:
+        return 0
+    vistos.add(id(objeto))
+    tamanho = sys.getsizeof(objeto)
+    if isinstance(objeto, dict):
+        tamanho += sum(tamanho_memoria(chave, vistos) + tamanho_memoria(valor, vistos) for chave, valor in objeto.items())
+    elif isinstance(objeto, (list, tuple, set, frozenset, deque)):
+        tamanho += sum(tamanho_memoria(item, vistos) for item in objeto)
+    elif hasattr(type(objeto), "__slots__"):
+        tamanho += sum(tamanho_memoria(getattr(objeto, atributo, None), vistos) for atributo in type(objeto).__slots__)
+    return tamanho
+
+# Estados por chat em ordem de acesso (o menos recente primeiro), o que torna a expiração por TTL
+# e o descarte por excesso de chats uma remoção pelo início do OrderedDict
+class GerenciadorEstados:
+    def __init__(self, ttl_segundos, maximo_chats):
+        self.ttl_segundos = ttl_segundos
+        self.maximo_chats = maximo_chats
+        self.conversas = OrderedDict()
+        self.descartados = 0
+
+    def obter(self, chat):
+        agora = time.monotonic()
+        self.podar(agora)
+        conversa = self.conversas.get(chat)
+        if conversa is None:
+            conversa = self.conversas[chat] = EstadoConversa()
+            while len(self.conversas) > self.maximo_chats:
+                self.conversas.popitem(last=False)
+                self.descartados += 1
+        else:
+            self.conversas.move_to_end(chat)
+        conversa.acesso = agora
+        return conversa
+
+    def podar(self, agora=None):
+        agora = time.monotonic() if agora is None else agora
+        while self.conversas:
+            chat, conversa = next(iter(self.conversas.items()))
+            if agora - conversa.acesso < self.ttl_segundos:
+                break
+            del self.conversas[chat]
+            self.descartados += 1
+
+    # [(chat, bytes, segundos parado, tela atual)], do maior para o menor
+    def estatisticas(self):
+        self.podar()
+        agora = time.monotonic()
+        return sorted(
+            ((chat, tamanho_memoria(conversa), agora - conversa.acesso, conversa.tela_atual) for chat, conversa in self.conversas.items()),
+            key=lambda linha: linha[1], reverse=True,
+        )
+
+estados_conversa = GerenciadorEstados(ESTADO_TTL_MINUTOS * 60, ESTADO_MAXIMO_CHATS)
+
+def estado_conversa(update: Update):
+    return estados_conversa.obter(obter_usuario(update))
+
+# Função para obter o fluxo em andamento, se ele for do tipo esperado (None se expirou ou mudou)
+def fluxo_atual(update: Update, tipo):
+    fluxo = estado_conversa(update).fluxo
+    return fluxo if isinstance(fluxo, tipo) else None
+
+async def sessao_expirada(update: Update):
+    estado_conversa(update).pilha.clear()
+    await exibir(update, "Sua sessão expirou. Comece novamente pelo menu.", TECLADO_VOLTAR)
+
+# Comando /memoria (admin): estado de conversa em memória por chat ativo
+async def memoria(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if str(update.effective_user.id) not in ADMIN_IDS:
+        return
+    linhas = estados_conversa.estatisticas()
+    total = sum(tamanho for _, tamanho, _, _ in linhas)
+    texto = (
+        f"Chats com estado: {len(linhas)} (TTL {ESTADO_TTL_MINUTOS} min, máximo {ESTADO_MAXIMO_CHATS})\n"
+        f"Memória estimada: {total / 1024:.1f} KiB, média de {total / max(len(linhas), 1):.0f} B por chat\n"
+        f"Descartados desde a inicialização: {estados_conversa.descartados}"
+    )
+    for chat, tamanho, parado, tela in linhas[:10]:
+        texto += f"\n{chat}: {tamanho} B, parado há {parado / 60:.0f} min, tela {tela or '-'}"
+    await responder(update, texto)
+
+# Funções da pilha de navegação
+async def mostrar_tela(update: Update, context: ContextTypes.DEFAULT_TYPE, nome):
+    conversa = estado_conversa(update)
+    conversa.tela_atual = nome
+    tela = TELAS.get(nome)
+    if tela is None:
+        conversa.estado = None
+        await TELAS_DINAMICAS[nome](update, context)
+        return
+    conversa.estado = tela.estado
+    await exibir(update, tela.texto, tela.teclado)
+
+async def navegar_para(update: Update, context: ContextTypes.DEFAULT_TYPE, nome):
+    conversa = estado_conversa(update)
+    if conversa.tela_atual and conversa.tela_atual != nome:
+        conversa.pilha.append(conversa.tela_atual)
+    await mostrar_tela(update, context, nome)
+
+# Função para encerrar um fluxo: o próximo "Voltar" leva à tela informada (ou à anterior)
+def concluir_fluxo(update: Update, retornar_para=None):
+    conversa = estado_conversa(update)
+    conversa.estado = None
+    conversa.tela_atual = None
+    conversa.fluxo = None
+    if retornar_para:
+        pilha = conversa.pilha
+        while pilha and pilha[-1] != retornar_para:
+            pilha.pop()
+        if not pilha:
+            pilha.append(retornar_para)
+
+# Comando /start (menu interativo)
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    estado_conversa(update).pilha.clear()
+    await mostrar_tela(update, context, "start")
+
+# Função para lidar com o botão "Voltar"
+async def handle_voltar(update: Update, context: ContextTypes.DEFAULT_TYPE, argumento=None):
+    pilha = estado_conversa(update).pilha
+    # Sempre volta ao menu inicial se a pilha estiver vazia
+    await mostrar_tela(update, context, pilha.pop() if pilha else "start")
+
+# Tela dinâmica do valor do gasto fixo (o texto depende da periodicidade)
+async def tela_gasto_fixo_valor(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    fluxo = fluxo_atual(update, FluxoGastoFixo)
+    if fluxo is None:
+        await sessao_expirada(update)
+        return
+    await exibir(update, f"Insira o valor do gasto fixo {fluxo.periodicidade.lower()} (ex.: 100):", TECLADO_VOLTAR)
+    estado_conversa(update).estado = 'awaiting_gasto_fixo_valor'
+
+# Telas dinâmicas da escolha de categoria, com as categorias mais usadas pelo usuário
+def tela_categorias(acao, texto):
+    async def renderizar(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        try:
+            frequentes = [nome for nome, _ in obter_categorias_frequentes(obter_usuario(update)).most_common(CATEGORIAS_TECLADO)]
+        except Exception:
+            frequentes = []
+        await exibir(update, texto, teclado_categorias(acao, frequentes))
+        estado_conversa(update).estado = f'awaiting_{acao}'
+    return renderizar
+
+# Telas dinâmicas das listagens de edição e remoção
+def tela_listagem(listagem):
+    async def renderizar(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        try:
+            itens = carregar_itens(obter_usuario(update), listagem.tipo)
+            if not itens:
+                await exibir(update, listagem.vazio, TECLADO_VOLTAR)
+                return
+            teclado = montar_teclado([(rotulo, f"{listagem.acao_item}:{item_id}") for item_id, rotulo in itens])
+            await exibir(update, listagem.titulo, teclado)
+        except Exception as e:
+            logger.error(f"Erro ao carregar itens ({listagem.tipo}): {str(e)}")
+            await exibir(update, listagem.erro, TECLADO_VOLTAR)
+    return renderizar
+
+# Tela dinâmica de confirmação de remoção
+async def tela_confirmar_remocao(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    fluxo = fluxo_atual(update, FluxoRemocao)
+    if fluxo is None:
+        await sessao_expirada(update)
+        return
+    itens = dict(carregar_itens(obter_usuario(update), fluxo.tipo))
+    # Itens de outros meses chegam pela busca, que guarda o rótulo dos resultados exibidos
+    busca = estado_conversa(update).busca
+    rotulo = itens.get(fluxo.item_id) or (busca.rotulos.get((fluxo.tipo, fluxo.item_id)) if busca else None)
+    if rotulo is None:
+        await exibir(update, "Item não encontrado.", TECLADO_VOLTAR)
+        return
+    await exibir(update, f"Você tem certeza que deseja remover {DESCRICAO_ITEM[fluxo.tipo]} {rotulo}?", TECLADO_CONFIRMAR_REMOCAO)
+
+# Função para interpretar o texto da busca: termo e filtros ">50", "<200", "de:DD/MM/AAAA", "ate:DD/MM/AAAA"
+def interpretar_busca(texto):
+    termo = []
+    filtros = {}
+    try:
+        for parte in texto.split():
+            minusculo = parte.lower()
+            if re.fullmatch(r"[<>]=?\d+([.,]\d+)?", parte):
+                filtros["valor_min" if parte[0] == ">" else "valor_max"] = ler_centavos(parte.lstrip("<>="))
+            elif minusculo.startswith("de:"):
+                filtros["inicio"] = datetime.strptime(parte[3:], "%d/%m/%Y").date()
+            elif minusculo.startswith(("ate:", "até:")):
+                filtros["fim"] = datetime.strptime(parte.split(":", 1)[1], "%d/%m/%Y").date() + timedelta(days=1)
+            else:
+                termo.append(parte)
+    except ValueError:
+        return None
+    if not termo:
+        return None
+    return " ".join(termo), FiltrosBusca(**filtros)
+
+# Gasto em uma mensagem ("gastei 32,50 no uber ontem no pix"): regras compiladas para o valor,
+# a data e a forma de pagamento; a categoria vem das palavras que sobram, procuradas no modelo do
+# usuário, nos nomes das categorias dele e, por fim, nas palavras conhecidas de PALAVRAS_CATEGORIA
+class GastoLivre(NamedTuple):
+    valor: int
+    categoria: str
+    forma_pagamento: str
+    data: date
+    palavras: tuple
+
+DATA_LIVRE = re.compile(r"\b(\d{1,2})/(\d{1,2})(?:/(\d{2}|\d{4}))?\b")
+DIA_LIVRE = re.compile(r"\bdia (\d{1,2})\b")
+DIAS_RELATIVOS = {"hoje": 0, "ontem": 1, "anteontem": 2}
+VALOR_LIVRE = re.compile(r"(?:r\$\s*)?\b(\d{1,3}(?:\.\d{3})+(?:,\d{1,2})?|\d+(?:[.,]\d{1,2})?)\b")
+FORMAS_LIVRES = [
+    (re.compile(r"\bpix\b"), "Pix"),
+    (re.compile(r"\b(?:cartao de )?debito\b"), "Cartão de Débito"),
+    (re.compile(r"\b(?:cartao de )?credito\b|\bcartao\b"), "Cartão de Crédito"),
+    (re.compile(r"\b(?:dinheiro|especie)\b"), "Dinheiro"),
+]
+GATILHOS_GASTO = {"gastei", "paguei", "comprei", "gasto"}
+PALAVRAS_IGNORADAS = GATILHOS_GASTO | {
+    "no", "na", "nos", "nas", "de", "do", "da", "dos", "das", "em", "com", "pra", "para", "pro", "o", "a",
+    "os", "as", "um", "uma", "e", "r", "reais", "real", "conto", "contos", "hoje", "ontem", "anteontem", "dia",
+}
+PALAVRAS_CATEGORIA = {
+    **dict.fromkeys(["uber", "taxi", "onibus", "metro", "gasolina", "combustivel", "estacionamento", "pedagio"], "Transporte"),
+    **dict.fromkeys(["mercado", "supermercado", "ifood", "restaurante", "lanche", "padaria", "almoco", "jantar", "cafe", "pizza"], "Alimentação"),
+    **dict.fromkeys(["farmacia", "remedio", "medico", "consulta", "dentista", "exame"], "Saúde"),
+    **dict.fromkeys(["cinema", "bar", "show", "netflix", "spotify", "viagem"], "Lazer"),
+    **dict.fromkeys(["aluguel", "condominio"], "Aluguel"),
+}
+
+# Data do gasto (hoje se a mensagem não tiver uma); ValueError se a data não existir
+def interpretar_data_livre(texto, hoje):
+    for palavra, dias in DIAS_RELATIVOS.items():
+        if re.search(rf"\b{palavra}\b", texto):
+            return hoje - timedelta(days=dias)
+    encontrada = DATA_LIVRE.search(texto)
+    if encontrada:
+        dia, mes, ano = (int(parte) if parte else None for parte in encontrada.groups())
+        if ano is not None:
+            return date(ano + (2000 if len(encontrada[3]) == 2 else 0), mes, dia)
+        # Sem o ano, uma data futura (ou um 29/02 que não existe neste ano) é do ano passado
+        try:
+            data = date(hoje.year, mes, dia)
+        except ValueError:
+            data = None
+        return data if data is not None and data <= hoje else date(hoje.year - 1, mes, dia)
+    encontrada = DIA_LIVRE.search(texto)
+    if encontrada:
+        dia = int(encontrada[1])
+        if not 1 <= dia <= 31:
+            raise ValueError(f"dia inválido: {dia}")
+        if dia <= hoje.day:
+            return hoje.replace(day=dia)
+        # Um dia que ainda não chegou é do mês passado, limitado ao último dia dele ("dia 31" em abril)
+        anterior = hoje.replace(day=1) - timedelta(days=1)
+        return anterior.replace(day=min(dia, anterior.day))
+    return hoje
 
-# Função para definir ou atualizar o limite do usuário
-def definir_limite(usuario, limite):
-    try:
-        with conectar() as conn:
-            with conn.cursor() as cursor:
-                cursor.execute('''
-                INSERT INTO limites (usuario, limite)
-                VALUES (%s, %s)
-                ON CONFLICT (usuario)
-                DO UPDATE SET limite = EXCLUDED.limite
-                ''', (usuario, limite))
-                conn.commit()
-        logger.info(f"Limite de R${limite} definido para o usuário {usuario}")
-    except Exception as e:
-        logger.error(f"Erro ao definir limite: {e}")
-        raise
+# Função para interpretar o gasto de uma mensagem; None se não houver valor ou se a categoria não
+# for reconhecida em uma mensagem sem "gastei", "paguei"... ValueError se a data do gasto não existir
+def interpretar_gasto_livre(texto, hoje, modelo, categorias):
+    texto = normalizar_texto(texto)
+    restante = DIA_LIVRE.sub(" ", DATA_LIVRE.sub(" ", texto))
+    forma_pagamento = None
+    for padrao, forma in FORMAS_LIVRES:
+        if padrao.search(restante):
+            forma_pagamento = forma_pagamento or forma
+            restante = padrao.sub(" ", restante)
+    valor = VALOR_LIVRE.search(restante)
+    if valor is None:
+        return None
+    centavos = ler_centavos(valor[1])
+    if centavos <= 0:
+        return None
+    restante = restante[:valor.start()] + " " + restante[valor.end():]
+    palavras = [p for p in dict.fromkeys(re.findall(r"[a-z0-9]+", restante)) if p not in PALAVRAS_IGNORADAS and not p.isdigit()]
+
+    categoria = next((modelo.palavras[p] for p in palavras if p in modelo.palavras), None)
+    if categoria is None:
+        frase = f" {' '.join(palavras)} "
+        categoria = next((
+            nome for nome, _ in categorias.most_common()
+            if not SUFIXO_GASTO_FIXO.search(nome) and chave_categoria(nome) and f" {chave_categoria(nome)} " in frase
+        ), None)
+    if categoria is None:
+        categoria = next((PALAVRAS_CATEGORIA[p] for p in palavras if p in PALAVRAS_CATEGORIA), None)
+    if categoria is None and not GATILHOS_GASTO & set(texto.split()):
+        return None
+    data = interpretar_data_livre(texto, hoje)
+    if categoria is None:
+        return GastoLivre(centavos, "Outros", forma_pagamento or padrao_forma(modelo), data, ())
+    return GastoLivre(centavos, categoria, forma_pagamento or padrao_forma(modelo), data, tuple(palavras[:5]))
+
+def padrao_forma(modelo):
+    return modelo.formas.most_common(1)[0][0] if modelo.formas else "Pix"
 
-# Função para verificar se o limite foi excedido
-async def verificar_limite(update: Update, usuario, mes, ano):
+# Tela dinâmica dos resultados da busca, com botões de editar e remover em cada resultado
+async def tela_busca_resultados(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    busca = estado_conversa(update).busca
+    if busca is None:
+        await mostrar_tela(update, context, "buscar")
+        return
+    termo, filtros, pagina = busca.termo, busca.filtros, busca.pagina
+    usuario = obter_usuario(update)
     try:
-        limite = obter_limite(usuario)
-        if limite is None:
-            return
-        
-        total_gastos = obter_total_gastos_mensais(usuario, mes, ano)
-        if total_gastos > limite:
-            await update.message.reply_text(
-                f"⚠️ Alerta: Você ultrapassou seu limite de gastos mensal de R${limite:.2f}! "
-                f"Seu total de gastos em {mes:02d}/{ano} é R${total_gastos:.2f}."
-            )
+        resultados = buscar_lancamentos(usuario, termo, filtros, pagina)
+        corte = obter_corte_arquivo(usuario)
     except Exception as e:
-        logger.error(f"Erro ao verificar limite: {e}")
+        logger.error(f"Erro ao exibir busca: {e}")
+        await exibir(update, "Erro ao realizar a busca.", TECLADO_VOLTAR)
+        return
+    aviso = ""
+    if corte and (filtros.inicio is None or filtros.inicio < corte):
+        aviso = aviso_arquivo(corte, "não entram na busca (o resumo mostra os totais mensais)")
+    if not resultados and pagina == 0:
+        await exibir(update, f"Nenhum resultado para '{termo}'.{aviso}", TECLADO_VOLTAR)
+        return
 
-# Função para gerar recomendações
-def gerar_recomendacao(gastos):
-    total_gastos = sum(total for _, total in gastos)
-    for categoria, total in gastos:
-        if total > 1000 and categoria.lower() in ['lazer', 'compras', 'entretenimento']:
-            return f"Considere reduzir gastos com '{categoria}' (R${total:.2f})."
-    if total_gastos > 3000:
-        return "Você está gastando muito! Reduza despesas gerais."
-    elif total_gastos > 1500:
-        return "Seus gastos estão moderados. Tente economizar um pouco mais."
-    return "Seus gastos estão sob controle. Parabéns!"
+    proxima = len(resultados) > BUSCA_POR_PAGINA
+    resultados = resultados[:BUSCA_POR_PAGINA]
+    texto = f"🔎 Resultados para '{termo}' (página {pagina + 1}):\n"
+    botoes = []
+    rotulos = {}
+    for numero, (tipo, item_id, valor, descricao, forma_pagamento, data) in enumerate(resultados, start=pagina * BUSCA_POR_PAGINA + 1):
+        if tipo == "entrada":
+            tipo_item, editar, remover = "entrada", "editar_entrada_select", "remover_entrada_select"
+            rotulo = f"ID {item_id} - {formatar_reais(em_centavos(valor))} - {descricao}"
+        else:
+            tipo_item = "gasto_fixo" if eh_gasto_fixo(descricao) else "gasto_normal"
+            editar, remover = "editar_gasto_select", f"remover_{tipo_item}_select"
+            rotulo = f"ID {item_id} - {formatar_reais(em_centavos(valor))} - {descricao} - {forma_pagamento}"
+        rotulos[(tipo_item, item_id)] = rotulo
+        texto += f"\n{numero}. {'💰' if tipo == 'entrada' else '💸'} {rotulo} - {data:%d/%m/%Y}"
+        botoes.append([
+            InlineKeyboardButton(f"✏️ {numero}", callback_data=f"{editar}:{item_id}"),
+            InlineKeyboardButton(f"🗑️ {numero}", callback_data=f"{remover}:{item_id}")
+        ])
+    busca.rotulos = rotulos
+    texto += aviso
 
-# Comando /start (menu interativo)
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    keyboard = [
-        [InlineKeyboardButton("GASTO", callback_data="start_gasto")],
-        [InlineKeyboardButton("VALOR RECEBIDO", callback_data="start_entrada")],
-        [InlineKeyboardButton("RESUMO", callback_data="start_resumo")],
-        [InlineKeyboardButton("PLANILHA EXCEL", callback_data="start_excel")],
-        [InlineKeyboardButton("POWER BI", callback_data="start_powerbi")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text("Escolha uma opção:", reply_markup=reply_markup)
-    context.user_data['navigation_stack'] = []
+    navegacao = []
+    if pagina > 0:
+        navegacao.append(InlineKeyboardButton("⬅️ Anterior", callback_data=f"busca_pagina:{pagina - 1}"))
+    if proxima:
+        navegacao.append(InlineKeyboardButton("Próxima ➡️", callback_data=f"busca_pagina:{pagina + 1}"))
+    if navegacao:
+        botoes.append(navegacao)
+    botoes.append([BOTAO_VOLTAR])
+    await exibir(update, texto, InlineKeyboardMarkup(botoes))
 
-# Handler para o menu inicial
-async def button_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
+# Comando /buscar (ex.: /buscar mercado >50 de:01/01/2024)
+async def buscar(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not context.args:
+        await navegar_para(update, context, "buscar")
+        return
+    busca = interpretar_busca(" ".join(context.args))
+    if busca is None:
+        await responder(update, "Busca inválida. Use: /buscar TERMO [>VALOR] [<VALOR] [de:DD/MM/AAAA] [ate:DD/MM/AAAA].")
+        return
+    estado_conversa(update).busca = Busca(*busca)
+    await navegar_para(update, context, "busca_resultados")
 
-    if query.data == "start_gasto":
-        keyboard = [
-            [InlineKeyboardButton("GASTO NORMAL", callback_data="gasto_normal")],
-            [InlineKeyboardButton("GASTO FIXO", callback_data="gasto_fixo")],
-            [InlineKeyboardButton("Voltar", callback_data="voltar")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.message.edit_text("Escolha o tipo de gasto:", reply_markup=reply_markup)
-        context.user_data['navigation_stack'].append("start")
-    elif query.data == "start_entrada":
-        keyboard = [
-            [InlineKeyboardButton("ADICIONAR VALOR RECEBIDO", callback_data="entrada_adicionar")],
-            [InlineKeyboardButton("EDITAR VALOR RECEBIDO", callback_data="editar_entrada")],
-            [InlineKeyboardButton("REMOVER VALOR RECEBIDO", callback_data="remover_entrada")],
-            [InlineKeyboardButton("Voltar", callback_data="voltar")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.message.edit_text("Escolha uma ação para Valor Recebido:", reply_markup=reply_markup)
-        context.user_data['navigation_stack'].append("start")
-    elif query.data == "start_powerbi":
-        await send_powerbi_link(update, context)
-        context.user_data['navigation_stack'].append("start")
-    elif query.data == "start_resumo":
-        await resumo(update, context)
-    elif query.data == "start_excel":
-        mes = datetime.now().month
-        ano = datetime.now().year
-        context.user_data['excel_mes'] = mes
-        context.user_data['excel_ano'] = ano
-        context.user_data['navigation_stack'].append("start")
-        await mostrar_selecao_excel(update, context, mes, ano)
-
-# Função para mostrar a seleção de mês/ano para a planilha Excel
-async def mostrar_selecao_excel(update: Update, context: ContextTypes.DEFAULT_TYPE, mes, ano):
-    usuario = str(update.callback_query.message.chat.id)
-    try:
-        mensagem = f"Selecione o mês e ano para gerar a planilha:\n\nMês atual: {mes:02d}/{ano}"
-        keyboard = [
-            [
-                InlineKeyboardButton("⬅️ Mês Anterior", callback_data="excel_prev"),
-                InlineKeyboardButton("Gerar Planilha", callback_data="excel_gerar"),
-                InlineKeyboardButton("Mês Próximo ➡️", callback_data="excel_next")
-            ],
-            [InlineKeyboardButton("Voltar", callback_data="voltar")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.callback_query.message.edit_text(mensagem, reply_markup=reply_markup)
+# Função para obter o período selecionado no resumo ou na planilha (padrão: mês atual)
+def periodo_selecionado(update: Update, destino):
+    conversa = estado_conversa(update)
+    periodo = getattr(conversa, f'periodo_{destino}')
+    if periodo is None:
+        periodo = periodo_mes(datetime.now().month, datetime.now().year)
+        setattr(conversa, f'periodo_{destino}', periodo)
+    return periodo
+
+# Tela dinâmica do resumo
+async def tela_resumo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await mostrar_resumo(update, context, periodo_selecionado(update, "resumo"))
+
+# Tela dinâmica da seleção do período da planilha
+async def tela_excel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await mostrar_selecao_excel(update, context, periodo_selecionado(update, "excel"))
+
+# Função para mostrar a seleção do período para a planilha Excel
+async def mostrar_selecao_excel(update: Update, context: ContextTypes.DEFAULT_TYPE, periodo):
+    try:
+        mensagem = f"Selecione o período para gerar a planilha:\n\nPeríodo atual: {rotulo_periodo(periodo)}"
+        await exibir(update, mensagem, TECLADO_EXCEL)
     except Exception as e:
         logger.error(f"Erro ao mostrar seleção de mês para Excel: {e}")
-        keyboard = [[InlineKeyboardButton("Voltar", callback_data="voltar")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.callback_query.message.edit_text("Erro ao mostrar seleção de mês.", reply_markup=reply_markup)
-
-# Handler para botões de navegação da seleção de mês para Excel
-async def button_excel(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
+        await exibir(update, "Erro ao mostrar seleção de mês.", TECLADO_VOLTAR)
 
-    if query.data == "voltar":
-        await handle_voltar(update, context)
+# Texto fora de um fluxo: tenta registrar um gasto descrito em uma mensagem
+async def registrar_gasto_livre(update: Update):
+    texto = update.message.text or ""
+    # Conversa sem nenhum valor é ignorada antes de consultar o banco
+    if not VALOR_DIGITADO.search(texto):
         return
-
-    mes = context.user_data.get('excel_mes', datetime.now().month)
-    ano = context.user_data.get('excel_ano', datetime.now().year)
-
-    if query.data == "excel_prev":
-        mes -= 1
-        if mes < 1:
-            mes = 12
-            ano -= 1
-    elif query.data == "excel_next":
-        mes += 1
-        if mes > 12:
-            mes = 1
-            ano += 1
-    elif query.data == "excel_gerar":
-        await gerar_planilha_excel(update, context, mes, ano)
+    usuario = obter_usuario(update)
+    try:
+        modelo, categorias = obter_modelo_gastos(usuario), obter_categorias_frequentes(usuario)
+    except Exception as e:
+        logger.error(f"Erro ao carregar o modelo de gastos: {e}")
+        await responder(update, "Erro ao salvar o gasto. Tente novamente mais tarde.", TECLADO_VOLTAR)
         return
-
-    context.user_data['excel_mes'] = mes
-    context.user_data['excel_ano'] = ano
-    await mostrar_selecao_excel(update, context, mes, ano)
+    try:
+        gasto = interpretar_gasto_livre(texto, datetime.now().date(), modelo, categorias)
+    except ValueError:
+        await responder(update, "Data inválida. Use o formato DD/MM/AAAA ou \"dia 5\".", TECLADO_VOLTAR)
+        return
+    if gasto is None:
+        return
+    try:
+        gasto_id, limites = salvar_gasto_livre(usuario, gasto, chave_idempotencia(update))
+    except Exception as e:
+        logger.error(f"Erro ao salvar gasto em uma mensagem: {e}")
+        await responder(update, "Erro ao salvar o gasto. Tente novamente mais tarde.", TECLADO_VOLTAR)
+        return
+    msg = f"Gasto de {formatar_reais(gasto.valor)} na categoria '{gasto.categoria}' ({gasto.forma_pagamento}, {gasto.data:%d/%m/%Y}) salvo com sucesso!"
+    if gasto_id is None:
+        await responder(update, msg, TECLADO_VOLTAR)
+        return
+    teclado = InlineKeyboardMarkup([
+        [InlineKeyboardButton("✏️ Editar", callback_data=f"editar_gasto_select:{gasto_id}"),
+         InlineKeyboardButton("🗑️ Remover", callback_data=f"remover_gasto_normal_select:{gasto_id}")],
+        [BOTAO_VOLTAR],
+    ])
+    await responder(update, msg, teclado)
+    await verificar_limite(update, usuario, gasto.data.month, gasto.data.year, limites)
 
 # Handler para processar mensagens de texto (fluxo interativo)
 async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    state = context.user_data.get('state')
+    state = estado_conversa(update).estado
     if not state:
+        await registrar_gasto_livre(update)
         return
 
     usuario = str(update.message.chat.id)
@@ -384,818 +4257,538 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if state == 'awaiting_gasto_valor':
         try:
-            valor = float(update.message.text)
+            valor = ler_centavos(update.message.text)
             if valor <= 0:
-                keyboard = [[InlineKeyboardButton("Voltar", callback_data="voltar")]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await update.message.reply_text("O valor deve ser positivo. Tente novamente.", reply_markup=reply_markup)
+                await responder(update, "O valor deve ser positivo. Tente novamente.", TECLADO_VOLTAR)
                 return
-            context.user_data['gasto_valor'] = valor
-            categorias = ["Alimentação", "Lazer", "Transporte", "Saúde", "Outros", "Escrever Categoria"]
-            keyboard = [
-                [InlineKeyboardButton(cat, callback_data=f"gasto_categoria_{cat}") for cat in categorias[i:i+2]]
-                for i in range(0, len(categorias), 2)
-            ]
-            keyboard.append([InlineKeyboardButton("Voltar", callback_data="voltar")])
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await update.message.reply_text("Escolha a categoria do gasto ou escreva uma personalizada:", reply_markup=reply_markup)
-            context.user_data['state'] = 'awaiting_gasto_categoria'
-            context.user_data['navigation_stack'].append("awaiting_gasto_valor")
+            estado_conversa(update).fluxo = FluxoGasto(valor)
+            await navegar_para(update, context, "gasto_categoria")
         except ValueError:
-            keyboard = [[InlineKeyboardButton("Voltar", callback_data="voltar")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await update.message.reply_text("Valor inválido. Insira um número (ex.: 100).", reply_markup=reply_markup)
+            await responder(update, "Valor inválido. Insira um número (ex.: 100).", TECLADO_VOLTAR)
     elif state == 'awaiting_gasto_categoria':
-        if update.message.text:
-            context.user_data['gasto_categoria'] = update.message.text
-            formas_pagamento = ["Cartão de Crédito", "Cartão de Débito", "Pix", "Dinheiro"]
-            keyboard = [
-                [InlineKeyboardButton(fp, callback_data=f"gasto_forma_{fp}") for fp in formas_pagamento[i:i+2]]
-                for i in range(0, len(formas_pagamento), 2)
-            ]
-            keyboard.append([InlineKeyboardButton("Voltar", callback_data="voltar")])
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await update.message.reply_text("Escolha a forma de pagamento:", reply_markup=reply_markup)
-            context.user_data['state'] = 'awaiting_gasto_forma'
-            context.user_data['navigation_stack'].append("awaiting_gasto_categoria")
+        fluxo = fluxo_atual(update, FluxoGasto)
+        if fluxo is None:
+            await sessao_expirada(update)
+        elif update.message.text:
+            fluxo.categoria = update.message.text
+            await navegar_para(update, context, "gasto_forma")
         else:
-            keyboard = [[InlineKeyboardButton("Voltar", callback_data="voltar")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await update.message.reply_text("Por favor, escreva uma categoria ou escolha uma das opções.", reply_markup=reply_markup)
+            await responder(update, "Por favor, escreva uma categoria ou escolha uma das opções.", TECLADO_VOLTAR)
     elif state == 'awaiting_entrada':
         try:
             parts = update.message.text.split(maxsplit=1)
             if len(parts) != 2:
-                keyboard = [[InlineKeyboardButton("Voltar", callback_data="voltar")]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await update.message.reply_text("Formato inválido. Use: VALOR DESCRICAO (ex.: 100 Salário).", reply_markup=reply_markup)
+                await responder(update, "Formato inválido. Use: VALOR DESCRICAO (ex.: 100 Salário).", TECLADO_VOLTAR)
                 return
-            valor = float(parts[0])
+            valor = ler_centavos(parts[0])
             if valor <= 0:
-                keyboard = [[InlineKeyboardButton("Voltar", callback_data="voltar")]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await update.message.reply_text("O valor deve ser positivo. Tente novamente.", reply_markup=reply_markup)
+                await responder(update, "O valor deve ser positivo. Tente novamente.", TECLADO_VOLTAR)
                 return
             descricao = parts[1]
             data = datetime.now().strftime('%Y-%m-%d')
-            salvar_entrada(usuario, valor, descricao, data)
-            keyboard = [[InlineKeyboardButton("Voltar", callback_data="voltar")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await update.message.reply_text(f"Entrada de R${valor:.2f} - {descricao} salva!", reply_markup=reply_markup)
-            context.user_data.pop('state', None)
-            await verificar_limite(update, usuario, mes, ano)
+            nova = salvar_entrada(usuario, em_reais(valor), descricao, data, chave_idempotencia(update))
+            await responder(update, f"Entrada de {formatar_reais(valor)} - {descricao} salva!", TECLADO_VOLTAR)
+            concluir_fluxo(update)
+            if nova:
+                await verificar_limite(update, usuario, mes, ano)
         except ValueError:
-            keyboard = [[InlineKeyboardButton("Voltar", callback_data="voltar")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await update.message.reply_text("Valor inválido. Insira um número (ex.: 100 Salário).", reply_markup=reply_markup)
+            await responder(update, "Valor inválido. Insira um número (ex.: 100 Salário).", TECLADO_VOLTAR)
     elif state == 'awaiting_gasto_fixo_valor':
+        fluxo = fluxo_atual(update, FluxoGastoFixo)
+        if fluxo is None:
+            await sessao_expirada(update)
+            return
         try:
-            valor = float(update.message.text)
+            valor = ler_centavos(update.message.text)
             if valor <= 0:
-                keyboard = [[InlineKeyboardButton("Voltar", callback_data="voltar")]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await update.message.reply_text("O valor deve ser positivo. Tente novamente.", reply_markup=reply_markup)
+                await responder(update, "O valor deve ser positivo. Tente novamente.", TECLADO_VOLTAR)
                 return
-            context.user_data['gasto_fixo_valor'] = valor
-            categorias = ["Alimentação", "Lazer", "Transporte", "Saúde", "Outros", "Escrever Categoria"]
-            keyboard = [
-                [InlineKeyboardButton(cat, callback_data=f"gasto_fixo_categoria_{cat}") for cat in categorias[i:i+2]]
-                for i in range(0, len(categorias), 2)
-            ]
-            keyboard.append([InlineKeyboardButton("Voltar", callback_data="voltar")])
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await update.message.reply_text("Escolha a categoria do gasto fixo ou escreva uma personalizada:", reply_markup=reply_markup)
-            context.user_data['state'] = 'awaiting_gasto_fixo_categoria'
-            context.user_data['navigation_stack'].append("awaiting_gasto_fixo_valor")
+            fluxo.valor = valor
+            await navegar_para(update, context, "gasto_fixo_categoria")
         except ValueError:
-            keyboard = [[InlineKeyboardButton("Voltar", callback_data="voltar")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await update.message.reply_text("Valor inválido. Insira um número (ex.: 100).", reply_markup=reply_markup)
+            await responder(update, "Valor inválido. Insira um número (ex.: 100).", TECLADO_VOLTAR)
     elif state == 'awaiting_gasto_fixo_categoria':
-        if update.message.text:
-            context.user_data['gasto_fixo_categoria'] = update.message.text
-            formas_pagamento = ["Cartão de Crédito", "Cartão de Débito", "Pix", "Dinheiro"]
-            keyboard = [
-                [InlineKeyboardButton(fp, callback_data=f"gasto_fixo_forma_{fp}") for fp in formas_pagamento[i:i+2]]
-                for i in range(0, len(formas_pagamento), 2)
-            ]
-            keyboard.append([InlineKeyboardButton("Voltar", callback_data="voltar")])
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await update.message.reply_text("Escolha a forma de pagamento do gasto fixo:", reply_markup=reply_markup)
-            context.user_data['state'] = 'awaiting_gasto_fixo_forma'
-            context.user_data['navigation_stack'].append("awaiting_gasto_fixo_categoria")
+        fluxo = fluxo_atual(update, FluxoGastoFixo)
+        if fluxo is None:
+            await sessao_expirada(update)
+        elif update.message.text:
+            fluxo.categoria = update.message.text
+            await navegar_para(update, context, "gasto_fixo_forma")
         else:
-            keyboard = [[InlineKeyboardButton("Voltar", callback_data="voltar")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await update.message.reply_text("Por favor, escreva uma categoria ou escolha uma das opções.", reply_markup=reply_markup)
+            await responder(update, "Por favor, escreva uma categoria ou escolha uma das opções.", TECLADO_VOLTAR)
     elif state == 'awaiting_editar_dados_gasto':
+        fluxo = fluxo_atual(update, FluxoEdicao)
+        if fluxo is None:
+            await sessao_expirada(update)
+            return
         try:
             parts = update.message.text.split(maxsplit=3)
-            valor = float(parts[0]) if len(parts) > 0 and parts[0] else None
+            valor = em_reais(ler_centavos(parts[0])) if len(parts) > 0 and parts[0] else None
             categoria = parts[1] if len(parts) > 1 and parts[1] else None
             forma_pagamento = parts[2] if len(parts) > 2 and parts[2] else None
             if valor is not None and valor <= 0:
-                keyboard = [[InlineKeyboardButton("Voltar", callback_data="voltar")]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await update.message.reply_text("O valor deve ser positivo.", reply_markup=reply_markup)
+                await responder(update, "O valor deve ser positivo.", TECLADO_VOLTAR)
                 return
-            gasto_id = context.user_data['editar_id']
+            gasto_id = fluxo.item_id
             editar_gasto(usuario, gasto_id, valor, categoria, forma_pagamento)
-            keyboard = [[InlineKeyboardButton("Voltar", callback_data="voltar")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await update.message.reply_text(f"Gasto ID {gasto_id} editado com sucesso!", reply_markup=reply_markup)
-            context.user_data.pop('state', None)
-            context.user_data.pop('editar_id', None)
+            await responder(update, f"Gasto ID {gasto_id} editado com sucesso!", TECLADO_VOLTAR)
+            concluir_fluxo(update)
         except ValueError:
-            keyboard = [[InlineKeyboardButton("Voltar", callback_data="voltar")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await update.message.reply_text("Dados inválidos. Use: VALOR CATEGORIA FORMA (ex.: 200 Alimentação Cartão).", reply_markup=reply_markup)
+            await responder(update, "Dados inválidos. Use: VALOR CATEGORIA FORMA (ex.: 200 Alimentação Cartão).", TECLADO_VOLTAR)
         except Exception:
-            keyboard = [[InlineKeyboardButton("Voltar", callback_data="voltar")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await update.message.reply_text("Erro ao editar o gasto ou ID não encontrado.", reply_markup=reply_markup)
+            await responder(update, "Erro ao editar o gasto ou ID não encontrado.", TECLADO_VOLTAR)
     elif state == 'awaiting_editar_dados_entrada':
+        fluxo = fluxo_atual(update, FluxoEdicao)
+        if fluxo is None:
+            await sessao_expirada(update)
+            return
         try:
             parts = update.message.text.split(maxsplit=2)
-            valor = float(parts[0]) if len(parts) > 0 and parts[0] else None
+            valor = em_reais(ler_centavos(parts[0])) if len(parts) > 0 and parts[0] else None
             descricao = parts[1] if len(parts) > 1 and parts[1] else None
             if valor is not None and valor <= 0:
-                keyboard = [[InlineKeyboardButton("Voltar", callback_data="voltar")]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await update.message.reply_text("O valor deve ser positivo.", reply_markup=reply_markup)
+                await responder(update, "O valor deve ser positivo.", TECLADO_VOLTAR)
                 return
-            entrada_id = context.user_data['editar_id']
+            entrada_id = fluxo.item_id
             editar_entrada(usuario, entrada_id, valor, descricao)
-            keyboard = [[InlineKeyboardButton("Voltar", callback_data="voltar")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await update.message.reply_text(f"Entrada ID {entrada_id} editada com sucesso!", reply_markup=reply_markup)
-            context.user_data.pop('state', None)
-            context.user_data.pop('editar_id', None)
+            await responder(update, f"Entrada ID {entrada_id} editada com sucesso!", TECLADO_VOLTAR)
+            concluir_fluxo(update)
         except ValueError:
-            keyboard = [[InlineKeyboardButton("Voltar", callback_data="voltar")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await update.message.reply_text("Dados inválidos. Use: VALOR DESCRICAO (ex.: 200 Salário).", reply_markup=reply_markup)
+            await responder(update, "Dados inválidos. Use: VALOR DESCRICAO (ex.: 200 Salário).", TECLADO_VOLTAR)
         except Exception:
-            keyboard = [[InlineKeyboardButton("Voltar", callback_data="voltar")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await update.message.reply_text("Erro ao editar a entrada ou ID não encontrado.", reply_markup=reply_markup)
+            await responder(update, "Erro ao editar a entrada ou ID não encontrado.", TECLADO_VOLTAR)
     elif state == 'awaiting_definirlimite':
         try:
-            limite = float(update.message.text)
+            limite = ler_centavos(update.message.text)
+            if limite <= 0:
+                await responder(update, "O limite deve ser positivo. Tente novamente.", TECLADO_VOLTAR)
+                return
+            definir_limite(usuario, em_reais(limite))
+            await responder(update, f"Limite de {formatar_reais(limite)} definido com sucesso!", TECLADO_VOLTAR)
+            concluir_fluxo(update)
+        except ValueError:
+            await responder(update, "Valor inválido. Insira um número (ex.: 1000).", TECLADO_VOLTAR)
+    elif state == 'awaiting_limite_categoria':
+        try:
+            parts = update.message.text.split(maxsplit=1)
+            if len(parts) != 2:
+                await responder(update, "Formato inválido. Use: VALOR CATEGORIA (ex.: 500 Lazer).", TECLADO_VOLTAR)
+                return
+            limite = ler_centavos(parts[0])
             if limite <= 0:
-                keyboard = [[InlineKeyboardButton("Voltar", callback_data="voltar")]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await update.message.reply_text("O limite deve ser positivo. Tente novamente.", reply_markup=reply_markup)
+                await responder(update, "O limite deve ser positivo. Tente novamente.", TECLADO_VOLTAR)
                 return
-            definir_limite(usuario, limite)
-            keyboard = [[InlineKeyboardButton("Voltar", callback_data="voltar")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await update.message.reply_text(f"Limite de R${limite:.2f} definido com sucesso!", reply_markup=reply_markup)
-            context.user_data.pop('state', None)
+            categoria = parts[1].strip()
+            definir_limite_categoria(usuario, categoria, em_reais(limite))
+            await responder(update, f"Limite de {formatar_reais(limite)} para '{categoria}' definido com sucesso!", TECLADO_VOLTAR)
+            concluir_fluxo(update)
+            await verificar_limite(update, usuario, mes, ano)
         except ValueError:
-            keyboard = [[InlineKeyboardButton("Voltar", callback_data="voltar")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await update.message.reply_text("Valor inválido. Insira um número (ex.: 1000).", reply_markup=reply_markup)
+            await responder(update, "Valor inválido. Use: VALOR CATEGORIA (ex.: 500 Lazer).", TECLADO_VOLTAR)
+    elif state == 'awaiting_busca':
+        busca = interpretar_busca(update.message.text or "")
+        if busca is None:
+            await responder(update, "Busca inválida. Escreva um termo e, se quiser, filtros como >50, <200, de:01/01/2024 ou ate:31/03/2024.", TECLADO_VOLTAR)
+            return
+        estado_conversa(update).busca = Busca(*busca)
+        await navegar_para(update, context, "busca_resultados")
+    elif state == 'awaiting_periodo':
+        periodo = interpretar_periodo(update.message.text or "", datetime.now().date())
+        if periodo is None:
+            await responder(update, "Período inválido. Use: INÍCIO FIM (ex.: 01/01/2024 31/03/2024), MM/AAAA, T3 2024 ou AAAA.", TECLADO_VOLTAR)
+            return
+        conversa = estado_conversa(update)
+        destino = conversa.periodo_destino
+        setattr(conversa, f'periodo_{destino}', periodo)
+        concluir_fluxo(update, retornar_para=destino)
+        await handle_voltar(update, context)
+    elif state == 'awaiting_backup':
+        await responder(update, "Envie o arquivo do backup (.jsonl.gz) ou toque em Voltar.", TECLADO_VOLTAR)
 
-# Handler para botões de gasto
-async def button_gasto(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
+# Rotas de callback: cada uma recebe o argumento após ":" no callback_data
+def navegador(nome):
+    async def navegar(update: Update, context: ContextTypes.DEFAULT_TYPE, argumento):
+        await navegar_para(update, context, nome)
+    return navegar
+
+async def rota_start_resumo(update: Update, context: ContextTypes.DEFAULT_TYPE, argumento):
+    await resumo(update, context)
 
-    if query.data == "voltar":
+async def rota_start_excel(update: Update, context: ContextTypes.DEFAULT_TYPE, argumento):
+    estado_conversa(update).periodo_excel = periodo_mes(datetime.now().month, datetime.now().year)
+    await navegar_para(update, context, "excel")
+
+# Escolha de período: "periodo:<destino>:<tipo>" define o período e volta à tela de destino
+async def rota_periodo(update: Update, context: ContextTypes.DEFAULT_TYPE, argumento):
+    destino, _, tipo = argumento.partition(":")
+    hoje = datetime.now().date()
+    construtores = {
+        "mes": lambda: periodo_mes(hoje.month, hoje.year),
+        "trimestre": lambda: periodo_trimestre(hoje.month, hoje.year),
+        "ano_ate_hoje": lambda: periodo_ano_ate_hoje(hoje),
+        "ano": lambda: periodo_ano(hoje.year - 1),
+    }
+    # O callback_data vem do cliente: destino ou tipo desconhecido volta à tela anterior
+    if destino not in DESTINOS_PERIODO or (tipo != "personalizado" and tipo not in construtores):
+        logger.warning(f"Período inválido no callback: {argumento}")
         await handle_voltar(update, context)
         return
+    if tipo == "personalizado":
+        estado_conversa(update).periodo_destino = destino
+        await navegar_para(update, context, "periodo_personalizado")
+        return
+    setattr(estado_conversa(update), f'periodo_{destino}', construtores[tipo]())
+    await handle_voltar(update, context)
 
-    if query.data == "gasto_normal":
-        keyboard = [
-            [InlineKeyboardButton("ADICIONAR GASTO NORMAL", callback_data="gasto_normal_adicionar")],
-            [InlineKeyboardButton("EDITAR GASTO NORMAL", callback_data="editar_gasto")],
-            [InlineKeyboardButton("REMOVER GASTO NORMAL", callback_data="remover_gasto_normal")],
-            [InlineKeyboardButton("DEFINIR LIMITE DE GASTO", callback_data="definir_limite")],
-            [InlineKeyboardButton("Voltar", callback_data="voltar")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.message.edit_text("Escolha uma ação para Gasto Normal:", reply_markup=reply_markup)
-        context.user_data['navigation_stack'].append("start_gasto")
-    elif query.data == "gasto_fixo":
-        keyboard = [
-            [InlineKeyboardButton("ADICIONAR GASTO FIXO", callback_data="gasto_fixo_adicionar")],
-            [InlineKeyboardButton("EDITAR GASTO FIXO", callback_data="editar_gasto_fixo")],
-            [InlineKeyboardButton("REMOVER GASTO FIXO", callback_data="remover_gasto_fixo")],
-            [InlineKeyboardButton("Voltar", callback_data="voltar")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.message.edit_text("Escolha uma ação para Gasto Fixo:", reply_markup=reply_markup)
-        context.user_data['navigation_stack'].append("start_gasto")
-    elif query.data == "gasto_normal_adicionar":
-        keyboard = [[InlineKeyboardButton("Voltar", callback_data="voltar")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.message.edit_text("Por favor, insira o valor que você gastou (ex.: 100):", reply_markup=reply_markup)
-        context.user_data['state'] = 'awaiting_gasto_valor'
-        context.user_data['navigation_stack'].append("gasto_normal")
-    elif query.data == "gasto_fixo_adicionar":
-        keyboard = [
-            [InlineKeyboardButton("DIÁRIO", callback_data="gasto_fixo_diario")],
-            [InlineKeyboardButton("SEMANAL", callback_data="gasto_fixo_semanal")],
-            [InlineKeyboardButton("MENSAL", callback_data="gasto_fixo_mensal")],
-            [InlineKeyboardButton("Voltar", callback_data="voltar")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.message.edit_text("Escolha a periodicidade do gasto fixo:", reply_markup=reply_markup)
-        context.user_data['navigation_stack'].append("gasto_fixo")
-    elif query.data.startswith("gasto_fixo_"):
-        periodicidade = query.data[len("gasto_fixo_"):]
-        context.user_data['gasto_fixo_periodicidade'] = periodicidade.upper()
-        keyboard = [[InlineKeyboardButton("Voltar", callback_data="voltar")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.message.edit_text(f"Insira o valor do gasto fixo {periodicidade} (ex.: 100):", reply_markup=reply_markup)
-        context.user_data['state'] = 'awaiting_gasto_fixo_valor'
-        context.user_data['navigation_stack'].append("awaiting_gasto_fixo_periodicidade")
-    elif query.data.startswith("gasto_categoria_"):
-        categoria = query.data[len("gasto_categoria_"):]
-        if categoria == "Escrever Categoria":
-            keyboard = [[InlineKeyboardButton("Voltar", callback_data="voltar")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.message.edit_text("Por favor, escreva a categoria personalizada:", reply_markup=reply_markup)
-            context.user_data['state'] = 'awaiting_gasto_categoria'
-        else:
-            context.user_data['gasto_categoria'] = categoria
-            formas_pagamento = ["Cartão de Crédito", "Cartão de Débito", "Pix", "Dinheiro"]
-            keyboard = [
-                [InlineKeyboardButton(fp, callback_data=f"gasto_forma_{fp}") for fp in formas_pagamento[i:i+2]]
-                for i in range(0, len(formas_pagamento), 2)
-            ]
-            keyboard.append([InlineKeyboardButton("Voltar", callback_data="voltar")])
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.message.edit_text("Escolha a forma de pagamento:", reply_markup=reply_markup)
-            context.user_data['state'] = 'awaiting_gasto_forma'
-            context.user_data['navigation_stack'].append("awaiting_gasto_categoria")
-    elif query.data.startswith("gasto_forma_"):
-        forma_pagamento = query.data[len("gasto_forma_"):]
-        valor = context.user_data.get('gasto_valor')
-        categoria = context.user_data.get('gasto_categoria')
-        data = datetime.now().strftime('%Y-%m-%d')
-        try:
-            usuario = str(query.message.chat.id)
-            salvar_gasto(usuario, valor, categoria, forma_pagamento, data)
-            msg = f"Gasto normal de R${valor:.2f} na categoria '{categoria}' ({forma_pagamento}) salvo com sucesso!"
-            keyboard = [[InlineKeyboardButton("Voltar", callback_data="voltar")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.message.edit_text(msg, reply_markup=reply_markup)
-            context.user_data.pop('state', None)
-            context.user_data.pop('gasto_valor', None)
-            context.user_data.pop('gasto_categoria', None)
-            mes = datetime.now().month
-            ano = datetime.now().year
-            await verificar_limite(query, usuario, mes, ano)
-        except Exception as e:
-            logger.error(f"Erro ao salvar o gasto normal: {str(e)} - Dados: usuario={usuario}, valor={valor}, categoria={categoria}, forma_pagamento={forma_pagamento}, data={data}")
-            keyboard = [[InlineKeyboardButton("Voltar", callback_data="voltar")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.message.edit_text(f"Erro ao salvar o gasto normal: {str(e)}", reply_markup=reply_markup)
-    elif query.data.startswith("gasto_fixo_categoria_"):
-        categoria = query.data[len("gasto_fixo_categoria_"):]
-        if categoria == "Escrever Categoria":
-            keyboard = [[InlineKeyboardButton("Voltar", callback_data="voltar")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.message.edit_text("Por favor, escreva a categoria personalizada para o gasto fixo:", reply_markup=reply_markup)
-            context.user_data['state'] = 'awaiting_gasto_fixo_categoria'
-        else:
-            context.user_data['gasto_fixo_categoria'] = categoria
-            formas_pagamento = ["Cartão de Crédito", "Cartão de Débito", "Pix", "Dinheiro"]
-            keyboard = [
-                [InlineKeyboardButton(fp, callback_data=f"gasto_fixo_forma_{fp}") for fp in formas_pagamento[i:i+2]]
-                for i in range(0, len(formas_pagamento), 2)
-            ]
-            keyboard.append([InlineKeyboardButton("Voltar", callback_data="voltar")])
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.message.edit_text("Escolha a forma de pagamento do gasto fixo:", reply_markup=reply_markup)
-            context.user_data['state'] = 'awaiting_gasto_fixo_forma'
-            context.user_data['navigation_stack'].append("awaiting_gasto_fixo_forma")
-    elif query.data.startswith("gasto_fixo_forma_"):
-        forma_pagamento = query.data[len("gasto_fixo_forma_"):]
-        valor = context.user_data.get('gasto_fixo_valor')
-        categoria = context.user_data.get('gasto_fixo_categoria')
-        periodicidade = context.user_data.get('gasto_fixo_periodicidade')
-        data = datetime.now().strftime('%Y-%m-%d')
-        try:
-            usuario = str(query.message.chat.id)
-            salvar_gasto(usuario, valor, f"{categoria} ({periodicidade})", forma_pagamento, data)
-            msg = f"Gasto fixo de R${valor:.2f} na categoria '{categoria}' ({periodicidade}, {forma_pagamento}) salvo com sucesso!"
-            keyboard = [[InlineKeyboardButton("Voltar", callback_data="voltar")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.message.edit_text(msg, reply_markup=reply_markup)
-            context.user_data.pop('state', None)
-            context.user_data.pop('gasto_fixo_valor', None)
-            context.user_data.pop('gasto_fixo_categoria', None)
-            context.user_data.pop('gasto_fixo_periodicidade', None)
-            mes = datetime.now().month
-            ano = datetime.now().year
-            await verificar_limite(query, usuario, mes, ano)
-        except Exception as e:
-            logger.error(f"Erro ao salvar o gasto fixo: {str(e)}")
-            keyboard = [[InlineKeyboardButton("Voltar", callback_data="voltar")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.message.edit_text(f"Erro ao salvar o gasto fixo: {str(e)}", reply_markup=reply_markup)
-    elif query.data == "definir_limite":
-        keyboard = [[InlineKeyboardButton("Voltar", callback_data="voltar")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.message.edit_text("Por favor, insira o valor do limite (ex.: 1000):", reply_markup=reply_markup)
-        context.user_data['state'] = 'awaiting_definirlimite'
-        context.user_data['navigation_stack'].append("gasto_normal")
-
-# Handler para botões de entrada
-async def button_entrada(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
+async def rota_periodicidade(update: Update, context: ContextTypes.DEFAULT_TYPE, periodicidade):
+    estado_conversa(update).fluxo = FluxoGastoFixo(periodicidade)
+    await navegar_para(update, context, "gasto_fixo_valor")
 
-    if query.data == "entrada_adicionar":
-        keyboard = [[InlineKeyboardButton("Voltar", callback_data="voltar")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.message.edit_text("Por favor, insira o valor da entrada (ex.: 100) e a descrição (ex.: 'Salário'):", reply_markup=reply_markup)
-        context.user_data['state'] = 'awaiting_entrada'
-        context.user_data['navigation_stack'].append("start_entrada")
+async def rota_gasto_categoria(update: Update, context: ContextTypes.DEFAULT_TYPE, categoria):
+    fluxo = fluxo_atual(update, FluxoGasto)
+    if fluxo is None:
+        await sessao_expirada(update)
+        return
+    fluxo.categoria = categoria
+    await navegar_para(update, context, "gasto_forma")
 
-# Handler para botões de edição e remoção
-async def button_action(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
+async def rota_gasto_fixo_categoria(update: Update, context: ContextTypes.DEFAULT_TYPE, categoria):
+    fluxo = fluxo_atual(update, FluxoGastoFixo)
+    if fluxo is None or fluxo.valor is None:
+        await sessao_expirada(update)
+        return
+    fluxo.categoria = categoria
+    await navegar_para(update, context, "gasto_fixo_forma")
 
-    usuario = str(query.message.chat.id)
+async def rota_gasto_forma(update: Update, context: ContextTypes.DEFAULT_TYPE, forma_pagamento):
+    fluxo = fluxo_atual(update, FluxoGasto)
+    if fluxo is None or fluxo.categoria is None:
+        await sessao_expirada(update)
+        return
+    valor, categoria = fluxo.valor, fluxo.categoria
+    data = datetime.now().strftime('%Y-%m-%d')
+    usuario = obter_usuario(update)
+    try:
+        novo = salvar_gasto(usuario, em_reais(valor), categoria, forma_pagamento, data, chave_idempotencia(update))
+        msg = f"Gasto normal de {formatar_reais(valor)} na categoria '{categoria}' ({forma_pagamento}) salvo com sucesso!"
+        await exibir(update, msg, TECLADO_VOLTAR)
+        concluir_fluxo(update, retornar_para="gasto_normal")
+        if novo:
+            await verificar_limite(update, usuario, datetime.now().month, datetime.now().year)
+    except Exception as e:
+        logger.error(f"Erro ao salvar o gasto normal: {str(e)} - Dados: usuario={usuario}, valor={valor}, categoria={categoria}, forma_pagamento={forma_pagamento}, data={data}")
+        await exibir(update, f"Erro ao salvar o gasto normal: {str(e)}", TECLADO_VOLTAR)
+
+async def rota_gasto_fixo_forma(update: Update, context: ContextTypes.DEFAULT_TYPE, forma_pagamento):
+    fluxo = fluxo_atual(update, FluxoGastoFixo)
+    if fluxo is None or fluxo.valor is None or fluxo.categoria is None:
+        await sessao_expirada(update)
+        return
+    valor, categoria, periodicidade = fluxo.valor, fluxo.categoria, fluxo.periodicidade
+    data = datetime.now().strftime('%Y-%m-%d')
+    usuario = obter_usuario(update)
+    try:
+        novo = salvar_gasto(usuario, em_reais(valor), f"{categoria} ({periodicidade})", forma_pagamento, data, chave_idempotencia(update))
+        msg = f"Gasto fixo de {formatar_reais(valor)} na categoria '{categoria}' ({periodicidade}, {forma_pagamento}) salvo com sucesso!"
+        await exibir(update, msg, TECLADO_VOLTAR)
+        concluir_fluxo(update, retornar_para="gasto_fixo")
+        if novo:
+            await verificar_limite(update, usuario, datetime.now().month, datetime.now().year)
+    except Exception as e:
+        logger.error(f"Erro ao salvar o gasto fixo: {str(e)}")
+        await exibir(update, f"Erro ao salvar o gasto fixo: {str(e)}", TECLADO_VOLTAR)
+
+def seletor_edicao(tela_dados):
+    async def selecionar(update: Update, context: ContextTypes.DEFAULT_TYPE, item_id):
+        estado_conversa(update).fluxo = FluxoEdicao(int(item_id))
+        await navegar_para(update, context, tela_dados)
+    return selecionar
+
+def seletor_remocao(tipo):
+    async def selecionar(update: Update, context: ContextTypes.DEFAULT_TYPE, item_id):
+        estado_conversa(update).fluxo = FluxoRemocao(tipo, int(item_id))
+        await navegar_para(update, context, "confirmar_remocao")
+    return selecionar
+
+async def rota_confirmar_remover(update: Update, context: ContextTypes.DEFAULT_TYPE, resposta):
+    if resposta != "sim":
+        await exibir(update, "Remoção cancelada.", TECLADO_VOLTAR)
+        concluir_fluxo(update)
+        return
+    fluxo = fluxo_atual(update, FluxoRemocao)
+    if fluxo is None:
+        await sessao_expirada(update)
+        return
+    remover_id, remover_tipo = fluxo.item_id, fluxo.tipo
+    try:
+        usuario = obter_usuario(update)
+        if remover_tipo == 'entrada':
+            remover_entrada(usuario, remover_id)
+            msg = f"Entrada ID {remover_id} removida com sucesso!"
+        else:
+            remover_gasto(usuario, remover_id)
+            msg = f"Gasto {'fixo' if remover_tipo == 'gasto_fixo' else 'normal'} ID {remover_id} removido com sucesso!"
+        await exibir(update, msg, TECLADO_VOLTAR)
+        concluir_fluxo(update)
+    except Exception as e:
+        logger.error(f"Erro ao remover: {str(e)}")
+        await exibir(update, "Erro ao remover o item.", TECLADO_VOLTAR)
+
+def navegador_periodo(prefixo, delta):
+    async def navegar(update: Update, context: ContextTypes.DEFAULT_TYPE, argumento):
+        setattr(estado_conversa(update), f'periodo_{prefixo}', deslocar_periodo(periodo_selecionado(update, prefixo), delta))
+        await mostrar_tela(update, context, prefixo)
+    return navegar
 
-    if query.data == "voltar":
+async def rota_busca_pagina(update: Update, context: ContextTypes.DEFAULT_TYPE, pagina):
+    if not pagina.isdecimal():
+        logger.warning(f"Página inválida no callback: {pagina}")
         await handle_voltar(update, context)
         return
+    busca = estado_conversa(update).busca
+    if busca is not None:
+        busca.pagina = int(pagina)
+    await mostrar_tela(update, context, "busca_resultados")
 
-    if query.data == "editar_gasto":  # Para Gasto Normal
-        try:
-            gastos = listar_gastos_mensais(usuario, datetime.now().month, datetime.now().year)
-            gastos_normais = [g for g in gastos if not any(p in g[2] for p in ["(DIÁRIO)", "(SEMANAL)", "(MENSAL)"])]
-            if not gastos_normais:
-                keyboard = [[InlineKeyboardButton("Voltar", callback_data="voltar")]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await query.message.edit_text("Nenhum gasto normal registrado para editar.", reply_markup=reply_markup)
-                return
-            keyboard = [
-                [InlineKeyboardButton(f"ID {gasto[0]} - R${gasto[1]:.2f} - {gasto[2]} - {gasto[3]}", callback_data=f"editar_gasto_select_{gasto[0]}")]
-                for gasto in gastos_normais
-            ]
-            keyboard.append([InlineKeyboardButton("Voltar", callback_data="voltar")])
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.message.edit_text("Selecione o gasto normal para editar:", reply_markup=reply_markup)
-            context.user_data['navigation_stack'].append("gasto_normal")
-        except Exception as e:
-            logger.error(f"Erro ao carregar gastos para edição: {str(e)}")
-            keyboard = [[InlineKeyboardButton("Voltar", callback_data="voltar")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.message.edit_text("Erro ao carregar os gastos para edição.", reply_markup=reply_markup)
-    elif query.data == "editar_gasto_fixo":
-        try:
-            gastos = listar_gastos_mensais(usuario, datetime.now().month, datetime.now().year)
-            gastos_fixos = [g for g in gastos if any(p in g[2] for p in ["(DIÁRIO)", "(SEMANAL)", "(MENSAL)"])]
-            if not gastos_fixos:
-                keyboard = [[InlineKeyboardButton("Voltar", callback_data="voltar")]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await query.message.edit_text("Nenhum gasto fixo registrado para editar.", reply_markup=reply_markup)
-                return
-            keyboard = [
-                [InlineKeyboardButton(f"ID {gasto[0]} - R${gasto[1]:.2f} - {gasto[2]} - {gasto[3]}", callback_data=f"editar_gasto_select_{gasto[0]}")]
-                for gasto in gastos_fixos
-            ]
-            keyboard.append([InlineKeyboardButton("Voltar", callback_data="voltar")])
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.message.edit_text("Selecione o gasto fixo para editar:", reply_markup=reply_markup)
-            context.user_data['navigation_stack'].append("gasto_fixo")
-        except Exception as e:
-            logger.error(f"Erro ao carregar gastos fixos para edição: {str(e)}")
-            keyboard = [[InlineKeyboardButton("Voltar", callback_data="voltar")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.message.edit_text("Erro ao carregar os gastos fixos para edição.", reply_markup=reply_markup)
-    elif query.data == "editar_entrada":
-        try:
-            entradas = listar_entradas_mensais(usuario, datetime.now().month, datetime.now().year)
-            if not entradas:
-                keyboard = [[InlineKeyboardButton("Voltar", callback_data="voltar")]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await query.message.edit_text("Nenhum valor recebido registrado para editar.", reply_markup=reply_markup)
-                return
-            keyboard = [
-                [InlineKeyboardButton(f"ID {entrada[0]} - R${entrada[1]:.2f} - {entrada[2]}", callback_data=f"editar_entrada_select_{entrada[0]}")]
-                for entrada in entradas
-            ]
-            keyboard.append([InlineKeyboardButton("Voltar", callback_data="voltar")])
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.message.edit_text("Selecione o valor recebido para editar:", reply_markup=reply_markup)
-            context.user_data['navigation_stack'].append("start_entrada")
-        except Exception as e:
-            logger.error(f"Erro ao carregar entradas para edição: {str(e)}")
-            keyboard = [[InlineKeyboardButton("Voltar", callback_data="voltar")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.message.edit_text("Erro ao carregar os valores recebidos para edição.", reply_markup=reply_markup)
-    elif query.data.startswith("editar_gasto_select_"):
-        gasto_id = int(query.data[len("editar_gasto_select_"):])
-        context.user_data['editar_id'] = gasto_id
-        keyboard = [[InlineKeyboardButton("Voltar", callback_data="voltar")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.message.edit_text("Insira o novo valor (opcional), categoria (opcional) e forma de pagamento (opcional), separados por espaço (ex.: 200 Alimentação Cartão):", reply_markup=reply_markup)
-        context.user_data['state'] = 'awaiting_editar_dados_gasto'
-        context.user_data['navigation_stack'].append("editar_gasto")
-    elif query.data.startswith("editar_entrada_select_"):
-        entrada_id = int(query.data[len("editar_entrada_select_"):])
-        context.user_data['editar_id'] = entrada_id
-        keyboard = [[InlineKeyboardButton("Voltar", callback_data="voltar")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.message.edit_text("Insira o novo valor (opcional) e descrição (opcional), separados por espaço (ex.: 200 Salário):", reply_markup=reply_markup)
-        context.user_data['state'] = 'awaiting_editar_dados_entrada'
-        context.user_data['navigation_stack'].append("editar_entrada")
-    elif query.data == "remover_gasto_normal":
-        try:
-            gastos = listar_gastos_mensais(usuario, datetime.now().month, datetime.now().year)
-            gastos_normais = [g for g in gastos if not any(p in g[2] for p in ["(DIÁRIO)", "(SEMANAL)", "(MENSAL)"])]
-            if not gastos_normais:
-                keyboard = [[InlineKeyboardButton("Voltar", callback_data="voltar")]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await query.message.edit_text("Nenhum gasto normal registrado para remover.", reply_markup=reply_markup)
-                return
-            keyboard = [
-                [InlineKeyboardButton(f"ID {gasto[0]} - R${gasto[1]:.2f} - {gasto[2]} - {gasto[3]}", callback_data=f"remover_gasto_normal_select_{gasto[0]}")]
-                for gasto in gastos_normais
-            ]
-            keyboard.append([InlineKeyboardButton("Voltar", callback_data="voltar")])
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.message.edit_text("Selecione o gasto normal para remover:", reply_markup=reply_markup)
-            context.user_data['navigation_stack'].append("gasto_normal")
-        except Exception as e:
-            logger.error(f"Erro ao carregar gastos normais para remoção: {str(e)}")
-            keyboard = [[InlineKeyboardButton("Voltar", callback_data="voltar")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.message.edit_text("Erro ao carregar os gastos normais para remoção.", reply_markup=reply_markup)
-    elif query.data == "remover_gasto_fixo":
-        try:
-            gastos = listar_gastos_mensais(usuario, datetime.now().month, datetime.now().year)
-            gastos_fixos = [g for g in gastos if any(p in g[2] for p in ["(DIÁRIO)", "(SEMANAL)", "(MENSAL)"])]
-            if not gastos_fixos:
-                keyboard = [[InlineKeyboardButton("Voltar", callback_data="voltar")]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await query.message.edit_text("Nenhum gasto fixo registrado para remover.", reply_markup=reply_markup)
-                return
-            keyboard = [
-                [InlineKeyboardButton(f"ID {gasto[0]} - R${gasto[1]:.2f} - {gasto[2]} - {gasto[3]}", callback_data=f"remover_gasto_fixo_select_{gasto[0]}")]
-                for gasto in gastos_fixos
-            ]
-            keyboard.append([InlineKeyboardButton("Voltar", callback_data="voltar")])
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.message.edit_text("Selecione o gasto fixo para remover:", reply_markup=reply_markup)
-            context.user_data['navigation_stack'].append("gasto_fixo")
-        except Exception as e:
-            logger.error(f"Erro ao carregar gastos fixos para remoção: {str(e)}")
-            keyboard = [[InlineKeyboardButton("Voltar", callback_data="voltar")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.message.edit_text("Erro ao carregar os gastos fixos para remoção.", reply_markup=reply_markup)
-    elif query.data == "remover_entrada":
-        try:
-            entradas = listar_entradas_mensais(usuario, datetime.now().month, datetime.now().year)
-            if not entradas:
-                keyboard = [[InlineKeyboardButton("Voltar", callback_data="voltar")]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await query.message.edit_text("Nenhum valor recebido registrado para remover.", reply_markup=reply_markup)
-                return
-            keyboard = [
-                [InlineKeyboardButton(f"ID {entrada[0]} - R${entrada[1]:.2f} - {entrada[2]}", callback_data=f"remover_entrada_select_{entrada[0]}")]
-                for entrada in entradas
-            ]
-            keyboard.append([InlineKeyboardButton("Voltar", callback_data="voltar")])
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.message.edit_text("Selecione o valor recebido para remover:", reply_markup=reply_markup)
-            context.user_data['navigation_stack'].append("start_entrada")
-        except Exception as e:
-            logger.error(f"Erro ao carregar entradas para remoção: {str(e)}")
-            keyboard = [[InlineKeyboardButton("Voltar", callback_data="voltar")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.message.edit_text("Erro ao carregar os valores recebidos para remoção.", reply_markup=reply_markup)
-    elif query.data.startswith("remover_gasto_normal_select_"):
-        gasto_id = query.data[len("remover_gasto_normal_select_"):]
-        context.user_data['remover_id'] = gasto_id
-        context.user_data['remover_tipo'] = 'gasto_normal'
-        gastos = listar_gastos_mensais(usuario, datetime.now().month, datetime.now().year)
-        gasto = next((g for g in gastos if str(g[0]) == gasto_id), None)
-        if gasto:
-            opcao = f"o gasto normal ID {gasto[0]} - R${gasto[1]:.2f} - {gasto[2]} - {gasto[3]}"
-            keyboard = [
-                [
-                    InlineKeyboardButton("SIM", callback_data="confirmar_remover_sim"),
-                    InlineKeyboardButton("NÃO", callback_data="confirmar_remover_nao")
-                ],
-                [InlineKeyboardButton("Voltar", callback_data="voltar")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.message.edit_text(f"Você tem certeza que deseja remover {opcao}?", reply_markup=reply_markup)
-            context.user_data['navigation_stack'].append("remover_gasto_normal")
-    elif query.data.startswith("remover_gasto_fixo_select_"):
-        gasto_id = query.data[len("remover_gasto_fixo_select_"):]
-        context.user_data['remover_id'] = gasto_id
-        context.user_data['remover_tipo'] = 'gasto_fixo'
-        gastos = listar_gastos_mensais(usuario, datetime.now().month, datetime.now().year)
-        gasto = next((g for g in gastos if str(g[0]) == gasto_id), None)
-        if gasto:
-            opcao = f"o gasto fixo ID {gasto[0]} - R${gasto[1]:.2f} - {gasto[2]} - {gasto[3]}"
-            keyboard = [
-                [
-                    InlineKeyboardButton("SIM", callback_data="confirmar_remover_sim"),
-                    InlineKeyboardButton("NÃO", callback_data="confirmar_remover_nao")
-                ],
-                [InlineKeyboardButton("Voltar", callback_data="voltar")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.message.edit_text(f"Você tem certeza que deseja remover {opcao}?", reply_markup=reply_markup)
-            context.user_data['navigation_stack'].append("remover_gasto_fixo")
-    elif query.data.startswith("remover_entrada_select_"):
-        entrada_id = query.data[len("remover_entrada_select_"):]
-        context.user_data['remover_id'] = entrada_id
-        context.user_data['remover_tipo'] = 'entrada'
-        entradas = listar_entradas_mensais(usuario, datetime.now().month, datetime.now().year)
-        entrada = next((e for e in entradas if str(e[0]) == entrada_id), None)
-        if entrada:
-            opcao = f"a entrada ID {entrada[0]} - R${entrada[1]:.2f} - {entrada[2]}"
-            keyboard = [
-                [
-                    InlineKeyboardButton("SIM", callback_data="confirmar_remover_sim"),
-                    InlineKeyboardButton("NÃO", callback_data="confirmar_remover_nao")
-                ],
-                [InlineKeyboardButton("Voltar", callback_data="voltar")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.message.edit_text(f"Você tem certeza que deseja remover {opcao}?", reply_markup=reply_markup)
-            context.user_data['navigation_stack'].append("remover_entrada")
-    elif query.data == "confirmar_remover_sim":
-        try:
-            remover_id = context.user_data.get('remover_id')
-            remover_tipo = context.user_data.get('remover_tipo')
-            if remover_tipo == 'gasto_normal':
-                remover_gasto(usuario, int(remover_id))
-                msg = f"Gasto normal ID {remover_id} removido com sucesso!"
-            elif remover_tipo == 'gasto_fixo':
-                remover_gasto(usuario, int(remover_id))
-                msg = f"Gasto fixo ID {remover_id} removido com sucesso!"
-            elif remover_tipo == 'entrada':
-                remover_entrada(usuario, int(remover_id))
-                msg = f"Entrada ID {remover_id} removida com sucesso!"
-            keyboard = [[InlineKeyboardButton("Voltar", callback_data="voltar")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.message.edit_text(msg, reply_markup=reply_markup)
-            context.user_data.pop('remover_id', None)
-            context.user_data.pop('remover_tipo', None)
-        except Exception as e:
-            logger.error(f"Erro ao remover: {str(e)}")
-            keyboard = [[InlineKeyboardButton("Voltar", callback_data="voltar")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.message.edit_text("Erro ao remover o item.", reply_markup=reply_markup)
-    elif query.data == "confirmar_remover_nao":
-        keyboard = [[InlineKeyboardButton("Voltar", callback_data="voltar")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.message.edit_text("Remoção cancelada.", reply_markup=reply_markup)
+async def rota_resumo_grafico(update: Update, context: ContextTypes.DEFAULT_TYPE, argumento):
+    await enviar_grafico_resumo(update, context, periodo_selecionado(update, "resumo"))
 
-# Função para lidar com o botão "Voltar"
-async def handle_voltar(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def rota_excel_gerar(update: Update, context: ContextTypes.DEFAULT_TYPE, argumento):
+    await gerar_planilha_excel(update, context, periodo_selecionado(update, "excel"))
+
+# Handler único de callbacks: despacha pelo prefixo do callback_data (antes de ":")
+async def roteador_callbacks(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    if not context.user_data.get('navigation_stack') or len(context.user_data['navigation_stack']) == 0:
-        await start(query, context)  # Sempre volta ao menu inicial se a pilha estiver vazia
-        context.user_data['state'] = None  # Limpa o estado
-        return
+    await query.answer()
 
-    previous_state = context.user_data['navigation_stack'].pop()
+    acao, _, argumento = query.data.partition(":")
+    rota = ROTAS.get(acao)
+    if rota is None:
+        # Botões de mensagens antigas (formato anterior) voltam ao menu inicial
+        logger.warning(f"Callback desconhecido: {query.data}")
+        estado_conversa(update).pilha.clear()
+        await mostrar_tela(update, context, "start")
+        return
+    await perfilador.executar(acao, update, rota(update, context, argumento))
 
-    if previous_state == "start":
-        await start(query, context)
-    elif previous_state == "start_gasto":
-        keyboard = [
-            [InlineKeyboardButton("GASTO NORMAL", callback_data="gasto_normal")],
-            [InlineKeyboardButton("GASTO FIXO", callback_data="gasto_fixo")],
-            [InlineKeyboardButton("Voltar", callback_data="voltar")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.message.edit_text("Escolha o tipo de gasto:", reply_markup=reply_markup)
-    elif previous_state == "start_entrada":
-        keyboard = [
-            [InlineKeyboardButton("ADICIONAR VALOR RECEBIDO", callback_data="entrada_adicionar")],
-            [InlineKeyboardButton("EDITAR VALOR RECEBIDO", callback_data="editar_entrada")],
-            [InlineKeyboardButton("REMOVER VALOR RECEBIDO", callback_data="remover_entrada")],
-            [InlineKeyboardButton("Voltar", callback_data="voltar")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.message.edit_text("Escolha uma ação para Valor Recebido:", reply_markup=reply_markup)
-    elif previous_state == "gasto_normal":
-        keyboard = [
-            [InlineKeyboardButton("ADICIONAR GASTO NORMAL", callback_data="gasto_normal_adicionar")],
-            [InlineKeyboardButton("EDITAR GASTO NORMAL", callback_data="editar_gasto")],
-            [InlineKeyboardButton("REMOVER GASTO NORMAL", callback_data="remover_gasto_normal")],
-            [InlineKeyboardButton("DEFINIR LIMITE DE GASTO", callback_data="definir_limite")],
-            [InlineKeyboardButton("Voltar", callback_data="voltar")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.message.edit_text("Escolha uma ação para Gasto Normal:", reply_markup=reply_markup)
-    elif previous_state == "gasto_fixo":
-        keyboard = [
-            [InlineKeyboardButton("ADICIONAR GASTO FIXO", callback_data="gasto_fixo_adicionar")],
-            [InlineKeyboardButton("EDITAR GASTO FIXO", callback_data="editar_gasto_fixo")],
-            [InlineKeyboardButton("REMOVER GASTO FIXO", callback_data="remover_gasto_fixo")],
-            [InlineKeyboardButton("Voltar", callback_data="voltar")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.message.edit_text("Escolha uma ação para Gasto Fixo:", reply_markup=reply_markup)
-    elif previous_state == "editar_gasto":
-        await button_action(Update(0, query.message), context, "editar_gasto")
-    elif previous_state == "editar_gasto_fixo":
-        await button_action(Update(0, query.message), context, "editar_gasto_fixo")
-    elif previous_state == "editar_entrada":
-        await button_action(Update(0, query.message), context, "editar_entrada")
-    elif previous_state == "remover_gasto_normal":
-        await button_action(Update(0, query.message), context, "remover_gasto_normal")
-    elif previous_state == "remover_gasto_fixo":
-        await button_action(Update(0, query.message), context, "remover_gasto_fixo")
-    elif previous_state == "remover_entrada":
-        await button_action(Update(0, query.message), context, "remover_entrada")
-    elif previous_state == "awaiting_gasto_valor":
-        keyboard = [
-            [InlineKeyboardButton("ADICIONAR GASTO NORMAL", callback_data="gasto_normal_adicionar")],
-            [InlineKeyboardButton("EDITAR GASTO NORMAL", callback_data="editar_gasto")],
-            [InlineKeyboardButton("REMOVER GASTO NORMAL", callback_data="remover_gasto_normal")],
-            [InlineKeyboardButton("DEFINIR LIMITE DE GASTO", callback_data="definir_limite")],
-            [InlineKeyboardButton("Voltar", callback_data="voltar")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.message.edit_text("Escolha uma ação para Gasto Normal:", reply_markup=reply_markup)
-        context.user_data['state'] = None
-    elif previous_state == "awaiting_gasto_categoria":
-        categorias = ["Alimentação", "Lazer", "Transporte", "Saúde", "Outros", "Escrever Categoria"]
-        keyboard = [
-            [InlineKeyboardButton(cat, callback_data=f"gasto_categoria_{cat}") for cat in categorias[i:i+2]]
-            for i in range(0, len(categorias), 2)
-        ]
-        keyboard.append([InlineKeyboardButton("Voltar", callback_data="voltar")])
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.message.edit_text("Escolha a categoria do gasto ou escreva uma personalizada:", reply_markup=reply_markup)
-        context.user_data['state'] = 'awaiting_gasto_categoria'
-    elif previous_state == "awaiting_gasto_fixo_periodicidade":
-        keyboard = [
-            [InlineKeyboardButton("DIÁRIO", callback_data="gasto_fixo_diario")],
-            [InlineKeyboardButton("SEMANAL", callback_data="gasto_fixo_semanal")],
-            [InlineKeyboardButton("MENSAL", callback_data="gasto_fixo_mensal")],
-            [InlineKeyboardButton("Voltar", callback_data="voltar")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.message.edit_text("Escolha a periodicidade do gasto fixo:", reply_markup=reply_markup)
-    elif previous_state == "awaiting_gasto_fixo_valor":
-        periodicidade = context.user_data.get('gasto_fixo_periodicidade', '').lower()
-        keyboard = [[InlineKeyboardButton("Voltar", callback_data="voltar")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.message.edit_text(f"Insira o valor do gasto fixo {periodicidade} (ex.: 100):", reply_markup=reply_markup)
-        context.user_data['state'] = 'awaiting_gasto_fixo_valor'
-    elif previous_state == "awaiting_gasto_fixo_categoria":
-        categorias = ["Alimentação", "Lazer", "Transporte", "Saúde", "Outros", "Escrever Categoria"]
-        keyboard = [
-            [InlineKeyboardButton(cat, callback_data=f"gasto_fixo_categoria_{cat}") for cat in categorias[i:i+2]]
-            for i in range(0, len(categorias), 2)
-        ]
-        keyboard.append([InlineKeyboardButton("Voltar", callback_data="voltar")])
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.message.edit_text("Escolha a categoria do gasto fixo ou escreva uma personalizada:", reply_markup=reply_markup)
-        context.user_data['state'] = 'awaiting_gasto_fixo_categoria'
-    elif previous_state == "awaiting_gasto_fixo_forma":
-        formas_pagamento = ["Cartão de Crédito", "Cartão de Débito", "Pix", "Dinheiro"]
-        keyboard = [
-            [InlineKeyboardButton(fp, callback_data=f"gasto_fixo_forma_{fp}") for fp in formas_pagamento[i:i+2]]
-            for i in range(0, len(formas_pagamento), 2)
-        ]
-        keyboard.append([InlineKeyboardButton("Voltar", callback_data="voltar")])
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.message.edit_text("Escolha a forma de pagamento do gasto fixo:", reply_markup=reply_markup)
-        context.user_data['state'] = 'awaiting_gasto_fixo_forma'
-    elif previous_state == "start_resumo":
-        await start(query, context)
-    elif previous_state == "start_excel":
-        mes = context.user_data.get('excel_mes', datetime.now().month)
-        ano = context.user_data.get('excel_ano', datetime.now().year)
-        await mostrar_selecao_excel(update, context, mes, ano)
-
-# Comando /resumo
+# Comando /resumo (aceita um período: /resumo 2024, /resumo 10/2024, /resumo T3 2024 ou /resumo 01/01/2024 31/03/2024)
 async def resumo(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    mes = datetime.now().month
-    ano = datetime.now().year
-    context.user_data['resumo_mes'] = mes
-    context.user_data['resumo_ano'] = ano
-    context.user_data['navigation_stack'].append("start")
-    await mostrar_resumo(update, context, mes, ano)
+    periodo = periodo_mes(datetime.now().month, datetime.now().year)
+    if context.args:
+        periodo = interpretar_periodo(" ".join(context.args), datetime.now().date())
+        if periodo is None:
+            await responder(update, "Período inválido. Use: /resumo AAAA, /resumo MM/AAAA, /resumo T3 2024 ou /resumo INÍCIO FIM (ex.: 01/01/2024 31/03/2024).")
+            return
+    estado_conversa(update).periodo_resumo = periodo
+    await navegar_para(update, context, "resumo")
+
+# Função para montar o texto do resumo de um período (valores em centavos); com a evolução por intervalo (serie),
+# ela substitui a recomendação, que considera gastos de um único mês
+def formatar_resumo(rotulo, gastos, entradas, baselines=None, serie=None, granularidade="month"):
+    resumo = f"Resumo de {rotulo}:\n"
+
+    if gastos:
+        resumo += "Gastos:\n"
+        emojis = ["🟦", "🟩", "🟪", "🟥", "🟧"]
+        max_valor = max(total for _, total in gastos)
+        for i, (categoria, total) in enumerate(gastos):
+            emoji = emojis[i % len(emojis)]
+            bar_length = total * 10 // max_valor if max_valor > 0 else 0
+            bar = "▬" * bar_length
+            resumo += f"{emoji} {categoria}: {formatar_reais(total)} {bar}\n"
+        total_gastos = sum(total for _, total in gastos)
+        resumo += f"Total Gasto: {formatar_reais(total_gastos)}\n"
+    else:
+        resumo += "Nenhum gasto registrado.\n"
+        total_gastos = 0
+
+    resumo += f"\nEntradas: {formatar_reais(entradas)}\n"
+    saldo = entradas - total_gastos
+    resumo += f"Saldo: {formatar_reais(saldo)}\n"
+
+    if serie:
+        resumo += "\nEvolução:\n"
+        for intervalo, gastos_intervalo, entradas_intervalo in serie:
+            intervalo = f"{intervalo:%m/%Y}" if granularidade == "month" else f"semana de {intervalo:%d/%m}"
+            resumo += f"{intervalo}: gastos {formatar_reais(gastos_intervalo)} | entradas {formatar_reais(entradas_intervalo)}\n"
+    elif gastos:
+        recomendacao = gerar_recomendacao(gastos, baselines)
+        resumo += f"\nRecomendação: {recomendacao}"
+    return resumo
+
+# Últimas telas de leitura geradas por (usuário, tela): enquanto o banco está indisponível elas são
+# mostradas no lugar da mensagem de erro, com o horário em que foram geradas
+TELAS_SALVAS_HORAS = config("TELAS_SALVAS_HORAS", default=24, cast=float)
+telas_salvas = CacheTTL(ttl=TELAS_SALVAS_HORAS * 3600, max_itens=5000)
+
+def salvar_tela(chave, texto, reply_markup, parse_mode=None):
+    telas_salvas.guardar(chave, (texto, reply_markup, parse_mode, datetime.now()))
+
+async def exibir_tela_salva(update: Update, chave):
+    salva = telas_salvas.obter(chave)
+    if salva is None:
+        await exibir(update, MENSAGEM_BANCO_INDISPONIVEL, TECLADO_VOLTAR)
+        return
+    texto, reply_markup, parse_mode, gerada_em = salva
+    aviso = f"{MENSAGEM_BANCO_INDISPONIVEL}\nMostrando os dados de {gerada_em:%d/%m %H:%M}.\n\n"
+    await exibir(update, (escape(aviso) if parse_mode == "HTML" else aviso) + texto, reply_markup, parse_mode=parse_mode)
 
 # Função para mostrar o resumo com botões
-async def mostrar_resumo(update: Update, context: ContextTypes.DEFAULT_TYPE, mes, ano):
-    usuario = str(update.message.chat.id) if update.message else str(update.callback_query.message.chat.id)
+async def mostrar_resumo(update: Update, context: ContextTypes.DEFAULT_TYPE, periodo):
+    usuario = obter_usuario(update)
     try:
-        gastos = obter_gastos_mensais(usuario, mes, ano)
-        entradas = obter_entradas_mensais(usuario, mes, ano)
-        resumo = f"Resumo de {mes:02d}/{ano}:\n"
-        
-        if gastos:
-            resumo += "Gastos:\n"
-            emojis = ["🟦", "🟩", "🟪", "🟥", "🟧"]
-            max_valor = max(total for _, total in gastos)
-            for i, (categoria, total) in enumerate(gastos):
-                emoji = emojis[i % len(emojis)]
-                bar_length = int((total / max_valor) * 10) if max_valor > 0 else 0
-                bar = "▬" * bar_length
-                resumo += f"{emoji} {categoria}: R${total:.2f} {bar}\n"
-            total_gastos = sum(total for _, total in gastos)
-            resumo += f"Total Gasto: R${total_gastos:.2f}\n"
-        else:
-            resumo += "Nenhum gasto registrado.\n"
-            total_gastos = 0
-        
-        resumo += f"\nEntradas: R${entradas:.2f}\n"
-        saldo = entradas - total_gastos
-        resumo += f"Saldo: R${saldo:.2f}\n"
-        
-        if gastos:
-            recomendacao = gerar_recomendacao(gastos)
-            resumo += f"\nRecomendação: {recomendacao}"
-
-        keyboard = [
-            [
-                InlineKeyboardButton("⬅️ Mês Anterior", callback_data="resumo_prev"),
-                InlineKeyboardButton("Voltar", callback_data="voltar"),
-                InlineKeyboardButton("Mês Próximo ➡️", callback_data="resumo_next")
-            ]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-
-        if update.message:
-            await update.message.reply_text(resumo, reply_markup=reply_markup)
-        else:
-            await update.callback_query.message.edit_text(resumo, reply_markup=reply_markup)
+        granularidade = granularidade_periodo(periodo)
+        gastos, entradas, serie = obter_resumo_periodo(usuario, periodo.inicio, periodo.fim, granularidade)
+        baselines = obter_baselines(usuario) if gastos and periodo.tipo == "mes" and repositorio.analises else None
+        resumo = formatar_resumo(rotulo_periodo(periodo), gastos, entradas, baselines, serie, granularidade)
+        if repositorio.analises and periodo == periodo_mes(datetime.now().month, datetime.now().year):
+            previsao, limite = prever_gasto_mensal(usuario)
+            resumo += f"\n\n📈 Projeção para o fim do mês: {formatar_reais(previsao)}"
+            if limite is not None and previsao > limite:
+                resumo += f"\n⚠️ No ritmo atual você deve ultrapassar seu limite de {formatar_reais(limite)}."
+        salvar_tela((usuario, "resumo", periodo), resumo, TECLADO_RESUMO)
+        await exibir(update, resumo, TECLADO_RESUMO)
+    except BancoIndisponivel:
+        await exibir_tela_salva(update, (usuario, "resumo", periodo))
     except Exception as e:
         logger.error(f"Erro ao gerar resumo: {e}")
-        keyboard = [[InlineKeyboardButton("Voltar", callback_data="voltar")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        if update.message:
-            await update.message.reply_text("Erro ao gerar o resumo.", reply_markup=reply_markup)
-        else:
-            await update.callback_query.message.edit_text("Erro ao gerar o resumo.", reply_markup=reply_markup)
+        await exibir(update, "Erro ao gerar o resumo.", TECLADO_VOLTAR)
 
-# Handler para botões de navegação do /resumo
-async def button_resumo(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
+# Gráficos do resumo: renderizados em processos separados (matplotlib sem interface gráfica)
+# para não travar o loop de eventos, e reenviados pelo file_id do Telegram enquanto os
+# dados do mês não mudarem
+GRAFICO_PROCESSOS = config("GRAFICO_PROCESSOS", default=1, cast=int)
+executor_graficos = ProcessPoolExecutor(max_workers=GRAFICO_PROCESSOS, mp_context=multiprocessing.get_context("spawn"))
+cache_graficos = CacheTTL(ttl=86400, max_itens=5000)
 
-    if query.data == "voltar":
-        await handle_voltar(update, context)
-        return
+# Função para desenhar o gráfico do mês (executada no processo de renderização): gastos por
+# categoria à esquerda e entradas x gastos à direita, com os valores em centavos (convertidos para
+# reais só na escala do eixo). Retorna o PNG em bytes
+def renderizar_grafico_resumo(rotulo, gastos, entradas):
+    figura = Figure(figsize=(10, 5), dpi=100)
+    eixo_categorias, eixo_saldo = figura.subplots(1, 2, gridspec_kw={"width_ratios": [3, 1]})
+
+    gastos = sorted(gastos, key=lambda item: item[1])
+    if gastos:
+        categorias, totais = zip(*gastos)
+        barras = eixo_categorias.barh(categorias, [t / 100 for t in totais], color="#4C72B0")
+        eixo_categorias.bar_label(barras, labels=[formatar_reais(t) for t in totais], padding=3, fontsize=8)
+        eixo_categorias.margins(x=0.25)
+    else:
+        eixo_categorias.text(0.5, 0.5, "Nenhum gasto registrado", ha="center", va="center", transform=eixo_categorias.transAxes)
+    eixo_categorias.set_title("Gastos por categoria")
+    eixo_categorias.set_xlabel("Valor (R$)")
+
+    total_gastos = sum(totais) if gastos else 0
+    barras = eixo_saldo.bar(["Entradas", "Gastos"], [entradas / 100, total_gastos / 100], color=["#55A868", "#C44E52"])
+    eixo_saldo.bar_label(barras, labels=[formatar_reais(entradas), formatar_reais(total_gastos)], padding=3, fontsize=8)
+    eixo_saldo.margins(y=0.15)
+    eixo_saldo.set_title("Entradas x Gastos")
+
+    figura.suptitle(f"Resumo de {rotulo}")
+    figura.tight_layout()
+    saida = BytesIO()
+    figura.savefig(saida, format="png")
+    return saida.getvalue()
 
-    mes = context.user_data.get('resumo_mes', datetime.now().month)
-    ano = context.user_data.get('resumo_ano', datetime.now().year)
+# Função para enviar o gráfico do mês, reaproveitando o file_id já enviado quando nada mudou
+async def enviar_grafico_resumo(update: Update, context: ContextTypes.DEFAULT_TYPE, periodo):
+    usuario = obter_usuario(update)
+    chat_id = update.effective_chat.id
+    rotulo = rotulo_periodo(periodo)
+    legenda = f"📊 Gráfico de {rotulo}"
+    try:
+        chave = (usuario, periodo.inicio, periodo.fim, versao_dados(usuario))
+        file_id = cache_graficos.obter(chave)
+        if file_id is not None:
+            try:
+                await agendador_envios.enviar_foto(chat_id, file_id, caption=legenda)
+                metricas.incrementar("graficos")
+                return
+            except BadRequest as e:
+                logger.warning(f"file_id do gráfico em cache recusado, renderizando de novo: {e}")
+
+        resumo_periodo = obter_resumo_periodo(usuario, periodo.inicio, periodo.fim)
+        png = await asyncio.get_running_loop().run_in_executor(
+            executor_graficos, renderizar_grafico_resumo, rotulo, resumo_periodo.gastos, resumo_periodo.entradas
+        )
+        mensagem = await agendador_envios.enviar_foto(chat_id, png, caption=legenda)
+        cache_graficos.guardar(chave, mensagem.photo[-1].file_id)
+        metricas.incrementar("graficos")
+    except Exception as e:
+        logger.error(f"Erro ao gerar gráfico do resumo: {e}")
+        await responder(update, "Erro ao gerar o gráfico.", TECLADO_VOLTAR)
+
+# Função para montar a tabela de tendências (um bloco por categoria, o total primeiro)
+TAMANHO_MAXIMO_MENSAGEM = 4096
 
-    if query.data == "resumo_prev":
-        mes -= 1
-        if mes < 1:
-            mes = 12
-            ano -= 1
-    elif query.data == "resumo_next":
-        mes += 1
-        if mes > 12:
-            mes = 1
-            ano += 1
+def formatar_tendencias(tendencias, meses=12):
+    blocos = {}
+    for categoria, mes, total, variacao, media in tendencias:
+        variacao = "" if variacao is None else f"{em_reais(variacao):+}"
+        blocos.setdefault(categoria, []).append(f"{mes:%m/%y} {em_reais(total):>9} {variacao:>9} {em_reais(media):>9}")
+    somas = {categoria: sum(t[2] for t in tendencias if t[0] == categoria) for categoria in blocos}
+    ordem = sorted(blocos, key=lambda categoria: (categoria is not None, -somas[categoria]))
 
-    context.user_data['resumo_mes'] = mes
-    context.user_data['resumo_ano'] = ano
+    texto = f"📈 Tendências dos últimos {meses} meses\n(total | variação sobre o mês anterior | média acumulada)\n"
+    for categoria in ordem:
+        bloco = (f"\n<b>{escape(categoria) if categoria is not None else 'Total'}</b>\n"
+                 f"<pre>{'Mês':<5} {'Total':>9} {'Var.':>9} {'Média':>9}\n" + "\n".join(blocos[categoria]) + "</pre>")
+        if len(texto) + len(bloco) > TAMANHO_MAXIMO_MENSAGEM - 50:
+            texto += "\n… demais categorias omitidas."
+            break
+        texto += bloco
+    return texto
+
+# Tela dinâmica das tendências
+async def tela_tendencias(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not repositorio.analises:
+        await exibir(update, "As tendências estão disponíveis apenas com o banco PostgreSQL.", TECLADO_VOLTAR)
+        return
+    usuario = obter_usuario(update)
+    try:
+        tendencias = obter_tendencias(usuario)
+        if not tendencias:
+            await exibir(update, "Nenhum gasto registrado nos últimos 12 meses.", TECLADO_VOLTAR)
+            return
+        texto = formatar_tendencias(tendencias)
+        salvar_tela((usuario, "tendencias"), texto, TECLADO_VOLTAR, parse_mode="HTML")
+        await exibir(update, texto, TECLADO_VOLTAR, parse_mode="HTML")
+    except BancoIndisponivel:
+        await exibir_tela_salva(update, (usuario, "tendencias"))
+    except Exception as e:
+        logger.error(f"Erro ao gerar tendências: {e}")
+        await exibir(update, "Erro ao gerar as tendências.", TECLADO_VOLTAR)
 
-    await mostrar_resumo(update, context, mes, ano)
+# Comando /tendencias
+async def tendencias(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await navegar_para(update, context, "tendencias")
 
-# Comando /powerbi
-POWER_BI_BASE_LINK = "https://app.powerbi.com/links/vv8SkpDKaL?filter=public%20gastos/usuario%20eq%20'"
+# Comando /powerbi: o relatório lê a visão relatorios.gastos_bi (esquema estrela pré-agregado),
+# filtrada pelo usuário, e não a tabela de gastos do bot
+POWER_BI_BASE_LINK = config("POWER_BI_BASE_LINK", default="https://app.powerbi.com/links/vv8SkpDKaL?filter=relatorios%20gastos_bi/usuario%20eq%20")
 async def send_powerbi_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         query = update.callback_query
         user_id = str(query.from_user.id)
         filtered_link = f"{POWER_BI_BASE_LINK}'{user_id}'"
-        keyboard = [[InlineKeyboardButton("Voltar", callback_data="voltar")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.message.edit_text(f"Veja seu relatório (faça login no Power BI): {filtered_link}", reply_markup=reply_markup)
+        await exibir(update, f"Veja seu relatório (faça login no Power BI): {filtered_link}", TECLADO_VOLTAR)
+        metricas.incrementar("links_powerbi")
     except Exception as e:
         logger.error(f"Erro ao gerar link do Power BI: {str(e)}")
-        keyboard = [[InlineKeyboardButton("Voltar", callback_data="voltar")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.message.edit_text("Erro ao gerar o link do Power BI.", reply_markup=reply_markup)
+        await exibir(update, "Erro ao gerar o link do Power BI.", TECLADO_VOLTAR)
 
 # Função para gerar e enviar a planilha Excel com gráficos e resumo
-async def gerar_planilha_excel(update: Update, context: ContextTypes.DEFAULT_TYPE, mes, ano):
+async def gerar_planilha_excel(update: Update, context: ContextTypes.DEFAULT_TYPE, periodo):
     query = update.callback_query
-    await query.answer()
 
     usuario = str(query.message.chat.id)
+    rotulo = rotulo_periodo(periodo)
     try:
-        gastos = listar_gastos_mensais(usuario, mes, ano)
-        entradas = listar_entradas_mensais(usuario, mes, ano)
-        gastos_resumo = obter_gastos_mensais(usuario, mes, ano)
-        total_entradas = obter_entradas_mensais(usuario, mes, ano)
-        total_gastos = obter_total_gastos_mensais(usuario, mes, ano)
+        gastos = listar_gastos_periodo(usuario, periodo.inicio, periodo.fim)
+        entradas = listar_entradas_periodo(usuario, periodo.inicio, periodo.fim)
+        gastos_resumo, total_entradas, serie = obter_resumo_periodo(usuario, periodo.inicio, periodo.fim)
+        total_gastos = sum(total for _, total in gastos_resumo)
 
         if gastos:
             df_gastos = pd.DataFrame(gastos, columns=['ID', 'Valor', 'Categoria', 'Forma de Pagamento', 'Data'])
@@ -1206,15 +4799,20 @@ async def gerar_planilha_excel(update: Update, context: ContextTypes.DEFAULT_TYP
             df_entradas = pd.DataFrame(entradas, columns=['ID', 'Valor', 'Descrição', 'Data'])
         else:
             df_entradas = pd.DataFrame(columns=['ID', 'Valor', 'Descrição', 'Data'])
+        # Valores das linhas em centavos int64 e convertidos para reais só na planilha
+        for df in (df_gastos, df_entradas):
+            df['Valor'] = np.fromiter(map(em_centavos, df['Valor']), dtype=np.int64, count=len(df)) / 100
 
         if gastos_resumo:
-            df_gastos_resumo = pd.DataFrame(gastos_resumo, columns=['Categoria', 'Total'])
+            df_gastos_resumo = pd.DataFrame(
+                [(categoria, em_reais(total)) for categoria, total in gastos_resumo], columns=['Categoria', 'Total']
+            )
         else:
             df_gastos_resumo = pd.DataFrame(columns=['Categoria', 'Total'])
 
         df_resumo = pd.DataFrame({
             'Descrição': ['Total de Gastos', 'Total de Entradas', 'Saldo'],
-            'Valor': [total_gastos, total_entradas, total_entradas - total_gastos]
+            'Valor': [em_reais(total_gastos), em_reais(total_entradas), em_reais(total_entradas - total_gastos)]
         })
 
         output = BytesIO()
@@ -1223,12 +4821,18 @@ async def gerar_planilha_excel(update: Update, context: ContextTypes.DEFAULT_TYP
             df_entradas.to_excel(writer, sheet_name='Entradas', index=False)
             df_gastos_resumo.to_excel(writer, sheet_name='Gastos por Categoria', index=False)
             df_resumo.to_excel(writer, sheet_name='Resumo', index=False)
+            if serie:
+                pd.DataFrame(
+                    [(f"{intervalo:%m/%Y}", em_reais(gastos_mes), em_reais(entradas_mes), em_reais(entradas_mes - gastos_mes))
+                     for intervalo, gastos_mes, entradas_mes in serie],
+                    columns=['Mês', 'Gastos', 'Entradas', 'Saldo']
+                ).to_excel(writer, sheet_name='Evolução Mensal', index=False)
 
             workbook = writer.book
             worksheet = workbook['Gastos por Categoria']
 
             chart = BarChart()
-            chart.title = f"Gastos por Categoria - {mes:02d}/{ano}"
+            chart.title = f"Gastos por Categoria - {rotulo}"
             chart.x_axis.title = "Categoria"
             chart.y_axis.title = "Valor (R$)"
 
@@ -1244,38 +4848,434 @@ async def gerar_planilha_excel(update: Update, context: ContextTypes.DEFAULT_TYP
 
         output.seek(0)
 
-        await query.message.reply_document(
-            document=output,
-            filename=f"relatorio_financeiro_{usuario}_{mes:02d}_{ano}.xlsx",
-            caption=f"Planilha de {mes:02d}/{ano} gerada com sucesso!"
+        await agendador_envios.enviar_documento(
+            query.message.chat.id,
+            output,
+            filename=f"relatorio_financeiro_{usuario}_{periodo.inicio:%Y-%m-%d}_{periodo.fim - timedelta(days=1):%Y-%m-%d}.xlsx",
+            caption=f"Planilha de {rotulo} gerada com sucesso!"
         )
         output.close()
+        metricas.incrementar("planilhas")
 
-        keyboard = [[InlineKeyboardButton("Voltar", callback_data="voltar")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.message.reply_text("Planilha gerada com sucesso!", reply_markup=reply_markup)
-        context.user_data['navigation_stack'].append("start")
+        await responder(update, "Planilha gerada com sucesso!", TECLADO_VOLTAR)
 
     except Exception as e:
         logger.error(f"Erro ao gerar planilha Excel: {e}")
-        keyboard = [[InlineKeyboardButton("Voltar", callback_data="voltar")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.message.edit_text(f"Erro ao gerar a planilha: {str(e)}", reply_markup=reply_markup)
+        await exibir(update, f"Erro ao gerar a planilha: {str(e)}", TECLADO_VOLTAR)
+
+# Backup da conta inteira em JSON Lines comprimido com gzip: uma linha de cabeçalho e depois um
+# registro por linha ({"tipo": "gasto", "id": ..., "valor": "12.50", ...}), com as colunas de
+# COLUNAS_BACKUP. Valores vão como texto para não perder centavos. O arquivo é escrito e lido
+# aos poucos (em disco, não em memória) e o mesmo formato serve para o PostgreSQL e o SQLite
+BACKUP_VERSAO = 1
+BACKUP_LOTE = config("BACKUP_LOTE", default=1000, cast=int)
+BACKUP_TAMANHO_MAXIMO_MB = config("BACKUP_TAMANHO_MAXIMO_MB", default=20, cast=int)
+COLUNAS_BACKUP = {
+    "gasto": ("id", "valor", "categoria", "forma_pagamento", "data"),
+    "entrada": ("id", "valor", "descricao", "data"),
+    "limite": ("valor",),
+    "limite_categoria": ("categoria", "valor"),
+    "gasto_arquivado": ("mes", "categoria", "total", "quantidade"),
+    "entrada_arquivada": ("mes", "total", "quantidade"),
+}
+ROTULOS_BACKUP = {
+    "gasto": "gastos", "entrada": "entradas", "limite": "limite geral", "limite_categoria": "limites por categoria",
+    "gasto_arquivado": "meses arquivados de gastos", "entrada_arquivada": "meses arquivados de entradas",
+}
+
+def valor_backup(valor):
+    valor = Decimal(str(valor)).quantize(Decimal("0.01"))
+    if not valor.is_finite() or valor < 0:
+        raise ValueError(f"valor inválido: {valor}")
+    return valor
+
+def texto_backup(texto):
+    if not isinstance(texto, str) or not texto.strip():
+        raise ValueError("texto vazio")
+    return texto
+
+def texto_opcional_backup(texto):
+    return None if texto is None else str(texto)
+
+CONVERSORES_BACKUP = {
+    "id": int, "quantidade": int, "valor": valor_backup, "total": valor_backup,
+    "data": date.fromisoformat, "mes": date.fromisoformat,
+    "categoria": texto_backup, "descricao": texto_opcional_backup, "forma_pagamento": texto_opcional_backup,
+}
+
+def resumir_contagem_backup(contagem):
+    return "\n".join(f"• {ROTULOS_BACKUP[tipo]}: {contagem[tipo]}" for tipo in COLUNAS_BACKUP if contagem[tipo]) or "• nenhum registro"
+
+# Função para escrever o backup do usuário em um arquivo temporário; devolve (arquivo, {tipo: registros})
+def gerar_backup(usuario):
+    arquivo = tempfile.TemporaryFile()
+    contagem = Counter()
+    try:
+        with gzip.GzipFile(fileobj=arquivo, mode="wb") as saida:
+            # Antes de "arquivado_ate" o backup só tem os totais mensais (gasto_arquivado e entrada_arquivada)
+            corte = repositorio.obter_corte_arquivo(usuario)
+            cabecalho = {
+                "tipo": "cabecalho", "versao": BACKUP_VERSAO, "usuario": usuario, "gerado_em": datetime.now().isoformat(timespec="seconds"),
+                "arquivado_ate": corte.isoformat() if corte else None,
+            }
+            saida.write((json.dumps(cabecalho) + "\n").encode())
+            for tipo, linha in repositorio.exportar_conta(usuario):
+                registro = {"tipo": tipo, **dict(zip(COLUNAS_BACKUP[tipo], linha))}
+                # Valores sempre como texto com centavos (o SQLite devolve float, o PostgreSQL Decimal)
+                for coluna in ("valor", "total"):
+                    if coluna in registro:
+                        registro[coluna] = str(valor_backup(registro[coluna]))
+                saida.write((json.dumps(registro, ensure_ascii=False, default=str) + "\n").encode())
+                contagem[tipo] += 1
+        arquivo.seek(0)
+        logger.info(f"Backup gerado para {usuario}: {dict(contagem)}")
+        return arquivo, contagem
+    except Exception as e:
+        arquivo.close()
+        logger.error(f"Erro ao gerar backup: {e}")
+        raise
+
+# Lê um backup linha a linha, validando o cabeçalho e cada registro; ValueError em arquivo inválido
+def ler_backup(arquivo):
+    try:
+        with gzip.GzipFile(fileobj=arquivo, mode="rb") as entrada:
+            cabecalho = json.loads(entrada.readline() or "{}")
+            if cabecalho.get("tipo") != "cabecalho" or cabecalho.get("versao") != BACKUP_VERSAO:
+                raise ValueError("cabeçalho ausente ou de outra versão")
+            for numero, linha in enumerate(entrada, start=2):
+                if not linha.strip():
+                    continue
+                try:
+                    registro = json.loads(linha)
+                    colunas = COLUNAS_BACKUP[registro["tipo"]]
+                    yield registro["tipo"], tuple(CONVERSORES_BACKUP[coluna](registro[coluna]) for coluna in colunas)
+                except (KeyError, TypeError, ValueError, InvalidOperation) as e:
+                    raise ValueError(f"linha {numero}: {e!r}") from e
+    except (OSError, EOFError) as e:
+        raise ValueError(f"não é um arquivo gzip válido ({e})") from e
+
+# Função para restaurar um backup na conta do usuário; devolve {tipo: registros inseridos}
+def restaurar_backup(usuario, arquivo):
+    try:
+        contagem = repositorio.restaurar_conta(usuario, ler_backup(arquivo))
+        marcar_alteracao(usuario)
+        categorias_frequentes.descartar(usuario)
+        modelos_gastos.descartar(usuario)
+        logger.info(f"Backup restaurado para {usuario}: {dict(contagem)}")
+        return contagem
+    except Exception as e:
+        logger.error(f"Erro ao restaurar backup: {e}")
+        raise
+
+# Comando /backup: envia a conta inteira como arquivo .jsonl.gz
+async def backup(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    usuario = obter_usuario(update)
+    try:
+        corte = obter_corte_arquivo(usuario)
+        arquivo, contagem = gerar_backup(usuario)
+        aviso = aviso_arquivo(corte, "vão no backup só como totais mensais") if corte else ""
+        with arquivo:
+            await agendador_envios.enviar_documento(
+                update.effective_chat.id,
+                arquivo,
+                filename=f"smartmoney_backup_{usuario}_{datetime.now():%Y-%m-%d}.jsonl.gz",
+                caption=f"Backup da sua conta:\n{resumir_contagem_backup(contagem)}{aviso}\n\nPara restaurar, use /restaurar e envie este arquivo."
+            )
+    except Exception as e:
+        await responder(update, f"Erro ao gerar o backup: {str(e)}", TECLADO_VOLTAR)
+
+# Comando /restaurar: aguarda o arquivo do /backup
+async def restaurar(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await navegar_para(update, context, "restaurar")
+
+# Handler de documentos: restaura o backup enviado depois do /restaurar
+async def receber_backup(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if estado_conversa(update).estado != 'awaiting_backup':
+        return
+    documento = update.message.document
+    if documento.file_size and documento.file_size > BACKUP_TAMANHO_MAXIMO_MB * 1024 * 1024:
+        await responder(update, f"Arquivo maior que {BACKUP_TAMANHO_MAXIMO_MB} MB.", TECLADO_VOLTAR)
+        return
+    usuario = obter_usuario(update)
+    try:
+        arquivo_telegram = await documento.get_file()
+        with tempfile.TemporaryFile() as arquivo:
+            await arquivo_telegram.download_to_memory(arquivo)
+            arquivo.seek(0)
+            contagem = restaurar_backup(usuario, arquivo)
+    except ValueError as e:
+        await responder(update, f"Arquivo de backup inválido: {str(e)}. Nada foi alterado.", TECLADO_VOLTAR)
+        return
+    except Exception as e:
+        await responder(update, f"Erro ao restaurar o backup: {str(e)}. Nada foi alterado.", TECLADO_VOLTAR)
+        return
+    concluir_fluxo(update)
+    await responder(update, f"Backup restaurado! Registros novos:\n{resumir_contagem_backup(contagem)}", TECLADO_VOLTAR)
+
+# Configuração do relatório mensal automático
+FUSO_HORARIO = ZoneInfo(config("FUSO_HORARIO", default="America/Sao_Paulo"))
+RELATORIO_MENSAL_HORA = config("RELATORIO_MENSAL_HORA", default=9, cast=int)
+RELATORIO_LOTE = config("RELATORIO_LOTE", default=500, cast=int)
+RELATORIO_CONCORRENCIA = config("RELATORIO_CONCORRENCIA", default=10, cast=int)
+RELATORIO_DIAS_RETOMADA = config("RELATORIO_DIAS_RETOMADA", default=3, cast=int)
+# Reservas sem confirmação há mais que isso são de uma execução interrompida e voltam a ficar pendentes
+RELATORIO_RESERVA_MINUTOS = config("RELATORIO_RESERVA_MINUTOS", default=10, cast=int)
+
+# Job do fechamento do mês: envia o resumo do mês anterior a todos os usuários ativos.
+# Cada lote é reservado antes do envio e confirmado depois, então uma execução
+# interrompida recomeça do ponto em que parou sem reenviar para quem já recebeu
+async def enviar_relatorio_mensal(context: ContextTypes.DEFAULT_TYPE):
+    hoje = datetime.now(FUSO_HORARIO)
+    mes, ano = deslocar_mes(hoje.month, hoje.year, -1)
+    semaforo = asyncio.Semaphore(RELATORIO_CONCORRENCIA)
+    total_enviados = 0
+
+    async def enviar(usuario, texto):
+        async with semaforo:
+            try:
+                await agendador_envios.enviar_texto(usuario, texto)
+            except Forbidden:
+                logger.info(f"Usuário {usuario} bloqueou o bot; relatório ignorado.")
+            except Exception as e:
+                logger.warning(f"Falha ao enviar relatório mensal para {usuario}: {e}")
+                return False
+            return True
+
+    try:
+        # As consultas de cada lote rodam fora do laço de eventos (e com todas as tentativas de conexão)
+        apos = ""
+        while True:
+            usuarios = await asyncio.to_thread(listar_usuarios_para_relatorio, mes, ano, apos, RELATORIO_LOTE)
+            if not usuarios:
+                break
+            apos = usuarios[-1]
+            reservados = await asyncio.to_thread(reservar_envios_relatorio, usuarios, mes, ano)
+            if not reservados:
+                continue
+            resumos = await asyncio.to_thread(obter_resumos_em_lote, reservados, mes, ano)
+            resultados = await asyncio.gather(*(
+                enviar(usuario, "📅 Fechamento do mês!\n\n" + formatar_resumo(f"{mes:02d}/{ano}", *resumos[usuario]))
+                for usuario in reservados
+            ))
+            enviados = [usuario for usuario, ok in zip(reservados, resultados) if ok]
+            falhas = [usuario for usuario, ok in zip(reservados, resultados) if not ok]
+            await asyncio.to_thread(registrar_envios_relatorio, enviados, falhas, mes, ano)
+            total_enviados += len(enviados)
+            logger.info(f"Relatório {mes:02d}/{ano}: checkpoint até o usuário {reservados[-1]} ({total_enviados} enviados)")
+        logger.info(f"Relatório mensal de {mes:02d}/{ano} concluído: {total_enviados} enviados.")
+    except Exception as e:
+        logger.error(f"Erro no envio do relatório mensal: {e}")
+
+# Configuração da avaliação noturna dos limites
+ALERTAS_LIMITE_HORA = config("ALERTAS_LIMITE_HORA", default=21, cast=int)
+ALERTA_LIMITE_PERCENTUAL = config("ALERTA_LIMITE_PERCENTUAL", default=0.8, cast=float)
+
+# Função para calcular, de forma vetorizada, quais alertas de limite precisam ser enviados:
+# lista de (usuario, categoria, nivel, limite, total) em centavos, com categoria '' para o limite geral
+def calcular_alertas_limite(linhas):
+    if not linhas:
+        return []
+    df = pd.DataFrame(linhas, columns=['usuario', 'categoria', 'limite', 'total', 'niveis_enviados'])
+    limite = df['limite'].to_numpy(dtype=np.int64)
+    total = df['total'].to_numpy(dtype=np.int64)
+    # O excedido é comparado em centavos; só o percentual do aviso usa a razão
+    uso = np.divide(total, limite, out=np.zeros(len(df)), where=limite > 0)
+    nivel = np.select([(limite > 0) & (total > limite), uso >= ALERTA_LIMITE_PERCENTUAL], ['excedido', 'aviso'], default='')
+    ja_enviado = np.fromiter(
+        (n in enviados for n, enviados in zip(nivel, df['niveis_enviados'])), dtype=bool, count=len(df)
+    )
+    pendentes = (nivel != '') & ~ja_enviado
+    return list(zip(df['usuario'][pendentes], df['categoria'][pendentes], nivel[pendentes],
+                    limite[pendentes].tolist(), total[pendentes].tolist()))
+
+# Job noturno: avalia os limites de todos os usuários de uma vez e enfileira os alertas
+async def avaliar_limites_noturno(context: ContextTypes.DEFAULT_TYPE):
+    hoje = datetime.now(FUSO_HORARIO)
+    mes, ano = hoje.month, hoje.year
+    semaforo = asyncio.Semaphore(RELATORIO_CONCORRENCIA)
+
+    async def enviar(usuario, categoria, nivel, limite, total):
+        alvo = "seu limite mensal" if not categoria else f"o limite da categoria '{categoria}'"
+        if nivel == 'excedido':
+            texto = f"⚠️ Alerta: Você ultrapassou {alvo} de {formatar_reais(limite)}. Total em {mes:02d}/{ano}: {formatar_reais(total)}."
+        else:
+            texto = f"🔔 Atenção: Você já usou {total / limite:.0%} de {alvo} ({formatar_reais(total)} de {formatar_reais(limite)})."
+        async with semaforo:
+            try:
+                await agendador_envios.enviar_texto(usuario, texto)
+            except Forbidden:
+                pass
+            except Exception as e:
+                logger.warning(f"Falha ao enviar alerta de limite para {usuario}: {e}")
+                return False
+            return True
+
+    try:
+        alertas = calcular_alertas_limite(obter_limites_todos_usuarios(mes, ano))
+        resultados = await asyncio.gather(*(enviar(*alerta) for alerta in alertas))
+        enviados = [alerta[:3] for alerta, ok in zip(alertas, resultados) if ok]
+        if enviados:
+            registrar_alertas_limite(enviados, mes, ano)
+        logger.info(f"Avaliação noturna de limites: {len(enviados)} alertas enviados.")
+    except Exception as e:
+        logger.error(f"Erro na avaliação noturna de limites: {e}")
+
+# Job noturno: recalcula as linhas de base de gastos de todos os usuários com os meses fechados
+ANOMALIAS_HORA = config("ANOMALIAS_HORA", default=3, cast=int)
+
+async def atualizar_baselines_noturno(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        hoje = datetime.now(FUSO_HORARIO)
+        mes_inicial, ano_inicial = deslocar_mes(hoje.month, hoje.year, -ANOMALIAS_MESES_HISTORICO)
+        meses = [date(*reversed(deslocar_mes(mes_inicial, ano_inicial, i)), 1) for i in range(ANOMALIAS_MESES_HISTORICO)]
+        historico = obter_historico_mensal(meses[0], date(hoje.year, hoje.month, 1))
+        salvar_baselines(calcular_baselines(historico, meses))
+    except Exception as e:
+        logger.error(f"Erro ao atualizar as linhas de base de gastos: {e}")
+
+# Job noturno: recalcula o perfil diário de gastos usado na previsão de fim de mês
+async def atualizar_perfis_diarios_noturno(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        hoje = datetime.now(FUSO_HORARIO)
+        mes_inicial, ano_inicial = deslocar_mes(hoje.month, hoje.year, -PREVISAO_MESES_HISTORICO)
+        linhas = obter_gastos_diarios(date(ano_inicial, mes_inicial, 1), date(hoje.year, hoje.month, 1))
+        salvar_perfis_diarios(calcular_perfis_diarios(linhas))
+    except Exception as e:
+        logger.error(f"Erro ao atualizar os perfis diários de gastos: {e}")
+
+# Job periódico: carga incremental do esquema de relatórios lido pelo Power BI
+async def atualizar_relatorios_periodico(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        atualizar_relatorios()
+    except Exception as e:
+        logger.error(f"Erro no job de atualização dos relatórios: {e}")
+
+# Job diário: pré-cria as próximas partições e arquiva as antigas
+async def manter_particoes_diario(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        manter_particoes(datetime.now(FUSO_HORARIO).date())
+    except Exception as e:
+        logger.error(f"Erro no job de manutenção das partições: {e}")
+
+# Telas montadas sob demanda (dependem de dados do usuário)
+TELAS_DINAMICAS = {
+    "gasto_categoria": tela_categorias("gasto_categoria", "Escolha a categoria do gasto ou escreva uma personalizada:"),
+    "gasto_fixo_categoria": tela_categorias("gasto_fixo_categoria", "Escolha a categoria do gasto fixo ou escreva uma personalizada:"),
+    "gasto_fixo_valor": tela_gasto_fixo_valor,
+    "confirmar_remocao": tela_confirmar_remocao,
+    "resumo": tela_resumo,
+    "excel": tela_excel,
+    "tendencias": tela_tendencias,
+    "busca_resultados": tela_busca_resultados,
+    "powerbi": send_powerbi_link,
+    **{nome: tela_listagem(listagem) for nome, listagem in LISTAGENS.items()},
+}
+
+# Registro de rotas: prefixo do callback_data -> handler(update, context, argumento)
+ROTAS = {
+    **{nome: navegador(nome) for nome in [
+        "start_gasto", "start_entrada", "gasto_normal", "gasto_fixo", "gasto_normal_adicionar",
+        "gasto_categoria_texto", "gasto_fixo_adicionar", "gasto_fixo_categoria_texto",
+        "entrada_adicionar", "definir_limite", "definir_limite_categoria", *LISTAGENS
+    ]},
+    "start_powerbi": navegador("powerbi"),
+    "start_tendencias": navegador("tendencias"),
+    "start_buscar": navegador("buscar"),
+    "busca_pagina": rota_busca_pagina,
+    "start_resumo": rota_start_resumo,
+    "start_excel": rota_start_excel,
+    "voltar": handle_voltar,
+    "gasto_fixo_periodicidade": rota_periodicidade,
+    "gasto_categoria": rota_gasto_categoria,
+    "gasto_forma": rota_gasto_forma,
+    "gasto_fixo_categoria": rota_gasto_fixo_categoria,
+    "gasto_fixo_forma": rota_gasto_fixo_forma,
+    "editar_gasto_select": seletor_edicao("editar_gasto_dados"),
+    "editar_entrada_select": seletor_edicao("editar_entrada_dados"),
+    "remover_gasto_normal_select": seletor_remocao("gasto_normal"),
+    "remover_gasto_fixo_select": seletor_remocao("gasto_fixo"),
+    "remover_entrada_select": seletor_remocao("entrada"),
+    "confirmar_remover": rota_confirmar_remover,
+    "resumo_prev": navegador_periodo("resumo", -1),
+    "resumo_next": navegador_periodo("resumo", 1),
+    "resumo_periodos": navegador("resumo_periodos"),
+    "resumo_grafico": rota_resumo_grafico,
+    "excel_prev": navegador_periodo("excel", -1),
+    "excel_next": navegador_periodo("excel", 1),
+    "excel_periodos": navegador("excel_periodos"),
+    "periodo": rota_periodo,
+    "excel_gerar": rota_excel_gerar,
+}
 
 # Função principal assíncrona com webhooks
 async def main():
     try:
-        application = Application.builder().token("7585573573:AAHC-v1EwpHHiBCJ5JSINejrMTdKJRIbqr4").build()
-
-        application.add_handler(CommandHandler("start", start))
-        application.add_handler(CallbackQueryHandler(button_start, pattern="^start_"))
-        application.add_handler(CallbackQueryHandler(button_gasto, pattern="^(gasto_|definir_limite|voltar)"))
-        application.add_handler(CallbackQueryHandler(button_entrada, pattern="^entrada_"))
-        application.add_handler(CallbackQueryHandler(button_action, pattern="^(editar_|remover_|confirmar_|voltar)"))
-        application.add_handler(CallbackQueryHandler(button_resumo, pattern="^(resumo_|voltar)"))
-        application.add_handler(CallbackQueryHandler(button_excel, pattern="^(excel_|voltar)"))
-        application.add_handler(CommandHandler("resumo", resumo))
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, text_handler))
+        application = Application.builder().token("7585573573:AAHC-v1EwpHHiBCJ5JSINejrMTdKJRIbqr4").base_url(TELEGRAM_API_URL).build()
+        agendador_envios.configurar(application.bot)
+
+        application.add_handler(TypeHandler(Update, registrar_update_metricas), group=-2)
+        application.add_handler(TypeHandler(Update, descartar_updates_duplicados), group=-1)
+        application.add_handler(CommandHandler("start", perfilado("/start", start)))
+        application.add_handler(CallbackQueryHandler(roteador_callbacks))
+        application.add_handler(CommandHandler("resumo", perfilado("/resumo", resumo)))
+        application.add_handler(CommandHandler("tendencias", perfilado("/tendencias", tendencias)))
+        application.add_handler(CommandHandler("buscar", perfilado("/buscar", buscar)))
+        application.add_handler(CommandHandler("perfil", perfil))
+        application.add_handler(CommandHandler("memoria", memoria))
+        application.add_handler(CommandHandler("stats", stats))
+        application.add_handler(CommandHandler("backup", perfilado("/backup", backup)))
+        application.add_handler(CommandHandler(["restaurar", "restore"], restaurar))
+        application.add_handler(MessageHandler(filters.Document.ALL, perfilado("/restaurar", receber_backup)))
+        application.add_error_handler(registrar_erro)
+        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, perfilado(estado_fluxo, text_handler)))
+
+        inicializar_schema()
+        agora = datetime.now(FUSO_HORARIO)
+        application.job_queue.run_repeating(
+            descarregar_metricas, interval=METRICAS_INTERVALO_SEGUNDOS, first=METRICAS_INTERVALO_SEGUNDOS, name="metricas_operacionais"
+        )
+        if METRICAS_PORTA:
+            tornado.web.Application([(r"/stats", PainelHandler)]).listen(METRICAS_PORTA)
+        if BANCO_DADOS == "postgres" and AQUECIMENTO_JANELA_MINUTOS > 0:
+            application.job_queue.run_repeating(
+                manter_banco_aquecido, interval=AQUECIMENTO_INTERVALO_SEGUNDOS, first=AQUECIMENTO_INTERVALO_SEGUNDOS, name="aquecimento_banco"
+            )
+        if DEDUP_PERSISTIDO:
+            application.job_queue.run_repeating(podar_updates_processados, interval=3600, first=60, name="poda_updates")
+        # Jobs em lote dependem de recursos do PostgreSQL; no SQLite o bot roda só o fluxo interativo
+        if repositorio.analises:
+            if PARTICIONAMENTO:
+                manter_particoes(agora.date())
+                application.job_queue.run_daily(
+                    manter_particoes_diario, time=dt_time(PARTICOES_HORA, tzinfo=FUSO_HORARIO), name="manutencao_particoes"
+                )
+            application.job_queue.run_repeating(
+                atualizar_relatorios_periodico, interval=RELATORIOS_INTERVALO_MINUTOS * 60, first=30, name="relatorios_bi"
+            )
+            application.job_queue.run_monthly(
+                enviar_relatorio_mensal, when=dt_time(RELATORIO_MENSAL_HORA, tzinfo=FUSO_HORARIO), day=1, name="relatorio_mensal"
+            )
+            application.job_queue.run_daily(
+                avaliar_limites_noturno, time=dt_time(ALERTAS_LIMITE_HORA, tzinfo=FUSO_HORARIO), name="limites_noturno"
+            )
+            application.job_queue.run_daily(
+                atualizar_baselines_noturno, time=dt_time(ANOMALIAS_HORA, tzinfo=FUSO_HORARIO), name="baselines_noturno"
+            )
+            application.job_queue.run_daily(
+                atualizar_perfis_diarios_noturno, time=dt_time(ANOMALIAS_HORA, tzinfo=FUSO_HORARIO), name="perfis_diarios_noturno"
+            )
+            # Retoma um fechamento interrompido por uma reinicialização nos primeiros dias do mês, depois
+            # que as reservas do lote em andamento na queda tiverem expirado
+            if agora.day <= RELATORIO_DIAS_RETOMADA and (agora.day > 1 or agora.hour >= RELATORIO_MENSAL_HORA):
+                application.job_queue.run_once(
+                    enviar_relatorio_mensal, when=max(60, RELATORIO_RESERVA_MINUTOS * 60), name="relatorio_mensal_retomada"
+                )
+        # Nome de cada handler e job para o rastreamento de consultas lentas (ver handler_atual)
+        for grupo in application.handlers.values():
+            for handler in grupo:
+                handler.callback = rastrear_handler(handler.callback)
+        for job in application.job_queue.jobs():
+            job.callback = rastrear_handler(job.callback)
 
         port = int(os.environ.get("PORT", 8443))
         hostname = "smartmoneyiabot.onrender.com"
@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+
+# O bot escolhe o repositório na importação: os testes rodam sem rede no SQLite, a menos que
+# BANCO_DADOS seja definido; com DATABASE_URL, o contrato também roda contra o PostgreSQL
+os.environ.setdefault("BANCO_DADOS", "sqlite")
+os.environ.setdefault("SQLITE_CAMINHO", os.path.join(tempfile.mkdtemp(prefix="smartmoney-testes-"), "bot.db"))
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
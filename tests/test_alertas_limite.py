@@ -0,0 +1,92 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+
+import bot
+from bot import calcular_alertas_limite
+
+# Linhas de obter_limites_todos_usuarios: (usuario, categoria, limite, total, niveis_enviados) em
+# centavos, com categoria '' para o limite geral
+def alertas(*linhas):
+    return [(usuario, categoria, str(nivel), limite, total) for usuario, categoria, nivel, limite, total in calcular_alertas_limite(list(linhas))]
+
+@pytest.mark.parametrize("total, nivel", [
+    (0, None),
+    (7999, None),
+    (8000, "aviso"),
+    (10000, "aviso"),
+    (10001, "excedido"),
+    (50000, "excedido"),
+])
+def test_cruzamento_dos_limiares(total, nivel):
+    esperado = [("1", "", nivel, 10000, total)] if nivel else []
+    assert alertas(("1", "", 10000, total, [])) == esperado
+
+def test_alerta_ja_enviado_nao_se_repete():
+    assert alertas(("1", "", 10000, 9000, ["aviso"])) == []
+    assert alertas(("1", "", 10000, 12000, ["aviso", "excedido"])) == []
+    # Depois do aviso, passar do limite ainda gera o alerta de excedido
+    assert alertas(("1", "", 10000, 12000, ["aviso"])) == [("1", "", "excedido", 10000, 12000)]
+    # O excedido já enviado não impede o aviso de outro usuário nem de outra categoria
+    assert alertas(
+        ("1", "", 10000, 12000, ["excedido"]),
+        ("1", "Mercado", 1000, 900, []),
+        ("2", "", 10000, 12000, []),
+    ) == [("1", "Mercado", "aviso", 1000, 900), ("2", "", "excedido", 10000, 12000)]
+
+def test_limite_geral_e_por_categoria_sao_independentes():
+    assert alertas(
+        ("1", "", 100000, 30000, []),
+        ("1", "Mercado", 20000, 25000, []),
+        ("1", "Lazer", 10000, 8500, []),
+        ("1", "Viagem", 0, 5000, []),
+    ) == [("1", "Mercado", "excedido", 20000, 25000), ("1", "Lazer", "aviso", 10000, 8500)]
+
+def test_centavos_sem_erro_de_ponto_flutuante():
+    # Um centavo acima do limite já é excedido: a comparação é entre inteiros
+    assert alertas(("1", "", 30, 31, [])) == [("1", "", "excedido", 30, 31)]
+    assert alertas(("1", "", 30, 30, ["aviso"])) == []
+    resultado = calcular_alertas_limite([("1", "", 30, 31, [])])
+    assert all(type(valor) is int for *_, limite, total in resultado for valor in (limite, total))
+
+def test_sem_linhas():
+    assert calcular_alertas_limite([]) == []
+
+@pytest.fixture
+def respostas(monkeypatch):
+    enviadas = []
+
+    async def responder(update, texto, reply_markup=None, parse_mode=None):
+        enviadas.append(texto)
+
+    monkeypatch.setattr(bot, "responder", responder)
+    return enviadas
+
+def verificar(limites, mes=3, ano=2024):
+    asyncio.run(bot.verificar_limite(None, "1", mes, ano, limites))
+
+def test_verificar_limite_geral_e_por_categoria(respostas):
+    verificar([(None, 100000, 100000), ("Mercado", 20000, 19999)])
+    assert respostas == []
+
+    verificar([(None, 100000, 100001), ("Mercado", 20000, 25050), ("Lazer", 5000, 100)])
+    assert respostas == [
+        "⚠️ Alerta: Você ultrapassou seu limite de gastos mensal de R$1000.00! Seu total de gastos em 03/2024 é R$1000.01.",
+        "⚠️ Alerta: Você ultrapassou o limite de R$200.00 da categoria 'Mercado'! Seu total nessa categoria em 03/2024 é R$250.50.",
+    ]
+
+def test_verificar_limite_usa_a_previsao_no_mes_atual(respostas, monkeypatch):
+    agora = datetime.now()
+    monkeypatch.setattr(bot.repositorio, "analises", True)
+    monkeypatch.setattr(bot, "prever_gasto_mensal", lambda usuario: (150000, None))
+
+    verificar([(None, 100000, 40000)], agora.month, agora.year)
+    verificar([(None, 100000, 120000)], agora.month, agora.year)
+    # Em outro mês a previsão não é consultada
+    verificar([(None, 100000, 40000)], 1, 2000)
+    assert respostas == [
+        "🔔 Previsão: no ritmo atual seus gastos devem chegar a R$1500.00 no fim do mês, acima do seu limite de R$1000.00.",
+        f"⚠️ Alerta: Você ultrapassou seu limite de gastos mensal de R$1000.00! Seu total de gastos em {agora.month:02d}/{agora.year} "
+        "é R$1200.00. Projeção para o fim do mês: R$1500.00.",
+    ]
@@ -0,0 +1,109 @@
+import gzip
+import io
+import json
+from datetime import date
+from decimal import Decimal
+
+import pytest
+
+import bot
+from bot import em_reais, gerar_backup, ler_backup, restaurar_backup
+
+@pytest.fixture
+def repositorio(monkeypatch, tmp_path):
+    repositorio = bot.RepositorioSQLite(str(tmp_path / "backup.db"))
+    repositorio.inicializar()
+    monkeypatch.setattr(bot, "repositorio", repositorio)
+    yield repositorio
+    repositorio.conexao().close()
+
+def popular(repositorio, usuario):
+    repositorio.salvar_gasto(usuario, em_reais(1050), "Mercado", "Pix", date(2024, 3, 5))
+    repositorio.salvar_gasto(usuario, em_reais(1050), "Mercado", "Pix", date(2024, 3, 5))
+    repositorio.salvar_gasto(usuario, em_reais(1), "Café ☕", None, date(2024, 2, 29))
+    repositorio.salvar_gasto(usuario, em_reais(150000), "Aluguel (MENSAL)", "Pix", date(2024, 3, 1))
+    repositorio.salvar_entrada(usuario, em_reais(500075), "Salário", date(2024, 3, 1))
+    repositorio.salvar_entrada(usuario, em_reais(7000), None, date(2024, 3, 2))
+    repositorio.definir_limite(usuario, em_reais(300000))
+    repositorio.definir_limite_categoria(usuario, "Mercado", em_reais(80000))
+
+# Conteúdo da conta sem os ids, que mudam na restauração
+def conteudo(repositorio, usuario):
+    return sorted(
+        (tipo, tuple(bot.em_centavos(v) if isinstance(v, (Decimal, float, int)) else v for v in (linha[1:] if tipo in ("gasto", "entrada") else linha)))
+        for tipo, linha in repositorio.exportar_conta(usuario)
+    )
+
+def gz(*linhas):
+    return io.BytesIO(gzip.compress("".join(linha + "\n" for linha in linhas).encode()))
+
+CABECALHO = json.dumps({"tipo": "cabecalho", "versao": bot.BACKUP_VERSAO, "usuario": "1"})
+GASTO = json.dumps({"tipo": "gasto", "id": 1, "valor": "10.50", "categoria": "Mercado", "forma_pagamento": "Pix", "data": "2024-03-05"})
+
+def test_ida_e_volta_do_backup(repositorio):
+    popular(repositorio, "1")
+    arquivo, contagem = gerar_backup("1")
+    with arquivo:
+        dados = arquivo.read()
+    assert contagem == {"gasto": 4, "entrada": 2, "limite": 1, "limite_categoria": 1}
+
+    linhas = gzip.decompress(dados).decode().splitlines()
+    cabecalho = json.loads(linhas[0])
+    assert (cabecalho["tipo"], cabecalho["versao"], cabecalho["usuario"]) == ("cabecalho", bot.BACKUP_VERSAO, "1")
+    registros = [json.loads(linha) for linha in linhas[1:]]
+    # Os valores vão como texto, sem perder centavos
+    assert {registro["valor"] for registro in registros if registro["tipo"] == "gasto"} == {"10.50", "0.01", "1500.00"}
+    assert {"tipo": "entrada", "valor": "70.00", "descricao": None, "data": "2024-03-02"}.items() <= next(
+        registro for registro in registros if registro["tipo"] == "entrada" and registro["descricao"] is None
+    ).items()
+
+    lidos = list(ler_backup(io.BytesIO(dados)))
+    assert ("gasto", (lidos[0][1][0], Decimal("0.01"), "Café ☕", None, date(2024, 2, 29))) in lidos
+    assert ("limite", (Decimal("3000.00"),)) in lidos
+
+    assert restaurar_backup("2", io.BytesIO(dados)) == contagem
+    assert conteudo(repositorio, "2") == conteudo(repositorio, "1")
+    # Restaurar de novo (ou na própria conta) não duplica nada
+    assert sum(restaurar_backup("2", io.BytesIO(dados)).values()) == 0
+    assert sum(restaurar_backup("1", io.BytesIO(dados)).values()) == 0
+    assert conteudo(repositorio, "2") == conteudo(repositorio, "1")
+
+def test_cabecalho_informa_o_corte_do_arquivo(repositorio, monkeypatch):
+    popular(repositorio, "1")
+    for corte, esperado in ((None, None), (date(2022, 8, 1), "2022-08-01")):
+        monkeypatch.setattr(repositorio, "obter_corte_arquivo", lambda usuario: corte)
+        arquivo, _ = gerar_backup("1")
+        with arquivo:
+            assert json.loads(gzip.decompress(arquivo.read()).decode().splitlines()[0])["arquivado_ate"] == esperado
+
+@pytest.mark.parametrize("arquivo, erro", [
+    (gz(CABECALHO, GASTO, '{"tipo": "gasto", "id": 2, "valor": '), "linha 3"),
+    (gz(CABECALHO, GASTO, GASTO.replace('"10.50"', '"-1.00"')), "linha 3"),
+    (gz(CABECALHO, GASTO.replace('"2024-03-05"', '"2024-02-30"')), "linha 2"),
+    (gz(CABECALHO, GASTO.replace('"Mercado"', '"  "')), "linha 2"),
+    (gz(CABECALHO, json.dumps({"tipo": "desconhecido"})), "linha 2"),
+    (gz(CABECALHO, json.dumps({"tipo": "gasto", "id": 1})), "linha 2"),
+    (gz(GASTO), "cabeçalho"),
+    (gz(CABECALHO.replace(f'"versao": {bot.BACKUP_VERSAO}', '"versao": 99')), "cabeçalho"),
+    (io.BytesIO(b"isto nao e gzip"), "gzip"),
+])
+def test_backup_invalido_nao_altera_nada(repositorio, arquivo, erro):
+    popular(repositorio, "1")
+    antes = conteudo(repositorio, "1")
+    with pytest.raises(ValueError, match=erro):
+        restaurar_backup("1", arquivo)
+    with pytest.raises(ValueError, match=erro):
+        restaurar_backup("2", io.BytesIO(arquivo.getvalue()))
+    assert conteudo(repositorio, "1") == antes
+    assert conteudo(repositorio, "2") == []
+
+def test_backup_truncado_nao_altera_nada(repositorio):
+    popular(repositorio, "1")
+    arquivo, _ = gerar_backup("1")
+    with arquivo:
+        dados = arquivo.read()
+    with pytest.raises(ValueError, match="gzip"):
+        restaurar_backup("2", io.BytesIO(dados[:-12]))
+    assert conteudo(repositorio, "2") == []
+    # Linhas em branco são ignoradas
+    assert restaurar_backup("2", gz(CABECALHO, "", GASTO, "  ")) == {"gasto": 1, "entrada": 0}
@@ -0,0 +1,67 @@
+from datetime import date
+from decimal import Decimal
+
+import pytest
+
+from bot import calcular_baselines, detectar_gasto_atipico, gerar_recomendacao
+
+MESES = [date(2024, mes, 1) for mes in range(1, 6)]
+
+# Histórico sintético (usuario, categoria, mes, total em reais, como vem do banco):
+# - o usuário "1" começa em fevereiro; janeiro não conta, e abril e maio sem Mercado contam como zero
+# - o usuário "2" tem só dois meses, abaixo de ANOMALIAS_MESES_MINIMOS
+HISTORICO = [
+    ("1", "Mercado", date(2024, 2, 1), Decimal("100.00")),
+    ("1", "Mercado", date(2024, 3, 1), Decimal("200.00")),
+    ("1", "Mercado", date(2024, 4, 1), Decimal("300.00")),
+    ("1", "Lazer", date(2024, 5, 1), Decimal("50.00")),
+    ("2", "Mercado", date(2024, 4, 1), Decimal("80.00")),
+    ("2", "Mercado", date(2024, 5, 1), Decimal("90.00")),
+]
+
+def test_baselines_do_historico_sintetico():
+    baselines = {(usuario, categoria): resto for usuario, categoria, *resto in calcular_baselines(HISTORICO, MESES)}
+    # Mercado: 100, 200, 300, 0 -> média 150, desvio amostral sqrt(50000 / 3); EWMA com pesos 0,7^k
+    # dos meses ativos (0,343, 0,49, 0,7, 1)
+    # Lazer: 0, 0, 0, 50 -> média 12,50, desvio sqrt(1875 / 3) = 25
+    assert baselines == {
+        ("1", "Mercado"): [150.0, 129.1, 135.14, 4],
+        ("1", "Lazer"): [12.5, 25.0, 19.74, 4],
+    }
+
+def test_meses_sem_historico_nao_contam():
+    # Um mês fora da janela não entra; com só três meses ativos o usuário ainda é válido
+    baselines = calcular_baselines(HISTORICO, MESES[2:])
+    assert [(usuario, categoria, n) for usuario, categoria, *_, n in baselines] == [("1", "Lazer", 3), ("1", "Mercado", 3)]
+    assert calcular_baselines([], MESES) == []
+
+def test_valores_repetidos_tem_desvio_zero():
+    historico = [("1", "Aluguel", mes, Decimal("1500.00")) for mes in MESES]
+    assert calcular_baselines(historico, MESES) == [("1", "Aluguel", 1500.0, 0.0, 1500.0, 5)]
+
+# Faixa normal: até max(média, EWMA) + ANOMALIAS_LIMIAR_Z desvios, comparada em centavos
+@pytest.mark.parametrize("total, atipico", [
+    (15000, False),
+    (40820, False),
+    (40821, True),
+    (90000, True),
+])
+def test_faixa_do_gasto_atipico(total, atipico):
+    baselines = {"Mercado": (Decimal("150.00"), Decimal("129.10"), Decimal("135.14"))}
+    resultado = detectar_gasto_atipico([("Mercado", total)], baselines)
+    if atipico:
+        categoria, valor, referencia, z = resultado
+        assert (categoria, valor, referencia) == ("Mercado", total, 15000)
+        assert z == pytest.approx((total - 15000) / 12910)
+    else:
+        assert resultado is None
+
+def test_o_mais_atipico_e_escolhido():
+    baselines = {
+        "Mercado": (Decimal("150.00"), Decimal("10.00"), Decimal("150.00")),
+        "Lazer": (Decimal("12.50"), Decimal("25.00"), Decimal("19.74")),
+        "Aluguel": (Decimal("1500.00"), Decimal("0.00"), Decimal("1500.00")),
+    }
+    gastos = [("Mercado", 20000), ("Lazer", 20000), ("Aluguel", 900000), ("Farmácia", 99999)]
+    assert detectar_gasto_atipico(gastos, baselines)[:3] == ("Lazer", 20000, 1974)
+    assert "Lazer" in gerar_recomendacao(gastos, baselines)
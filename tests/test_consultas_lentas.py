@@ -0,0 +1,44 @@
+import asyncio
+import json
+import os
+
+import psycopg2
+import pytest
+
+import bot
+
+async def meu_handler():
+    return bot.identificar_handler(), await asyncio.to_thread(bot.identificar_handler)
+
+def test_handler_identificado_no_laco_e_nas_threads():
+    assert asyncio.run(bot.rastrear_handler(meu_handler)()) == ("meu_handler", "meu_handler")
+    # Sem o rastreamento, só o laço enxerga a corrotina
+    assert asyncio.run(meu_handler()) == ("meu_handler", "desconhecido")
+    assert bot.identificar_handler() == "desconhecido"
+
+def test_perfilado_mantem_o_nome_do_handler():
+    assert bot.perfilado("/rota", meu_handler).__name__ == "meu_handler"
+    assert bot.rastrear_handler(bot.perfilado("/rota", meu_handler)).__name__ == "meu_handler"
+
+@pytest.mark.skipif(not os.environ.get("DATABASE_URL"), reason="DATABASE_URL não definido")
+def test_explain_sem_analyze_e_nunca_em_escritas(monkeypatch, tmp_path):
+    log = tmp_path / "planos.jsonl"
+    monkeypatch.setattr(bot, "SLOW_QUERY_MS", 0)
+    monkeypatch.setattr(bot, "EXPLAIN_SAMPLE_RATE", 1.0)
+    monkeypatch.setattr(bot, "EXPLAIN_LOG_PATH", str(log))
+    conn = psycopg2.connect(os.environ["DATABASE_URL"], cursor_factory=bot.CursorRastreado)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("CREATE TEMP TABLE contador (n integer)")
+            cursor.execute("INSERT INTO contador VALUES (1)")
+            cursor.execute("UPDATE contador SET n = n + 1")
+            cursor.execute("SELECT n FROM contador WHERE n > %s", (0,))
+            # O EXPLAIN não reexecuta nada: o UPDATE rodou uma só vez
+            assert cursor.fetchone() == (2,)
+    finally:
+        conn.close()
+    registros = [json.loads(linha) for linha in log.read_text().splitlines()]
+    assert [registro["sql"] for registro in registros] == ["SELECT n FROM contador WHERE n > %s"]
+    plano = registros[0]["plano"][0]
+    assert registros[0]["seq_scans"] == ["contador"]
+    assert "Actual Total Time" not in plano["Plan"] and "Execution Time" not in plano
@@ -0,0 +1,58 @@
+import os
+import uuid
+from datetime import date
+
+import pytest
+
+import bot
+from bot import em_centavos, em_reais, limites_em_centavos
+
+@pytest.mark.parametrize("modo, host, preparar", [
+    ("auto", "ep-cool-name-123456.us-east-2.aws.neon.tech", True),
+    ("auto", "ep-cool-name-123456-pooler.us-east-2.aws.neon.tech", False),
+    ("auto", "", True),
+    ("auto", None, True),
+    ("sim", "ep-cool-name-123456-pooler.us-east-2.aws.neon.tech", True),
+    ("nao", "localhost", False),
+])
+def test_prepare_desligado_atras_do_pooler(monkeypatch, modo, host, preparar):
+    monkeypatch.setattr(bot, "PREPARAR_CONSULTAS", modo)
+    assert bot.usar_consultas_preparadas(host) == preparar
+
+def test_sql_comum_repete_os_parametros_na_ordem_do_texto():
+    sql, ordem = bot.sem_preparar("text, date, integer", "SELECT $3 WHERE a = $1 AND b >= $2 AND c = $1")
+    assert sql == "SELECT CAST(%s AS integer) WHERE a = CAST(%s AS text) AND b >= CAST(%s AS date) AND c = CAST(%s AS text)"
+    assert ordem == [2, 0, 1, 0]
+    assert set(bot.CONSULTAS_SEM_PREPARAR) == set(bot.CONSULTAS_PREPARADAS)
+    assert all("$" not in sql for sql, _ in bot.CONSULTAS_SEM_PREPARAR.values())
+
+# Com o PREPARE desligado (como atrás do PgBouncer em modo transação) o repositório continua
+# funcionando e nenhuma consulta fica preparada na sessão
+@pytest.mark.skipif(not os.environ.get("DATABASE_URL"), reason="DATABASE_URL não definido")
+def test_repositorio_sem_prepare(monkeypatch):
+    monkeypatch.setattr(bot, "PREPARAR_CONSULTAS", "nao")
+    pool = bot.PoolConexoes(os.environ["DATABASE_URL"])
+    monkeypatch.setattr(bot, "pool_primario", pool)
+    repositorio = bot.RepositorioPostgres()
+    usuario = uuid.uuid4().hex
+    marco = (date(2024, 3, 1), date(2024, 4, 1))
+
+    assert repositorio.salvar_gasto(usuario, em_reais(1050), "Mercado", "Pix", date(2024, 3, 5))
+    assert repositorio.salvar_entrada(usuario, em_reais(500000), None, date(2024, 3, 1))
+    gasto_id, _ = repositorio.salvar_gasto_livre(
+        usuario, em_reais(990), "Lazer", "Pix", date(2024, 3, 9), uuid.uuid4().hex, ["cinema"], *marco
+    )
+    repositorio.definir_limite(usuario, em_reais(300000))
+    repositorio.editar_gasto(usuario, gasto_id, {"valor": em_reais(1990), "categoria": None, "forma_pagamento": None})
+
+    assert sorted(repositorio.obter_totais_periodo(usuario, *marco, "month"), key=lambda linha: linha[1] or "") == [
+        (date(2024, 3, 1), None, 500000), (date(2024, 3, 1), "Lazer", 1990), (date(2024, 3, 1), "Mercado", 1050),
+    ]
+    assert sorted(em_centavos(valor) for _, valor, _, _, _ in repositorio.listar_gastos_periodo(usuario, *marco)) == [1050, 1990]
+    assert limites_em_centavos(repositorio.avaliar_limites(usuario, *marco)) == [(None, 300000, 3040)]
+    with pool.conexao() as conn:
+        assert not conn.preparar and not conn.preparadas
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT count(*) FROM pg_prepared_statements")
+            assert cursor.fetchone() == (0,)
+    pool.pool.closeall()
@@ -0,0 +1,82 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from telegram.ext import ApplicationHandlerStop
+
+import bot
+from bot import FiltroUpdatesDuplicados
+
+def test_anel_descarta_repetidos_ate_a_capacidade():
+    filtro = FiltroUpdatesDuplicados(3)
+    assert [filtro.registrar(update_id) for update_id in (1, 2, 3)] == [True, True, True]
+    assert not filtro.registrar(1)
+    assert not filtro.registrar(3)
+    # O 4 tira o mais antigo (1) do anel; repetir o 1 volta a ser aceito e tira o 2
+    assert filtro.registrar(4)
+    assert filtro.registrar(1)
+    assert filtro.registrar(2)
+    assert not filtro.registrar(4)
+    assert list(filtro.ordem) == [4, 1, 2]
+    assert filtro.vistos == {4, 1, 2}
+
+def test_anel_nao_cresce_alem_da_capacidade():
+    filtro = FiltroUpdatesDuplicados(100)
+    for update_id in range(10000):
+        filtro.registrar(update_id)
+    assert len(filtro.vistos) == len(filtro.ordem) == 100
+    assert not filtro.registrar(9999)
+    assert filtro.registrar(9899)
+
+@pytest.fixture
+def dedup(monkeypatch, tmp_path):
+    repositorio = bot.RepositorioSQLite(str(tmp_path / "dedup.db"))
+    repositorio.inicializar()
+    monkeypatch.setattr(bot, "repositorio", repositorio)
+    monkeypatch.setattr(bot, "filtro_updates", FiltroUpdatesDuplicados(2))
+    monkeypatch.setattr(bot, "DEDUP_PERSISTIDO", True)
+    yield repositorio
+    repositorio.conexao().close()
+
+def processado(update_id):
+    try:
+        asyncio.run(bot.descartar_updates_duplicados(SimpleNamespace(update_id=update_id), None))
+    except ApplicationHandlerStop:
+        return False
+    return True
+
+def envelhecer_updates(repositorio, horas):
+    repositorio.executar("UPDATE updates_processados SET recebido_em = datetime('now', ?)", (f"-{horas} hours",))
+
+def test_update_repetido_na_janela_e_descartado(dedup):
+    assert processado(1)
+    assert not processado(1)
+
+def test_update_repetido_depois_da_janela_volta_a_ser_aceito(dedup):
+    assert processado(1)
+    assert processado(2) and processado(3)  # o 1 sai do anel em memória
+    # Ainda dentro da janela persistida: descartado mesmo fora do anel (como após reiniciar)
+    envelhecer_updates(dedup, bot.DEDUP_JANELA_HORAS - 1)
+    assert dedup.podar_updates(bot.DEDUP_JANELA_HORAS) == 0
+    assert not processado(1)
+    # Depois da janela o registro é podado e o id volta a ser aceito
+    envelhecer_updates(dedup, bot.DEDUP_JANELA_HORAS + 1)
+    assert dedup.podar_updates(bot.DEDUP_JANELA_HORAS) == 3
+    assert processado(2) and processado(3)
+    assert processado(1)
+
+def test_sem_persistencia_so_o_anel_deduplica(dedup, monkeypatch):
+    monkeypatch.setattr(bot, "DEDUP_PERSISTIDO", False)
+    assert processado(1)
+    assert not processado(1)
+    assert processado(2) and processado(3)
+    assert processado(1)
+
+def test_falha_do_banco_deixa_o_update_seguir(dedup, monkeypatch):
+    def falhar(update_id):
+        raise bot.BancoIndisponivel("circuito aberto")
+
+    monkeypatch.setattr(dedup, "registrar_update", falhar)
+    assert processado(1)
+    # O anel em memória continua deduplicando
+    assert not processado(1)
@@ -0,0 +1,80 @@
+import sqlite3
+from datetime import date
+from decimal import Decimal
+
+import pytest
+
+import bot
+from bot import em_centavos, em_reais, formatar_reais, ler_centavos, limites_em_centavos
+
+@pytest.mark.parametrize("texto, centavos", [
+    ("1.500,75", 150075),
+    ("1.500", 150000),
+    ("1.234.567,8", 123456780),
+    ("32.50", 3250),
+    ("32,5", 3250),
+    ("0,5", 50),
+    ("0,05", 5),
+    ("10", 1000),
+    ("R$ 10", 1000),
+    ("r$10,99", 1099),
+    ("  7 ", 700),
+    ("0", 0),
+])
+def test_ler_centavos(texto, centavos):
+    assert ler_centavos(texto) == centavos
+
+@pytest.mark.parametrize("texto", ["1,2,3", "1,234", "12.5.0", "abc", "", "-5", "1e3", "10 reais", "1.50.00"])
+def test_ler_centavos_rejeita(texto):
+    with pytest.raises(ValueError):
+        ler_centavos(texto)
+
+@pytest.mark.parametrize("valor, centavos", [
+    (Decimal("12.34"), 1234),
+    (Decimal("0.005"), 1),
+    (Decimal("0.004"), 0),
+    (Decimal("2.675"), 268),
+    (Decimal("-0.005"), -1),
+    (0.1 + 0.2, 30),
+    (2.675, 268),
+    (1234, 123400),
+])
+def test_em_centavos_arredonda_meio_para_cima(valor, centavos):
+    assert em_centavos(valor) == centavos
+
+def test_em_reais_e_formatar_reais():
+    assert em_reais(150075) == Decimal("1500.75")
+    assert str(em_reais(5)) == "0.05"
+    assert str(em_reais(1000)) == "10.00"
+    assert formatar_reais(3250) == "R$32.50"
+    assert formatar_reais(-1) == "R$-0.01"
+
+def test_limites_em_centavos():
+    assert limites_em_centavos([(None, Decimal("100.00"), 45.5), ("Mercado", 5, Decimal("5.50"))]) == [
+        (None, 10000, 4550), ("Mercado", 500, 550),
+    ]
+
+# O SQLite guarda NUMERIC como REAL: o valor gravado com em_reais volta como float e em_centavos
+# precisa recuperar exatamente os centavos, também depois de somas no banco
+def test_ida_e_volta_no_sqlite():
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE gastos (valor NUMERIC(12, 2) NOT NULL)")
+    valores = [1, 5, 10, 29, 99, 110, 3250, 4999, 150075, 999999999, *range(0, 100000, 7)]
+    conn.executemany("INSERT INTO gastos (valor) VALUES (?)", [(em_reais(centavos),) for centavos in valores])
+
+    lidos = [valor for valor, in conn.execute("SELECT valor FROM gastos ORDER BY rowid")]
+    assert any(isinstance(valor, float) for valor in lidos)
+    assert [em_centavos(valor) for valor in lidos] == valores
+
+    total, = conn.execute("SELECT SUM(CAST(round(valor * 100) AS INTEGER)) FROM gastos").fetchone()
+    assert total == sum(valores)
+
+def test_repositorio_sqlite_preserva_os_centavos(tmp_path):
+    repositorio = bot.RepositorioSQLite(str(tmp_path / "dinheiro.db"))
+    repositorio.inicializar()
+    dia = date(2024, 3, 5)
+    for centavos in (10, 20, 1, 150075):
+        repositorio.salvar_gasto("1", em_reais(centavos), "Mercado", "Pix", dia)
+    assert sorted(em_centavos(valor) for _, valor, *_ in repositorio.listar_gastos_periodo("1", *bot.intervalo_mes(3, 2024))) == [1, 10, 20, 150075]
+    assert repositorio.obter_totais_periodo("1", *bot.intervalo_mes(3, 2024), "month") == [(date(2024, 3, 1), "Mercado", 150106)]
+    repositorio.conexao().close()
@@ -0,0 +1,139 @@
+import asyncio
+import io
+import time
+from datetime import timedelta
+
+import pytest
+from telegram.error import BadRequest, RetryAfter
+
+from bot import AgendadorEnvios, BaldeTokens
+
+# Bot falso no lugar da API do Telegram: registra as chamadas, levanta as falhas na ordem em que
+# foram dadas (None = sucesso) e, com `liberar`, segura cada chamada até o evento ser disparado
+class BotFalso:
+    def __init__(self, falhas=(), liberar=None):
+        self.falhas = list(falhas)
+        self.liberar = liberar
+        self.chamadas = []
+
+    async def responder(self, metodo, kwargs):
+        self.chamadas.append((metodo, kwargs))
+        if self.liberar is not None:
+            await self.liberar.wait()
+        falha = self.falhas.pop(0) if self.falhas else None
+        if falha is not None:
+            raise falha
+        return kwargs
+
+    async def send_message(self, **kwargs):
+        return await self.responder("send_message", kwargs)
+
+    async def send_document(self, **kwargs):
+        kwargs["conteudo"] = kwargs["document"].read()
+        return await self.responder("send_document", kwargs)
+
+    async def edit_message_text(self, **kwargs):
+        return await self.responder("edit_message_text", kwargs)
+
+def novo_agendador(bot, max_tentativas=3):
+    agendador = AgendadorEnvios(1000, 1000, 1000, max_tentativas)
+    agendador.configurar(bot)
+    return agendador
+
+def test_balde_libera_a_rajada_e_depois_segue_a_taxa():
+    async def cenario():
+        balde = BaldeTokens(taxa=20, capacidade=3)
+        inicio = time.monotonic()
+        for _ in range(3):
+            await balde.adquirir()
+        rajada = time.monotonic() - inicio
+        await balde.adquirir()
+        return rajada, time.monotonic() - inicio
+
+    rajada, total = asyncio.run(cenario())
+    assert rajada < 0.02
+    assert total >= 0.04
+
+def test_balde_fica_ocioso_quando_reposto():
+    async def cenario():
+        balde = BaldeTokens(taxa=100, capacidade=2)
+        await balde.adquirir()
+        gasto = balde.ocioso()
+        await asyncio.sleep(0.03)
+        return gasto, balde.ocioso()
+
+    assert asyncio.run(cenario()) == (False, True)
+
+def test_retry_after_aguarda_e_reenvia():
+    async def cenario():
+        bot = BotFalso([RetryAfter(timedelta(milliseconds=200))])
+        agendador = novo_agendador(bot)
+        inicio = time.monotonic()
+        resposta = await agendador.enviar_texto(1, "olá")
+        return bot, resposta, time.monotonic() - inicio
+
+    bot, resposta, duracao = asyncio.run(cenario())
+    assert len(bot.chamadas) == 2
+    assert resposta["text"] == "olá"
+    assert duracao >= 0.18
+
+def test_retry_after_propaga_no_limite_de_tentativas_e_pausa_os_outros_chats():
+    async def cenario():
+        bot = BotFalso([RetryAfter(timedelta(milliseconds=200))] * 2)
+        agendador = novo_agendador(bot, max_tentativas=2)
+        with pytest.raises(RetryAfter):
+            await agendador.enviar_texto(1, "primeiro")
+        assert len(bot.chamadas) == 2
+        inicio = time.monotonic()
+        await agendador.enviar_texto(2, "outro chat")
+        return time.monotonic() - inicio
+
+    assert asyncio.run(cenario()) >= 0.15
+
+def test_documento_e_rebobinado_a_cada_tentativa():
+    async def cenario():
+        bot = BotFalso([RetryAfter(timedelta(milliseconds=10))])
+        agendador = novo_agendador(bot)
+        await agendador.enviar_documento(1, io.BytesIO(b"planilha"), filename="gastos.xlsx")
+        return [kwargs["conteudo"] for _, kwargs in bot.chamadas]
+
+    assert asyncio.run(cenario()) == [b"planilha", b"planilha"]
+
+def test_edicoes_substituidas_sao_descartadas():
+    async def cenario():
+        liberar = asyncio.Event()
+        bot = BotFalso(liberar=liberar)
+        agendador = novo_agendador(bot)
+        primeira = asyncio.create_task(agendador.editar_texto(1, 10, "1"))
+        while not bot.chamadas:
+            await asyncio.sleep(0)
+        seguintes = [asyncio.create_task(agendador.editar_texto(1, 10, texto)) for texto in "234"]
+        await asyncio.sleep(0.01)
+        liberar.set()
+        respostas = await asyncio.gather(primeira, *seguintes)
+        return bot, agendador, respostas
+
+    bot, agendador, respostas = asyncio.run(cenario())
+    assert [kwargs["text"] for _, kwargs in bot.chamadas] == ["1", "4"]
+    assert [resposta and resposta["text"] for resposta in respostas] == ["1", None, None, "4"]
+    assert agendador.edicoes_pendentes == {} and agendador.travas_edicao == {}
+
+def test_edicoes_de_mensagens_diferentes_nao_se_descartam():
+    async def cenario():
+        bot = BotFalso()
+        agendador = novo_agendador(bot)
+        await asyncio.gather(agendador.editar_texto(1, 10, "a"), agendador.editar_texto(1, 11, "b"))
+        return sorted(kwargs["message_id"] for _, kwargs in bot.chamadas)
+
+    assert asyncio.run(cenario()) == [10, 11]
+
+def test_edicao_sem_alteracao_e_ignorada():
+    async def cenario():
+        bot = BotFalso([BadRequest("Message is not modified: specified new message content is the same")])
+        resposta = await novo_agendador(bot).editar_texto(1, 10, "igual")
+        bot = BotFalso([BadRequest("Message to edit not found")])
+        with pytest.raises(BadRequest):
+            await novo_agendador(bot).editar_texto(1, 10, "sumiu")
+        return resposta
+
+    assert asyncio.run(cenario()) is None
@@ -0,0 +1,102 @@
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+from bot import EstadoConversa, FluxoEdicao, FluxoGasto, GerenciadorEstados
+
+# Relógio controlado no lugar do time.monotonic usado pelo gerenciador
+class Relogio:
+    def __init__(self):
+        self.agora = 1000.0
+
+    def __call__(self):
+        return self.agora
+
+@pytest.fixture
+def relogio(monkeypatch):
+    relogio = Relogio()
+    monkeypatch.setattr(bot.time, "monotonic", relogio)
+    return relogio
+
+def test_obter_devolve_o_mesmo_estado_do_chat(relogio):
+    estados = GerenciadorEstados(ttl_segundos=60, maximo_chats=10)
+    conversa = estados.obter("1")
+    conversa.estado = "awaiting_gasto_valor"
+    conversa.fluxo = FluxoGasto(3250)
+    assert estados.obter("1") is conversa
+    assert estados.obter("1").fluxo.valor == 3250
+    assert estados.obter("2") is not conversa
+    assert estados.obter("2").estado is None
+
+def test_estado_expira_depois_do_ttl(relogio):
+    estados = GerenciadorEstados(ttl_segundos=60, maximo_chats=10)
+    estados.obter("1").estado = "awaiting_gasto_valor"
+    relogio.agora += 59
+    assert estados.obter("1").estado == "awaiting_gasto_valor"
+    # Cada acesso renova o prazo
+    relogio.agora += 59
+    assert estados.obter("1").estado == "awaiting_gasto_valor"
+    relogio.agora += 60
+    assert estados.obter("1").estado is None
+    assert estados.descartados == 1
+
+def test_podar_remove_so_os_expirados(relogio):
+    estados = GerenciadorEstados(ttl_segundos=60, maximo_chats=10)
+    for chat in ("1", "2", "3"):
+        estados.obter(chat)
+        relogio.agora += 15
+    estados.obter("1")  # o 1 passa a ser o mais recente
+    relogio.agora += 30  # 2 parado há 60 s (expirado), 3 há 45 s, 1 há 30 s
+    estados.podar()
+    assert list(estados.conversas) == ["3", "1"]
+    relogio.agora += 1000
+    estados.podar()
+    assert not estados.conversas
+    assert estados.descartados == 3
+
+def test_excesso_de_chats_descarta_os_menos_recentes(relogio):
+    estados = GerenciadorEstados(ttl_segundos=3600, maximo_chats=3)
+    for chat in ("1", "2", "3"):
+        estados.obter(chat).estado = f"estado {chat}"
+    estados.obter("1")
+    estados.obter("4")
+    assert list(estados.conversas) == ["3", "1", "4"]
+    assert estados.obter("1").estado == "estado 1"
+    assert estados.obter("2").estado is None
+    assert len(estados.conversas) == 3
+    assert estados.descartados == 2
+
+def test_estatisticas_ordenadas_pelo_tamanho(relogio):
+    estados = GerenciadorEstados(ttl_segundos=60, maximo_chats=10)
+    estados.obter("pequeno")
+    grande = estados.obter("grande")
+    grande.tela_atual = "buscar"
+    grande.pilha.extend(f"tela {i}" for i in range(10))
+    relogio.agora += 10
+    linhas = estados.estatisticas()
+    assert [(chat, tela) for chat, _, _, tela in linhas] == [("grande", "buscar"), ("pequeno", None)]
+    assert linhas[0][1] > linhas[1][1] > 0
+    assert [parado for _, _, parado, _ in linhas] == [10, 10]
+    relogio.agora += 60
+    assert estados.estatisticas() == []
+
+def test_estados_usam_slots():
+    conversa = EstadoConversa()
+    assert not hasattr(conversa, "__dict__")
+    with pytest.raises(AttributeError):
+        conversa.campo_inexistente = 1
+    with pytest.raises(AttributeError):
+        FluxoGasto(100).item_id = 1
+    # A pilha do "Voltar" guarda só as telas mais recentes
+    conversa.pilha.extend(range(bot.NAVEGACAO_PROFUNDIDADE + 5))
+    assert list(conversa.pilha) == list(range(5, bot.NAVEGACAO_PROFUNDIDADE + 5))
+
+def test_fluxo_atual_so_devolve_o_tipo_esperado(relogio, monkeypatch):
+    monkeypatch.setattr(bot, "estados_conversa", GerenciadorEstados(ttl_segundos=60, maximo_chats=10))
+    update = SimpleNamespace(effective_chat=SimpleNamespace(id=7))
+    bot.estado_conversa(update).fluxo = FluxoEdicao(42)
+    assert bot.fluxo_atual(update, FluxoEdicao).item_id == 42
+    assert bot.fluxo_atual(update, FluxoGasto) is None
+    relogio.agora += 61
+    assert bot.fluxo_atual(update, FluxoEdicao) is None
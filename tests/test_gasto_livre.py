@@ -0,0 +1,113 @@
+import asyncio
+from collections import Counter
+from datetime import date
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+from bot import GastoLivre, ModeloGastos, interpretar_data_livre, interpretar_gasto_livre
+
+HOJE = date(2024, 4, 15)
+MODELO_VAZIO = ModeloGastos({}, Counter())
+
+@pytest.mark.parametrize("texto, centavos", [
+    ("gastei 32,50 no uber", 3250),
+    ("gastei 32.50 no uber", 3250),
+    ("gastei 0,5 no uber", 50),
+    ("gastei R$ 10 no uber", 1000),
+    ("gastei r$10 no uber", 1000),
+    ("gastei 1.500,75 no uber", 150075),
+    ("gastei 1.500 no uber", 150000),
+    ("uber 7", 700),
+])
+def test_valores(texto, centavos):
+    assert interpretar_gasto_livre(texto, HOJE, MODELO_VAZIO, Counter()).valor == centavos
+
+@pytest.mark.parametrize("texto, hoje, esperada", [
+    ("uber", HOJE, HOJE),
+    ("uber ontem", HOJE, date(2024, 4, 14)),
+    ("uber anteontem", date(2024, 1, 1), date(2023, 12, 30)),
+    ("uber 10/04", HOJE, date(2024, 4, 10)),
+    ("uber 10/04/23", HOJE, date(2023, 4, 10)),
+    ("uber 10/04/2022", HOJE, date(2022, 4, 10)),
+    # Sem o ano, uma data futura é do ano passado
+    ("uber 28/12", date(2025, 1, 3), date(2024, 12, 28)),
+    ("uber 29/02", date(2025, 3, 1), date(2024, 2, 29)),
+    ("uber dia 3", HOJE, date(2024, 4, 3)),
+    ("uber dia 15", HOJE, HOJE),
+    # Um dia que ainda não chegou é do mês passado, limitado ao último dia dele
+    ("uber dia 20", HOJE, date(2024, 3, 20)),
+    ("uber dia 31", date(2024, 5, 10), date(2024, 4, 30)),
+    ("uber dia 30", date(2024, 3, 5), date(2024, 2, 29)),
+    ("uber dia 31", date(2024, 1, 10), date(2023, 12, 31)),
+    ("uber dia 31", date(2024, 4, 30), date(2024, 3, 31)),
+])
+def test_datas(texto, hoje, esperada):
+    assert interpretar_data_livre(texto, hoje) == esperada
+
+@pytest.mark.parametrize("texto", ["uber 31/02", "uber 10/13/2024", "uber dia 0", "uber dia 32", "uber 29/02", "uber 31/04/2024"])
+def test_datas_inexistentes(texto):
+    with pytest.raises(ValueError):
+        interpretar_data_livre(texto, date(2026, 3, 1))
+
+def test_data_inexistente_so_e_erro_em_um_gasto():
+    with pytest.raises(ValueError):
+        interpretar_gasto_livre("gastei 50 no uber 31/02", HOJE, MODELO_VAZIO, Counter())
+    # Sem ser um gasto, a data nem é interpretada
+    assert interpretar_gasto_livre("te vejo 31/02 as 10", HOJE, MODELO_VAZIO, Counter()) is None
+
+@pytest.mark.parametrize("texto", [
+    "oi, tudo bem?",
+    "que horas são",
+    "te encontro as 10",
+    "chego em 5 minutos",
+    "gastei muito esse mês",
+    "paguei 0 no uber",
+])
+def test_conversa_e_ignorada(texto):
+    assert interpretar_gasto_livre(texto, HOJE, MODELO_VAZIO, Counter()) is None
+
+@pytest.mark.parametrize("texto, modelo, categorias, esperado", [
+    # Palavras conhecidas quando o usuário ainda não tem histórico
+    ("gastei 32,50 no uber ontem no pix", MODELO_VAZIO, Counter(),
+     GastoLivre(3250, "Transporte", "Pix", date(2024, 4, 14), ("uber",))),
+    ("farmácia 20 no débito", MODELO_VAZIO, Counter(),
+     GastoLivre(2000, "Saúde", "Cartão de Débito", HOJE, ("farmacia",))),
+    # O modelo do usuário tem prioridade, e a forma mais usada é o padrão
+    ("uber 15", ModeloGastos({"uber": "Trabalho"}, Counter({"Dinheiro": 3, "Pix": 1})), Counter(),
+     GastoLivre(1500, "Trabalho", "Dinheiro", HOJE, ("uber",))),
+    # Depois, os nomes das categorias do próprio usuário, sem os gastos fixos
+    ("40 no pet shop", MODELO_VAZIO, Counter({"Pet Shop": 2, "Aluguel (MENSAL)": 5}),
+     GastoLivre(4000, "Pet Shop", "Pix", HOJE, ("pet", "shop"))),
+    ("paguei 900 aluguel", MODELO_VAZIO, Counter({"Aluguel (MENSAL)": 5}),
+     GastoLivre(90000, "Aluguel", "Pix", HOJE, ("aluguel",))),
+    # Sem categoria reconhecida, só com "gastei", "paguei"...
+    ("gastei 12 com coisas", MODELO_VAZIO, Counter(),
+     GastoLivre(1200, "Outros", "Pix", HOJE, ())),
+    ("comprei 8,90 no cartão", MODELO_VAZIO, Counter(),
+     GastoLivre(890, "Outros", "Cartão de Crédito", HOJE, ())),
+])
+def test_categorias(texto, modelo, categorias, esperado):
+    assert interpretar_gasto_livre(texto, HOJE, modelo, categorias) == esperado
+
+def atualizacao(texto):
+    return SimpleNamespace(message=SimpleNamespace(text=texto, chat=SimpleNamespace(id=1)), effective_chat=SimpleNamespace(id=1))
+
+def test_conversa_sem_valor_nao_consulta_o_banco(monkeypatch):
+    respostas = []
+
+    def banco_fora(usuario):
+        raise bot.BancoIndisponivel("circuito aberto")
+
+    async def responder(update, texto, reply_markup=None, parse_mode=None):
+        respostas.append(texto)
+
+    monkeypatch.setattr(bot, "obter_modelo_gastos", banco_fora)
+    monkeypatch.setattr(bot, "responder", responder)
+    asyncio.run(bot.registrar_gasto_livre(atualizacao("bom dia!")))
+    assert respostas == []
+
+    # Com um valor, a falha do banco responde sem expor a exceção
+    asyncio.run(bot.registrar_gasto_livre(atualizacao("gastei 10 no uber")))
+    assert respostas == ["Erro ao salvar o gasto. Tente novamente mais tarde."]
@@ -0,0 +1,72 @@
+from datetime import date
+
+import pytest
+
+from bot import (
+    Periodo, date_trunc_sqlite, deslocar_data, deslocar_periodo, granularidade_periodo, interpretar_periodo,
+    rotulo_periodo,
+)
+
+HOJE = date(2024, 10, 15)
+
+@pytest.mark.parametrize("texto, periodo, rotulo", [
+    ("2024", Periodo(date(2024, 1, 1), date(2025, 1, 1), "ano"), "2024"),
+    ("ano", Periodo(date(2024, 1, 1), date(2024, 10, 16), "ano_ate_hoje"), "2024 (até 15/10)"),
+    ("10/2024", Periodo(date(2024, 10, 1), date(2024, 11, 1), "mes"), "10/2024"),
+    ("1/2024", Periodo(date(2024, 1, 1), date(2024, 2, 1), "mes"), "01/2024"),
+    (" 12/2024 ", Periodo(date(2024, 12, 1), date(2025, 1, 1), "mes"), "12/2024"),
+    ("T3 2024", Periodo(date(2024, 7, 1), date(2024, 10, 1), "trimestre"), "3º trimestre de 2024"),
+    ("t4/2024", Periodo(date(2024, 10, 1), date(2025, 1, 1), "trimestre"), "4º trimestre de 2024"),
+    ("T1 2025", Periodo(date(2025, 1, 1), date(2025, 4, 1), "trimestre"), "1º trimestre de 2025"),
+    ("28/12/2024 03/01/2025", Periodo(date(2024, 12, 28), date(2025, 1, 4), "personalizado"), "28/12/2024 a 03/01/2025"),
+    ("15/10/2024 15/10/2024", Periodo(date(2024, 10, 15), date(2024, 10, 16), "personalizado"), "15/10/2024 a 15/10/2024"),
+])
+def test_interpretar_periodo(texto, periodo, rotulo):
+    assert interpretar_periodo(texto, HOJE) == periodo
+    assert rotulo_periodo(periodo) == rotulo
+
+@pytest.mark.parametrize("texto", [
+    "", "semana", "13/2024", "0/2024", "T5 2024", "T0 2024", "24", "10/24", "2024-10",
+    "31/02/2024 01/03/2024", "10/03/2024 01/03/2024", "01/01/2024", "01/01/2024 02/01/2024 03/01/2024",
+    "0000", "12/9999", "T4 9999", "01/01/0001 01/01/10000",
+])
+def test_periodos_invalidos(texto):
+    assert interpretar_periodo(texto, HOJE) is None
+
+@pytest.mark.parametrize("periodo, delta, esperado", [
+    # Meses, trimestres e anos atravessando a virada do ano
+    (Periodo(date(2024, 12, 1), date(2025, 1, 1), "mes"), 1, Periodo(date(2025, 1, 1), date(2025, 2, 1), "mes")),
+    (Periodo(date(2025, 1, 1), date(2025, 2, 1), "mes"), -1, Periodo(date(2024, 12, 1), date(2025, 1, 1), "mes")),
+    (Periodo(date(2024, 10, 1), date(2025, 1, 1), "trimestre"), 1, Periodo(date(2025, 1, 1), date(2025, 4, 1), "trimestre")),
+    (Periodo(date(2025, 1, 1), date(2025, 4, 1), "trimestre"), -1, Periodo(date(2024, 10, 1), date(2025, 1, 1), "trimestre")),
+    (Periodo(date(2024, 1, 1), date(2025, 1, 1), "ano"), -1, Periodo(date(2023, 1, 1), date(2024, 1, 1), "ano")),
+    # O ano até hoje anda de ano em ano, com o fim no mesmo dia (29/02 vira 28/02)
+    (Periodo(date(2024, 1, 1), date(2024, 3, 1), "ano_ate_hoje"), -1, Periodo(date(2023, 1, 1), date(2023, 3, 1), "ano_ate_hoje")),
+    (Periodo(date(2024, 1, 1), date(2024, 2, 29), "ano_ate_hoje"), -1, Periodo(date(2023, 1, 1), date(2023, 2, 28), "ano_ate_hoje")),
+    # Períodos personalizados andam pela própria duração: uma semana vira a semana seguinte
+    (Periodo(date(2024, 12, 30), date(2025, 1, 6), "personalizado"), -1, Periodo(date(2024, 12, 23), date(2024, 12, 30), "personalizado")),
+    (Periodo(date(2024, 12, 23), date(2024, 12, 30), "personalizado"), 2, Periodo(date(2025, 1, 6), date(2025, 1, 13), "personalizado")),
+])
+def test_deslocar_periodo(periodo, delta, esperado):
+    assert deslocar_periodo(periodo, delta) == esperado
+
+def test_deslocar_data_limita_ao_fim_do_mes():
+    assert deslocar_data(date(2024, 1, 31), 1) == date(2024, 2, 29)
+    assert deslocar_data(date(2024, 3, 31), -13) == date(2023, 2, 28)
+    assert deslocar_data(date(2024, 11, 30), 2) == date(2025, 1, 30)
+
+def test_periodos_curtos_evoluem_por_semana():
+    assert granularidade_periodo(interpretar_periodo("10/2024", HOJE)) == "month"
+    assert granularidade_periodo(interpretar_periodo("T4 2024", HOJE)) == "month"
+    assert granularidade_periodo(interpretar_periodo("01/12/2024 31/01/2025", HOJE)) == "week"
+    assert granularidade_periodo(interpretar_periodo("01/12/2024 01/02/2025", HOJE)) == "month"
+
+@pytest.mark.parametrize("data, semana", [
+    ("2025-01-01", "2024-12-30"),
+    ("2024-12-29", "2024-12-23"),
+    ("2024-12-30", "2024-12-30"),
+    ("2025-01-05 10:00:00", "2024-12-30"),
+])
+def test_semana_no_sqlite_comeca_na_segunda_inclusive_na_virada_do_ano(data, semana):
+    assert date_trunc_sqlite("week", data) == semana
+    assert date_trunc_sqlite("month", data) == data[:8] + "01"
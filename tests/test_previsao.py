@@ -0,0 +1,71 @@
+from datetime import date
+from decimal import Decimal
+
+import pytest
+
+from bot import calcular_perfis_diarios, calcular_previsao
+
+def compromisso(centavos, periodicidade, neste_mes):
+    return {"centavos": centavos, "periodicidade": periodicidade, "neste_mes": neste_mes}
+
+# Sem histórico (sem perfil diário) a extrapolação é linear pelos dias do mês, com um piso no
+# início do mês para não multiplicar demais o primeiro gasto
+@pytest.mark.parametrize("gasto_variavel, hoje, previsao", [
+    (0, date(2024, 4, 10), 0),
+    (10000, date(2024, 4, 10), 30000),
+    (10000, date(2024, 4, 15), 20000),
+    (10000, date(2024, 2, 29), 10000),
+    (10000, date(2024, 4, 30), 10000),
+    # Dia 1 de abril: 1/30 do mês, limitado a PREVISAO_FRACAO_MINIMA
+    (10000, date(2024, 4, 1), 100000),
+    (10000, date(2024, 4, 2), 100000),
+    (10000, date(2024, 4, 6), 50000),
+])
+def test_mes_sem_historico(gasto_variavel, hoje, previsao):
+    assert calcular_previsao(gasto_variavel, 0, {}, None, hoje) == previsao
+    assert calcular_previsao(gasto_variavel, 0, {}, [], hoje) == previsao
+
+def test_perfil_diario_do_usuario():
+    fracao = [0.05] * 9 + [0.5] + [0.6] * 20 + [1.0]
+    assert calcular_previsao(10000, 0, {}, fracao, date(2024, 5, 10)) == 20000
+    # Um perfil com pouco gasto até o dia é limitado à metade da fração linear
+    assert calcular_previsao(10000, 0, {}, fracao, date(2024, 5, 9)) == round(10000 / (9 / 31 / 2))
+    assert calcular_previsao(10000, 0, {}, fracao, date(2024, 5, 31)) == 10000
+
+def test_compromissos_recorrentes():
+    hoje = date(2024, 4, 10)  # faltam 20 dias
+    compromissos = {
+        "Café (DIÁRIO)": compromisso(1000, "DIÁRIO", True),
+        "Feira (SEMANAL)": compromisso(5000, "SEMANAL", True),
+        "Aluguel (MENSAL)": compromisso(150000, "MENSAL", True),
+        "Academia (MENSAL)": compromisso(9990, "MENSAL", False),
+    }
+    # Variável linear (30000) + fixos já lançados + 20 cafés + 2 feiras + a academia que ainda não foi lançada
+    assert calcular_previsao(10000, 150000 + 9000, compromissos, None, hoje) == 30000 + 159000 + 20000 + 10000 + 9990
+
+def test_compromissos_no_fim_do_mes():
+    compromissos = {
+        "Café (DIÁRIO)": compromisso(1000, "DIÁRIO", True),
+        "Feira (SEMANAL)": compromisso(5000, "SEMANAL", True),
+    }
+    assert calcular_previsao(0, 31000, compromissos, None, date(2024, 3, 31)) == 31000
+    assert calcular_previsao(0, 0, compromissos, None, date(2024, 3, 24)) == 7000 + 5000
+
+def test_perfis_diarios():
+    linhas = [
+        # Usuário "1": em janeiro metade do gasto no dia 1 e metade no dia 16; em fevereiro tudo no dia 29
+        ("1", date(2024, 1, 1), 1, Decimal("100.00")),
+        ("1", date(2024, 1, 1), 16, Decimal("100.00")),
+        ("1", date(2024, 2, 1), 29, Decimal("50.00")),
+        # Usuário "2" tem um só mês, abaixo de PREVISAO_MESES_MINIMOS
+        ("2", date(2024, 2, 1), 3, Decimal("10.00")),
+    ]
+    perfis = calcular_perfis_diarios(linhas)
+    assert [(usuario, meses) for usuario, _, meses in perfis] == [("1", 2)]
+    fracao = perfis[0][1]
+    assert len(fracao) == 31
+    assert fracao == [0.25] * 15 + [0.5] * 13 + [1.0] * 3
+    assert calcular_perfis_diarios([]) == []
+
+    # O perfil alimenta a previsão: no dia 15 o usuário costuma ter gasto 1/4 do mês
+    assert calcular_previsao(10000, 0, {}, fracao, date(2024, 3, 15)) == 40000
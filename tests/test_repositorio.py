@@ -0,0 +1,261 @@
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+import pytest
+
+import bot
+from bot import FiltrosBusca, em_centavos, em_reais, limites_em_centavos
+
+# O mesmo contrato roda no SQLite (sempre, sem rede) e no PostgreSQL quando DATABASE_URL está
+# definido. Cada teste usa um usuário novo, então o banco do PostgreSQL não precisa ser limpo
+BACKENDS = [
+    "sqlite",
+    pytest.param("postgres", marks=pytest.mark.skipif(not os.environ.get("DATABASE_URL"), reason="DATABASE_URL não definido")),
+]
+
+MARCO = (date(2024, 3, 1), date(2024, 4, 1))
+
+@pytest.fixture(params=BACKENDS)
+def repositorio(request, tmp_path):
+    if request.param == "sqlite":
+        repositorio = bot.RepositorioSQLite(str(tmp_path / "contrato.db"))
+    else:
+        repositorio = bot.RepositorioPostgres()
+    repositorio.inicializar()
+    yield repositorio
+    if request.param == "sqlite":
+        repositorio.conexao().close()
+
+@pytest.fixture
+def usuario():
+    return uuid.uuid4().hex
+
+def gastos_em_centavos(repositorio, usuario, inicio=MARCO[0], fim=MARCO[1]):
+    return sorted(
+        (em_centavos(valor), categoria, forma_pagamento, data)
+        for _, valor, categoria, forma_pagamento, data in repositorio.listar_gastos_periodo(usuario, inicio, fim)
+    )
+
+# As chaves de idempotência são ids de update, únicos entre todos os usuários
+def nova_chave():
+    return uuid.uuid4().hex
+
+def totais_do_mes(repositorio, usuario):
+    return sorted(repositorio.obter_totais_periodo(usuario, *MARCO, "month"), key=lambda linha: linha[1] or "")
+
+# Um backend que não implementa algum método da interface falha já na criação, não na chamada
+@pytest.mark.parametrize("classe", [bot.RepositorioPostgres, bot.RepositorioSQLite])
+def test_backends_implementam_toda_a_interface(classe, tmp_path):
+    assert not classe.__abstractmethods__
+    assert isinstance(classe() if classe is bot.RepositorioPostgres else classe(str(tmp_path / "novo.db")), bot.Repositorio)
+
+def test_backend_incompleto_nao_e_instanciado():
+    class RepositorioIncompleto(bot.RepositorioSQLite):
+        buscar = bot.Repositorio.buscar
+
+    with pytest.raises(TypeError, match="buscar"):
+        RepositorioIncompleto(":memory:")
+    with pytest.raises(TypeError):
+        bot.Repositorio()
+
+def test_chave_de_idempotencia_grava_uma_vez(repositorio, usuario):
+    chave_gasto, chave_entrada = nova_chave(), nova_chave()
+    assert repositorio.salvar_gasto(usuario, em_reais(1050), "Mercado", "Pix", date(2024, 3, 5), chave_gasto)
+    assert not repositorio.salvar_gasto(usuario, em_reais(1050), "Mercado", "Pix", date(2024, 3, 5), chave_gasto)
+    assert repositorio.salvar_entrada(usuario, em_reais(500000), "Salário", date(2024, 3, 5), chave_entrada)
+    assert not repositorio.salvar_entrada(usuario, em_reais(500000), "Salário", date(2024, 3, 5), chave_entrada)
+    # Sem chave não há deduplicação
+    assert repositorio.salvar_gasto(usuario, em_reais(1050), "Mercado", "Pix", date(2024, 3, 5))
+    assert repositorio.salvar_gasto(usuario, em_reais(1050), "Mercado", "Pix", date(2024, 3, 5))
+
+    assert len(repositorio.listar_gastos_periodo(usuario, *MARCO)) == 3
+    assert len(repositorio.listar_entradas_periodo(usuario, *MARCO)) == 1
+
+def test_totais_do_periodo_em_centavos(repositorio, usuario):
+    for centavos in (10, 20, 10, 20):
+        repositorio.salvar_gasto(usuario, em_reais(centavos), "Mercado", "Pix", date(2024, 3, 10))
+    repositorio.salvar_gasto(usuario, em_reais(4000), "lazer ", "Crédito", date(2024, 3, 31))
+    repositorio.salvar_gasto(usuario, em_reais(99999), "Mercado", "Pix", date(2024, 4, 1))
+    repositorio.salvar_entrada(usuario, em_reais(123456), "Salário", date(2024, 3, 1))
+
+    totais = totais_do_mes(repositorio, usuario)
+    assert totais == [
+        (date(2024, 3, 1), None, 123456),
+        (date(2024, 3, 1), "Lazer", 4000),
+        (date(2024, 3, 1), "Mercado", 60),
+    ]
+    assert all(type(total) is int for _, _, total in totais)
+
+def test_totais_por_semana(repositorio, usuario):
+    repositorio.salvar_gasto(usuario, em_reais(100), "Mercado", "Pix", date(2024, 3, 4))
+    repositorio.salvar_gasto(usuario, em_reais(200), "Mercado", "Pix", date(2024, 3, 10))
+    repositorio.salvar_gasto(usuario, em_reais(300), "Mercado", "Pix", date(2024, 3, 11))
+
+    assert sorted(repositorio.obter_totais_periodo(usuario, *MARCO, "week")) == [
+        (date(2024, 3, 4), "Mercado", 300),
+        (date(2024, 3, 11), "Mercado", 300),
+    ]
+
+def test_limites_geral_e_por_categoria(repositorio, usuario):
+    repositorio.definir_limite(usuario, em_reais(10000))
+    repositorio.definir_limite_categoria(usuario, "Mercado", em_reais(500))
+    repositorio.definir_limite_categoria(usuario, "Viagem", em_reais(20000))
+    repositorio.salvar_gasto(usuario, em_reais(300), "Mercado", "Pix", date(2024, 3, 2))
+    repositorio.salvar_gasto(usuario, em_reais(250), "mercado (MENSAL)", "Pix", date(2024, 3, 3))
+    repositorio.salvar_gasto(usuario, em_reais(4000), "Lazer", "Pix", date(2024, 3, 4))
+    repositorio.salvar_gasto(usuario, em_reais(7000), "Lazer", "Pix", date(2024, 2, 28))
+
+    assert em_centavos(repositorio.obter_limite(usuario)) == 10000
+    assert sorted(limites_em_centavos(repositorio.avaliar_limites(usuario, *MARCO)), key=lambda linha: linha[0] or "") == [
+        (None, 10000, 4550),
+        ("Mercado", 500, 550),
+        ("Viagem", 20000, 0),
+    ]
+
+    repositorio.definir_limite(usuario, em_reais(20000))
+    assert em_centavos(repositorio.obter_limite(usuario)) == 20000
+
+def test_editar_e_remover_so_alteram_o_proprio_usuario(repositorio, usuario):
+    repositorio.salvar_gasto(usuario, em_reais(1000), "Mercado", "Pix", date(2024, 3, 5))
+    repositorio.salvar_entrada(usuario, em_reais(5000), "Freela", date(2024, 3, 6))
+    gasto_id = repositorio.listar_gastos_periodo(usuario, *MARCO)[0][0]
+    entrada_id = repositorio.listar_entradas_periodo(usuario, *MARCO)[0][0]
+
+    repositorio.editar_gasto(uuid.uuid4().hex, gasto_id, {"valor": em_reais(1)})
+    repositorio.remover_gasto(uuid.uuid4().hex, gasto_id)
+    assert gastos_em_centavos(repositorio, usuario) == [(1000, "Mercado", "Pix", date(2024, 3, 5))]
+
+    repositorio.editar_gasto(usuario, gasto_id, {"valor": em_reais(1234), "categoria": "Lazer"})
+    assert gastos_em_centavos(repositorio, usuario) == [(1234, "Lazer", "Pix", date(2024, 3, 5))]
+    assert totais_do_mes(repositorio, usuario) == [(date(2024, 3, 1), None, 5000), (date(2024, 3, 1), "Lazer", 1234)]
+
+    repositorio.editar_entrada(usuario, entrada_id, {"descricao": "Freelance"})
+    _, valor, descricao, _ = repositorio.listar_entradas_periodo(usuario, *MARCO)[0]
+    assert (em_centavos(valor), descricao) == (5000, "Freelance")
+
+    repositorio.remover_gasto(usuario, gasto_id)
+    repositorio.remover_entrada(usuario, entrada_id)
+    assert repositorio.listar_gastos_periodo(usuario, *MARCO) == []
+    assert repositorio.listar_entradas_periodo(usuario, *MARCO) == []
+
+def test_busca_tolera_erros_e_filtra_em_centavos(repositorio, usuario):
+    repositorio.salvar_gasto(usuario, em_reais(4999), "Mercado", "Pix", date(2024, 3, 5))
+    repositorio.salvar_gasto(usuario, em_reais(5000), "Mercado", "Débito", date(2024, 3, 6))
+    repositorio.salvar_gasto(usuario, em_reais(20000), "Mercado", "Crédito", date(2024, 5, 1))
+    repositorio.salvar_gasto(usuario, em_reais(5000), "Farmácia", "Pix", date(2024, 3, 7))
+    repositorio.salvar_entrada(usuario, em_reais(5000), "Venda no mercado livre", date(2024, 3, 8))
+
+    def buscar(termo, filtros=FiltrosBusca()):
+        return [(tipo, em_centavos(valor), texto) for tipo, _, valor, texto, _, _ in repositorio.buscar(usuario, termo, filtros, 10, 0)]
+
+    todos = [
+        ("entrada", 5000, "Venda no mercado livre"),
+        ("gasto", 4999, "Mercado"), ("gasto", 5000, "Mercado"), ("gasto", 20000, "Mercado"),
+    ]
+    assert sorted(buscar("mercado")) == todos
+    assert sorted(buscar("mercdo")) == todos
+    assert sorted(buscar("mercado", FiltrosBusca(valor_min=5000, valor_max=5000, fim=date(2024, 4, 1)))) == [
+        ("entrada", 5000, "Venda no mercado livre"), ("gasto", 5000, "Mercado"),
+    ]
+    assert buscar("mercado", FiltrosBusca(inicio=date(2024, 4, 1))) == [("gasto", 20000, "Mercado")]
+    assert buscar("viagem") == []
+
+def test_busca_pagina_por_limite_e_deslocamento(repositorio, usuario):
+    for dia in range(1, 8):
+        repositorio.salvar_gasto(usuario, em_reais(dia * 100), "Mercado", "Pix", date(2024, 3, dia))
+
+    paginas = [repositorio.buscar(usuario, "mercado", FiltrosBusca(), 3, deslocamento) for deslocamento in (0, 3, 6)]
+    assert [len(pagina) for pagina in paginas] == [3, 3, 1]
+    assert [linha[5] for pagina in paginas for linha in pagina] == [date(2024, 3, dia) for dia in range(7, 0, -1)]
+
+def test_gasto_livre_aprende_palavras_e_e_idempotente(repositorio, usuario):
+    chave = nova_chave()
+    repositorio.definir_limite(usuario, em_reais(1000))
+    gasto_id, limites = repositorio.salvar_gasto_livre(
+        usuario, em_reais(3250), "Transporte", "Pix", date(2024, 3, 5), chave, ["uber"], *MARCO
+    )
+    assert gasto_id is not None
+    assert limites_em_centavos(limites) == [(None, 1000, 3250)]
+
+    repetido, _ = repositorio.salvar_gasto_livre(
+        usuario, em_reais(3250), "Transporte", "Pix", date(2024, 3, 5), chave, ["uber"], *MARCO
+    )
+    assert repetido is None
+
+    palavras, formas = repositorio.carregar_modelo_gastos(usuario)
+    assert palavras == {"uber": "Transporte"}
+    assert [tuple(linha) for linha in formas] == [("Pix", 1)]
+    assert [tuple(linha) for linha in repositorio.contar_categorias(usuario)] == [("Transporte", 1)]
+
+def test_backup_restaurado_sem_duplicar(repositorio, usuario):
+    repositorio.salvar_gasto(usuario, em_reais(1050), "Mercado", "Pix", date(2024, 3, 5))
+    repositorio.salvar_gasto(usuario, em_reais(1050), "Mercado", "Pix", date(2024, 3, 5))
+    repositorio.salvar_gasto(usuario, em_reais(8990), "Lazer", None, date(2024, 3, 9))
+    repositorio.salvar_entrada(usuario, em_reais(500000), "Salário", date(2024, 3, 1))
+    repositorio.salvar_entrada(usuario, em_reais(7000), None, date(2024, 3, 2))
+    repositorio.definir_limite(usuario, em_reais(300000))
+    repositorio.definir_limite_categoria(usuario, "Mercado", em_reais(80000))
+    backup = list(repositorio.exportar_conta(usuario))
+
+    # Restaurar na mesma conta não insere nada
+    inseridos = repositorio.restaurar_conta(usuario, backup)
+    assert sum(inseridos.values()) == 0
+
+    outro = uuid.uuid4().hex
+    inseridos = repositorio.restaurar_conta(outro, backup)
+    assert {tipo: quantidade for tipo, quantidade in inseridos.items() if quantidade} == {
+        "gasto": 3, "entrada": 2, "limite": 1, "limite_categoria": 1,
+    }
+    assert gastos_em_centavos(repositorio, outro) == gastos_em_centavos(repositorio, usuario)
+    assert totais_do_mes(repositorio, outro) == totais_do_mes(repositorio, usuario)
+    assert sorted(limites_em_centavos(repositorio.avaliar_limites(outro, *MARCO)), key=lambda linha: linha[0] or "") == [
+        (None, 300000, 11090),
+        ("Mercado", 80000, 2100),
+    ]
+
+    # Um backup restaurado duas vezes continua sem duplicar
+    assert sum(repositorio.restaurar_conta(outro, backup).values()) == 0
+
+# Lançamentos arquivados só existem como totais mensais; o corte é o mês seguinte ao último arquivado
+def test_corte_do_arquivo(repositorio, usuario):
+    assert repositorio.obter_corte_arquivo(usuario) is None
+    repositorio.restaurar_conta(usuario, [
+        ("gasto_arquivado", (date(2022, 5, 1), "Mercado", em_reais(1000), 2)),
+        ("entrada_arquivada", (date(2022, 7, 1), em_reais(5000), 1)),
+    ])
+    assert repositorio.obter_corte_arquivo(usuario) == (date(2022, 8, 1) if repositorio.analises else None)
+
+def test_updates_registrados_uma_vez(repositorio):
+    update_id = uuid.uuid4().int % 2**62
+    assert repositorio.registrar_update(update_id)
+    assert not repositorio.registrar_update(update_id)
+
+def test_metricas_contam_cada_usuario_ativo_uma_vez_por_dia(repositorio, usuario):
+    dia = date.today()
+
+    def contadores():
+        return {metrica: valor for d, metrica, valor in repositorio.obter_metricas(dia) if d == dia}
+
+    antes = contadores()
+    repositorio.registrar_metricas({(dia, "gastos"): 2}, {dia: {usuario}})
+    repositorio.registrar_metricas({(dia, "gastos"): 1}, {dia: {usuario}})
+    depois = contadores()
+    assert depois["gastos"] - antes.get("gastos", 0) == 3
+    assert depois["usuarios_ativos"] - antes.get("usuarios_ativos", 0) == 1
+
+# Jobs em asyncio.to_thread e no executor usam o repositório ao mesmo tempo que o laço de eventos
+def test_sqlite_aceita_transacoes_de_varias_threads(tmp_path, usuario):
+    repositorio = bot.RepositorioSQLite(str(tmp_path / "threads.db"))
+    repositorio.inicializar()
+
+    def gravar(_):
+        for _ in range(40):
+            repositorio.salvar_gasto_livre(usuario, em_reais(100), "Mercado", "Pix", date(2024, 3, 5), nova_chave(), ["feira"], *MARCO)
+            repositorio.listar_gastos_periodo(usuario, *MARCO)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(gravar, range(8)))
+    assert totais_do_mes(repositorio, usuario) == [(date(2024, 3, 1), "Mercado", 32000)]
+    assert repositorio.carregar_modelo_gastos(usuario)[0] == {"feira": "Mercado"}